@@ -1,32 +1,23 @@
-import json
 import boto3
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 from datetime import datetime, timedelta
-from decimal import Decimal
-import math
+import dynamo_reader
+import geo_stats
+import json_codec
 
 app = Flask(__name__)
 CORS(app, origins=['https://tylerporras.github.io'])
+# Decimal attributes are converted by the encoder, no pre-walk needed
+json_codec.init_app(app)
 
 # Initialize DynamoDB
 dynamodb = boto3.resource('dynamodb', region_name='us-west-1')
 table = dynamodb.Table('teltonika-events')
 vehicle_mapping_table = dynamodb.Table('vehicle-mapping')
 
-# Convert Decimal to int/float for JSON serialization
-def decimal_to_number(obj):
-    """Convert Decimal objects to int or float"""
-    if isinstance(obj, Decimal):
-        if obj % 1 == 0:
-            return int(obj)
-        else:
-            return float(obj)
-    elif isinstance(obj, dict):
-        return {k: decimal_to_number(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [decimal_to_number(item) for item in obj]
-    return obj
+# Item attributes used to build trips
+TRIP_ATTRIBUTES = ('timestamp', 'vin', 'records')
 
 # VIN decoder
 def decode_vin(vin):
@@ -82,53 +73,22 @@ def decode_vin(vin):
     
     return vehicle_info
 
-# Calculate distance between two GPS points using Haversine formula
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    Returns distance in meters
-    """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    
-    # Radius of earth in meters
-    r = 6371000
-    
-    return c * r
-
 # Calculate trip distance from GPS points
-def calculate_gps_distance(records):
-    """Calculate total distance from GPS coordinates"""
-    total_distance = 0
+def calculate_trip_stats(records):
+    """GPS distance, max speed and average moving speed of a trip's records"""
+    lats = []
+    lons = []
+    speeds = []
+    for record in records:
+        gps = record.get('gps', {})
+        valid = gps.get('valid')
+        lats.append(gps.get('latitude') if valid else None)
+        lons.append(gps.get('longitude') if valid else None)
+        speeds.append(gps.get('speed_kmh'))
     
-    for i in range(1, len(records)):
-        prev = records[i-1]
-        curr = records[i]
-        
-        # Get GPS data
-        prev_gps = prev.get('gps', {})
-        curr_gps = curr.get('gps', {})
-        
-        if prev_gps.get('valid') and curr_gps.get('valid'):
-            prev_lat = prev_gps.get('latitude')
-            prev_lon = prev_gps.get('longitude')
-            curr_lat = curr_gps.get('latitude')
-            curr_lon = curr_gps.get('longitude')
-            
-            if all([prev_lat, prev_lon, curr_lat, curr_lon]):
-                distance = haversine_distance(prev_lat, prev_lon, curr_lat, curr_lon)
-                # Only add if reasonable (less than 500m between points, accounting for 30s intervals)
-                if distance < 500:
-                    total_distance += distance
-    
-    return total_distance
+    # Only count reasonable steps (less than 500m between points, accounting for 30s intervals)
+    return geo_stats.trip_stats(geo_stats.to_array(lats), geo_stats.to_array(lons),
+                                geo_stats.to_array(speeds), max_step_m=500)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -160,7 +120,7 @@ def get_latest_data(imei):
         item = response['Items'][0]
         
         # Parse the records JSON string
-        records = json.loads(item.get('records', '[]'))
+        records = json_codec.loads(item.get('records', '[]'))
         latest_record = records[0] if records else {}
         
         # Get VIN and convert to string (may be stored as number due to Lambda issue)
@@ -174,12 +134,11 @@ def get_latest_data(imei):
         else:
             vin = 'Unknown'
         
-        # Convert Decimal to int/float
         result = {
             'imei': item.get('imei'),
             'timestamp': int(item.get('timestamp', 0)),
             'vin': vin,
-            'data': decimal_to_number(latest_record)
+            'data': latest_record
         }
         
         return jsonify(result)
@@ -197,21 +156,12 @@ def get_trips(imei):
         # Calculate start time
         start_time = int((datetime.utcnow() - timedelta(hours=hours)).timestamp() * 1000)
         
-        # Query DynamoDB
-        response = table.query(
-            KeyConditionExpression='imei = :imei AND #ts >= :start_time',
-            ExpressionAttributeNames={
-                '#ts': 'timestamp'
-            },
-            ExpressionAttributeValues={
-                ':imei': imei,
-                ':start_time': start_time
-            },
-            ScanIndexForward=True
+        # Query DynamoDB: every page, in parallel time segments, only the trip attributes
+        items = dynamo_reader.query_window(
+            table.table_name, imei, start_time,
+            attributes=TRIP_ATTRIBUTES, decode_records=True
         )
         
-        items = response['Items']
-        
         if not items:
             return jsonify({'count': 0, 'trips': [], 'imei': imei})
         
@@ -242,17 +192,14 @@ def get_trips(imei):
         current_trip = None
         
         for item in items:
-            # Parse records
-            records = json.loads(item.get('records', '[]'))
-            
-            for record in records:
+            # Records were decoded by the reader threads
+            for record in item['records']:
                 timestamp = record.get('timestamp', 0)
                 io_data = record.get('io', {})
                 gps_data = record.get('gps', {})
                 
                 # Get ignition status
                 ignition = io_data.get('ignition', {}).get('value', 0)
-                speed = gps_data.get('speed_kmh', 0)
                 
                 # Get odometer values
                 trip_odometer = io_data.get('trip_odometer', {}).get('value', 0)
@@ -264,9 +211,6 @@ def get_trips(imei):
                         'start_time': int(timestamp),
                         'start_odometer': int(trip_odometer) if trip_odometer else 0,
                         'start_total_odometer': int(total_odometer) if total_odometer else 0,
-                        'max_speed': float(speed) if speed else 0,
-                        'speed_sum': 0,
-                        'speed_count': 0,
                         'records': [],
                         'vin': str(vin) if vin else 'Unknown',
                         'vehicle_make': vehicle_info.get('make', 'Unknown'),
@@ -280,34 +224,22 @@ def get_trips(imei):
                     current_trip['end_time'] = int(timestamp)
                     current_trip['end_odometer'] = int(trip_odometer) if trip_odometer else 0
                     current_trip['end_total_odometer'] = int(total_odometer) if total_odometer else 0
-                    
-                    # Update max speed
-                    if speed and speed > current_trip['max_speed']:
-                        current_trip['max_speed'] = float(speed)
-                    
-                    # Sum speeds for average (only when moving)
-                    if speed and speed > 1:
-                        current_trip['speed_sum'] += float(speed)
-                        current_trip['speed_count'] += 1
                 
                 # Trip end: ignition off
                 if ignition == 0 and current_trip is not None:
                     # Calculate duration
                     duration_ms = current_trip['end_time'] - current_trip['start_time']
                     
+                    # Distance and speeds in one pass over the trip's records
+                    stats = calculate_trip_stats(current_trip['records'])
+                    
                     # Calculate distance (prefer odometer, fallback to GPS)
-                    total_distance = 0
                     if current_trip['end_odometer'] > 0 and current_trip['start_odometer'] > 0:
                         # Use odometer
                         total_distance = current_trip['end_odometer'] - current_trip['start_odometer']
                     else:
                         # Use GPS calculation
-                        total_distance = calculate_gps_distance(current_trip['records'])
-                    
-                    # Calculate average speed
-                    avg_speed = 0
-                    if current_trip['speed_count'] > 0:
-                        avg_speed = current_trip['speed_sum'] / current_trip['speed_count']
+                        total_distance = stats['distance_m']
                     
                     # Only add trips with reasonable data
                     if duration_ms > 60000:  # At least 1 minute
@@ -316,8 +248,8 @@ def get_trips(imei):
                             'end_time': current_trip['end_time'],
                             'duration_ms': duration_ms,
                             'total_distance': int(total_distance),  # meters
-                            'max_speed': round(current_trip['max_speed'], 1),  # km/h
-                            'avg_speed': round(avg_speed, 1),  # km/h
+                            'max_speed': round(stats['max_speed'], 1),  # km/h
+                            'avg_speed': round(stats['avg_speed'], 1),  # km/h
                             'start_odometer': current_trip['start_odometer'],
                             'end_odometer': current_trip['end_odometer'],
                             'num_points': len(current_trip['records']),
@@ -336,23 +268,19 @@ def get_trips(imei):
             duration_ms = current_trip['end_time'] - current_trip['start_time']
             
             # Calculate distance
-            total_distance = 0
+            stats = calculate_trip_stats(current_trip['records'])
             if current_trip['end_odometer'] > 0 and current_trip['start_odometer'] > 0:
                 total_distance = current_trip['end_odometer'] - current_trip['start_odometer']
             else:
-                total_distance = calculate_gps_distance(current_trip['records'])
-            
-            avg_speed = 0
-            if current_trip['speed_count'] > 0:
-                avg_speed = current_trip['speed_sum'] / current_trip['speed_count']
+                total_distance = stats['distance_m']
             
             trips.append({
                 'start_time': current_trip['start_time'],
                 'end_time': current_trip['end_time'],
                 'duration_ms': duration_ms,
                 'total_distance': int(total_distance),
-                'max_speed': round(current_trip['max_speed'], 1),
-                'avg_speed': round(avg_speed, 1),
+                'max_speed': round(stats['max_speed'], 1),
+                'avg_speed': round(stats['avg_speed'], 1),
                 'start_odometer': current_trip['start_odometer'],
                 'end_odometer': current_trip['end_odometer'],
                 'num_points': len(current_trip['records']),
@@ -5,62 +5,553 @@ Database: Timescale Cloud (replacing DynamoDB)
 DEPLOYMENT: Railway-ready with dashboard serving
 """
 
+import base64
+import functools
+import gzip
+import hashlib
 import json
+import math
 import os
-import psycopg2
-from flask import Flask, jsonify, request, send_from_directory
+import re
+import threading
+from flask import Flask, Response, g, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
-from datetime import datetime, timedelta
-import math
+from datetime import datetime, timedelta, timezone
+import geofence
+import hot_state
+import json_codec
+import metrics
+import telemetry_export
+import telemetry_io
+import telemetry_rollups
+import trip_engine
+import track_simplify
+from db_pool import timescale_pool
+from geofence import Fence, geofence_engine
+from live_stream import telemetry_listener
+from ring_buffer import ring_buffer
+from response_cache import ANY_IMEI, response_cache
+from teltonika_codec import IO_IDS
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is used when brotli isn't installed
+    brotli = None
 
 app = Flask(__name__, static_folder='.')
 CORS(app)
+json_codec.init_app(app)
+# Registered first so its after_request hook sees the final (compressed) body
+metrics.init_app(app)
+
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = {'application/json', 'text/html', 'text/css', 'application/javascript'}
 
-# Timescale Connection Pool
-timescale_conn = None
+# The dashboard HTML isn't versioned, so browsers revalidate it (ETag) after this
+DASHBOARD_MAX_AGE = int(os.environ.get('DASHBOARD_MAX_AGE', 3600))
 
+# /api/export limits per request and per worker; larger pulls go through
+# `python telemetry_export.py`
+EXPORT_MAX_HOURS = int(os.environ.get('EXPORT_MAX_HOURS', 24 * 7))
+EXPORT_MAX_DEVICES = int(os.environ.get('EXPORT_MAX_DEVICES', 100))
+EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT', 2))
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+# Timescale Connection Pool - one connection per request, returned on teardown
 def get_timescale_connection():
-    """Get or create Timescale connection"""
-    global timescale_conn
-    if timescale_conn is None or timescale_conn.closed:
-        timescale_conn = psycopg2.connect(
-            host='pfz4m2fxdm.ubqkw0pnd9.tsdb.cloud.timescale.com',
-            port=38416,
-            database='tsdb',
-            user='tsdbadmin',
-            password='u2c06kpgklnlvq6g',
-            connect_timeout=10
-        )
-    return timescale_conn
+    """Check out a pooled Timescale connection for the current request"""
+    if 'timescale_conn' not in g:
+        with metrics.timed('db_checkout'):
+            g.timescale_conn = timescale_pool.getconn()
+    return g.timescale_conn
+
+@app.after_request
+def compress_response(response):
+    """Compress large text bodies with brotli or gzip, as the client accepts"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding == 'br':
+        response.set_data(brotli.compress(body, quality=5))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(body, compresslevel=6))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.teardown_appcontext
+def release_timescale_connection(exc):
+    """Return the request's connection to the pool"""
+    conn = g.pop('timescale_conn', None)
+    if conn is not None:
+        timescale_pool.putconn(conn)
+
+# New telemetry for a device invalidates its cached responses
+telemetry_listener.add_callback(lambda record: response_cache.invalidate(record['imei']))
+# Every new record is checked against the fences of its grid cell, off the listener thread
+geofence_engine.start(telemetry_listener)
+# Trips are detected in the background; requests only read them
+trip_engine.trip_updater.start()
+
+# Latest responses and the device list, shared by all workers (created by the
+# gunicorn master when running under gunicorn.conf.py)
+hot = hot_state.init()
+
+def announce_record(record):
+    vin = record['vin'] if record['vin'] != 'Unknown' else ''
+    hot.touch(record['imei'], vin, datetime.fromisoformat(record['datetime']))
+
+telemetry_listener.add_callback(announce_record)
+
+def announce_listener(connected):
+    if connected:
+        hot.listener_connected()
+    else:
+        hot.listener_disconnected()
+
+telemetry_listener.add_connection_callback(announce_listener)
+# Recent rows of every device, per worker
+telemetry_listener.add_callback(ring_buffer.on_record)
+
+def live_state_ready():
+    """
+    Whether state fed by notifications (hot state, ring buffers) can be
+    trusted, i.e. this worker's listener is connected. This worker's ring
+    buffers are dropped after each of its reconnects; the shared hot state
+    only when no worker's listener was connected (announce_listener).
+    """
+    telemetry_listener.start()
+    if not telemetry_listener.connected:
+        return False
+    ring_buffer.sync(telemetry_listener.generation)
+    return True
+
+def cached_response(endpoint):
+    """
+    Serve repeat requests (same endpoint, IMEI and query string) from
+    response_cache. Caching only happens while the telemetry listener is
+    connected, since invalidation relies on its notifications; entries from
+    an earlier connection are never matched because the key carries the
+    listener generation.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(imei=None):
+            telemetry_listener.start()
+            if not telemetry_listener.connected:
+                return view(imei)
+            key = (endpoint, imei or ANY_IMEI, tuple(sorted(request.args.items(multi=True))),
+                   telemetry_listener.generation, g.get('validated_at'))
+            body = response_cache.get(key)
+            if body is not None:
+                response = app.response_class(body, mimetype='application/json')
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            # New telemetry may arrive while the view reads; don't store
+            # its result then
+            version = response_cache.version(imei or ANY_IMEI)
+            response = view(imei)
+            if isinstance(response, Response) and response.status_code == 200:
+                response_cache.set(key, imei or ANY_IMEI, response.get_data(), version)
+                response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+# The device that reported most recently; the time bound lets Timescale
+# skip all but the newest chunks
+DEFAULT_IMEI_SQL = """
+    SELECT imei, time FROM telemetry
+    WHERE time > NOW() - INTERVAL '7 days'
+    ORDER BY time DESC
+    LIMIT 1
+"""
+NEWEST_TIME_SQL = "SELECT time FROM telemetry WHERE imei = %s ORDER BY time DESC LIMIT 1"
+
+def get_newest_time(cursor, imei=None):
+    """Time of the newest telemetry row for a device (or any device), or None"""
+    if imei:
+        cursor.execute(NEWEST_TIME_SQL, (imei,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    cursor.execute(DEFAULT_IMEI_SQL)
+    result = cursor.fetchone()
+    return result[1] if result else None
+
+def response_validators(endpoint, imei, query_string, newest):
+    """Weak ETag and Last-Modified for a response derived from the newest row"""
+    validator = '|'.join([endpoint, imei or ANY_IMEI, query_string, newest.isoformat()])
+    etag = hashlib.sha1(validator.encode()).hexdigest()[:20]
+    # Last-Modified has one-second resolution
+    last_modified = newest.replace(microsecond=0)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return etag, last_modified
+
+def trips_updated_at(cursor, imei):
+    """When the background updater last wrote the device's trips"""
+    if not imei:
+        imei = get_default_imei(cursor)
+    return trip_engine.checkpoint_time(cursor, imei) if imei else None
+
+def conditional_response(endpoint, updated_at=None):
+    """
+    ETag / Last-Modified validation derived from the newest telemetry row
+    (or, for views built from derived tables, updated_at(cursor, imei) when
+    that is later). While nothing has changed, a revalidating client gets
+    304 Not Modified without the view running or anything being serialized.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(imei=None):
+            newest = hot.newest(imei) if imei and live_state_ready() else None
+            try:
+                if newest is None or updated_at:
+                    cursor = get_timescale_connection().cursor()
+                    if newest is None:
+                        newest = get_newest_time(cursor, imei)
+                    derived = updated_at(cursor, imei) if updated_at else None
+                    cursor.close()
+                    if newest is None or (derived is not None and derived > newest):
+                        newest = derived
+            except Exception as e:
+                return jsonify({'error': str(e)}), 500
+            if newest is None:
+                return view(imei)
+            # cached_response keys on it, so derived updates aren't masked
+            g.validated_at = newest
+
+            etag, last_modified = response_validators(endpoint, imei, request.query_string.decode(), newest)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (request.if_modified_since is not None
+                                and last_modified <= request.if_modified_since)
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(imei))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
 
-def parse_raw_json(raw_json_str):
-    """Parse the raw_json field from Timescale to extract all 53 IO elements"""
+def get_simplify_params(args=None):
+    """
+    Read the optional tolerance_m / max_points track simplification
+    parameters. Raises ValueError on malformed or out-of-range values.
+    """
+    args = request.args if args is None else args
+    tolerance_m = optional_arg(args, 'tolerance_m', float)
+    max_points = optional_arg(args, 'max_points', int)
+    if tolerance_m is not None and not (math.isfinite(tolerance_m) and tolerance_m >= 0):
+        raise ValueError('tolerance_m must be a number >= 0')
+    if max_points is not None and max_points < 2:
+        raise ValueError('max_points must be >= 2')
+    return tolerance_m, max_points
+
+def optional_arg(args, name, type_):
+    """Typed query argument, or None when missing; raises ValueError when malformed"""
+    if args.get(name) in (None, ''):
+        return None
     try:
-        if isinstance(raw_json_str, str):
-            data = json.loads(raw_json_str)
+        return type_(args[name])
+    except ValueError:
+        raise ValueError(f"{name} must be {'an integer' if type_ is int else 'a number'}")
+
+def get_default_imei(cursor):
+    """IMEI of the device that reported most recently, or None"""
+    cursor.execute(DEFAULT_IMEI_SQL)
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+# Fields selectable with ?fields= on latest, history and fleet/latest:
+# name -> (telemetry column, section). Any other IO element can be asked
+# for by name (dallas_temp_1, io_123, ...) and is read from telemetry_io.
+RECORD_FIELDS = {
+    'latitude': ('latitude', 'gps'),
+    'longitude': ('longitude', 'gps'),
+    'altitude': ('altitude', 'gps'),
+    'angle': ('heading', 'gps'),
+    'satellites': ('satellites', 'gps'),
+    'speed_kmh': ('speed_kmh', 'gps'),
+    'ignition': ('ignition', 'io'),
+    'movement': ('movement', 'io'),
+    'external_voltage': ('external_voltage_mv', 'io'),
+    'battery_voltage': ('internal_voltage_mv', 'io'),
+    'gsm_signal': ('gsm_signal', 'io'),
+    'total_odometer': ('odometer_m', 'io'),
+    'vin': ('vin', None),
+    'io': (None, 'io')  # all IO elements, from telemetry_io
+}
+DEFAULT_FLEET_FIELDS = [f for f in RECORD_FIELDS if f != 'io']
+
+# Core IO elements stored as telemetry columns: name -> (IO id, description)
+CORE_IO = {
+    'ignition': (239, 'Ignition'),
+    'movement': (240, 'Movement'),
+    'external_voltage': (66, 'External Voltage (mV)'),
+    'battery_voltage': (67, 'Battery Voltage (mV)'),
+    'gsm_signal': (21, 'GSM Signal Strength'),
+    'total_odometer': (16, 'Total Odometer (m)')
+}
+
+def parse_fields(value):
+    """
+    Split a ?fields= list into telemetry columns and IO elements.
+    Returns (column_fields, io_ids): io_ids is None for every IO element
+    ('io'), a set of IO ids for named elements, or an empty set for none.
+    Raises ValueError on unknown names.
+    """
+    column_fields = []
+    io_ids = set()
+    unknown = []
+    for field in value.split(','):
+        if field == 'io':
+            io_ids = None
+        elif field in RECORD_FIELDS:
+            column_fields.append(field)
+        elif field in IO_IDS:
+            if io_ids is not None:
+                io_ids.add(IO_IDS[field])
+        elif re.fullmatch(r'io_\d+', field):
+            if io_ids is not None:
+                io_ids.add(int(field[3:]))
+        else:
+            unknown.append(field)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return column_fields, io_ids
+
+def build_record(time, fields, values, io_elements=None):
+    """Build a record from projected columns and (optionally) decoded IO elements"""
+    record = {'timestamp': int(time.timestamp() * 1000), 'datetime': time.isoformat()}
+    gps = {}
+    io = {}
+    for field, value in zip(fields, values):
+        if field == 'vin':
+            record['vin'] = value if value else 'Unknown'
+        elif field in CORE_IO:
+            io_id, description = CORE_IO[field]
+            if field in ('ignition', 'movement'):
+                value = 1 if value else 0
+            io[field] = {'id': io_id, 'value': value, 'description': description}
+        elif field in ('latitude', 'longitude', 'speed_kmh'):
+            gps[field] = float(value) if value else 0
         else:
-            data = raw_json_str
-        
-        io_elements = data.get('io', {})
-        return io_elements
-    except:
-        return {}
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """Calculate distance between two GPS points in meters"""
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    r = 6371000  # Earth radius in meters
-    return c * r
+            gps[field] = int(value) if value else 0
+    # Core IO columns win over the decoded copies
+    for io_name, io_data in (io_elements or {}).items():
+        io.setdefault(io_name, io_data)
+    if gps:
+        record['gps'] = gps
+    if io:
+        record['io'] = io
+    return record
+
+# Queries and row builders shared with the async server (asgi_server.py)
+DEVICES_SQL = """
+    SELECT DISTINCT imei, vin,
+           MAX(time) as last_seen
+    FROM telemetry
+    WHERE time > NOW() - INTERVAL '7 days'
+    GROUP BY imei, vin
+    ORDER BY last_seen DESC
+"""
+
+LATEST_SQL = """
+    SELECT
+        time, imei, latitude, longitude, altitude, speed_kmh, heading,
+        satellites, external_voltage_mv, internal_voltage_mv, ignition,
+        movement, gsm_signal, odometer_m, vin
+    FROM telemetry
+    WHERE imei = %s
+    ORDER BY time DESC
+    LIMIT 1
+"""
+
+HISTORY_SQL = """
+    SELECT
+        time, latitude, longitude, altitude, speed_kmh, heading,
+        satellites, external_voltage_mv, internal_voltage_mv, ignition,
+        movement, gsm_signal, odometer_m, vin
+    FROM telemetry
+    WHERE imei = %s AND time >= %s
+    ORDER BY time DESC
+    LIMIT %s
+"""
+
+# Ring buffer columns in LATEST_SQL / HISTORY_SQL order (after time)
+HISTORY_COLUMNS = (
+    'latitude', 'longitude', 'altitude', 'speed_kmh', 'heading',
+    'satellites', 'external_voltage_mv', 'internal_voltage_mv', 'ignition',
+    'movement', 'gsm_signal', 'odometer_m', 'vin'
+)
+LATEST_COLUMNS = ('imei',) + HISTORY_COLUMNS
+
+def device_entry(row):
+    return {
+        'imei': row[0],
+        'vin': row[1] if row[1] else 'Unknown',
+        'last_seen': row[2].isoformat() if row[2] else None
+    }
+
+def projected_latest_sql(fields):
+    columns = ''.join(f', {RECORD_FIELDS[f][0]}' for f in fields)
+    return f"""
+        SELECT time{columns}
+        FROM telemetry
+        WHERE imei = %s
+        ORDER BY time DESC
+        LIMIT 1
+    """
+
+def projected_latest_result(imei, row, fields, io_elements):
+    data = build_record(row[0], fields, row[1:], io_elements)
+    result = {'imei': imei, 'timestamp': data['timestamp']}
+    if 'vin' in data:
+        result['vin'] = data.pop('vin')
+    result['data'] = data
+    return result
+
+def latest_result(row, io_elements):
+    """The full /api/latest shape from a LATEST_SQL row and all its IO elements"""
+    # Build comprehensive response with ALL 53 IO elements
+    result = {
+        'imei': row[1],
+        'timestamp': int(row[0].timestamp() * 1000),
+        'vin': row[14] if row[14] else 'Unknown',
+        'data': {
+            'timestamp': int(row[0].timestamp() * 1000),
+            'datetime': row[0].isoformat(),
+            'priority': 0,
+            'gps': {
+                'latitude': float(row[2]) if row[2] else 0,
+                'longitude': float(row[3]) if row[3] else 0,
+                'altitude': int(row[4]) if row[4] else 0,
+                'angle': int(row[6]) if row[6] else 0,
+                'satellites': int(row[7]) if row[7] else 0,
+                'speed_kmh': float(row[5]) if row[5] else 0,
+                'valid': (row[7] or 0) > 0
+            },
+            'io': {
+                # Core metrics from main table
+                'ignition': {'id': 239, 'value': 1 if row[10] else 0, 'description': 'Ignition'},
+                'movement': {'id': 240, 'value': 1 if row[11] else 0, 'description': 'Movement'},
+                'external_voltage': {'id': 66, 'value': row[8], 'description': 'External Voltage (mV)'},
+                'battery_voltage': {'id': 67, 'value': row[9], 'description': 'Battery Voltage (mV)'},
+                'gsm_signal': {'id': 21, 'value': row[12], 'description': 'GSM Signal Strength'},
+                'total_odometer': {'id': 16, 'value': row[13], 'description': 'Total Odometer (m)'},
+            }
+        }
+    }
+
+    # Add ALL additional IO elements
+    for io_name, io_data in io_elements.items():
+        if io_name not in result['data']['io']:
+            result['data']['io'][io_name] = io_data
+    return result
+
+def fleet_sql(fields):
+    # DISTINCT ON (imei) over the (imei, time DESC) index: Timescale
+    # answers this with a skip scan, one index probe per device
+    columns = ''.join(f', {RECORD_FIELDS[f][0]}' for f in fields)
+    return f"""
+        SELECT DISTINCT ON (imei) imei, time{columns}
+        FROM telemetry
+        WHERE time > NOW() - %s * INTERVAL '1 hour'
+        ORDER BY imei, time DESC
+    """
+
+def projected_history_columns(fields, simplify):
+    columns = [RECORD_FIELDS[f][0] for f in fields]
+    if simplify:
+        columns += ['latitude', 'longitude', 'speed_kmh']
+    return columns
+
+def projected_history_sql(fields, simplify):
+    columns = ['time'] + projected_history_columns(fields, simplify)
+    return f"""
+        SELECT {', '.join(columns)}
+        FROM telemetry
+        WHERE imei = %s AND time >= %s
+        ORDER BY time DESC
+        LIMIT %s
+    """
+
+def recent_latest(cursor, imei, columns):
+    """The device's newest row as (time, *columns) from its ring buffer, or None"""
+    ring_buffer.seed(cursor, imei)
+    return ring_buffer.latest(imei, columns)
+
+def recent_rows(cursor, imei, columns, start_time, limit):
+    """History rows as (time, *columns) from the ring buffer, or None beyond its horizon"""
+    ring_buffer.seed(cursor, imei)
+    return ring_buffer.rows(imei, columns, start_time, limit)
+
+def latest_io(cursor, imei, time, io_ids=None):
+    """IO elements of a device's newest row, kept in its ring buffer once fetched"""
+    io_elements = ring_buffer.io_snapshot(imei, time)
+    if io_elements is None:
+        io_elements = telemetry_io.fetch_io(cursor, [(imei, time)]).get((imei, time), {})
+        ring_buffer.set_io(imei, time, io_elements)
+    if io_ids is not None:
+        io_elements = {name: element for name, element in io_elements.items() if element.get('id') in io_ids}
+    return io_elements
+
+def simplify_rows(rows, lat_index, lon_index, speed_index, tolerance_m, max_points):
+    """Thin a track before any IO elements are fetched"""
+    keep = track_simplify.simplify_indices(
+        [row[lat_index] for row in rows], [row[lon_index] for row in rows],
+        [row[speed_index] for row in rows], tolerance_m, max_points
+    )
+    return [rows[i] for i in keep]
+
+def history_record(row, io_elements):
+    """A /api/history record from a HISTORY_SQL row"""
+    return {
+        'timestamp': int(row[0].timestamp() * 1000),
+        'datetime': row[0].isoformat(),
+        'gps': {
+            'latitude': float(row[1]) if row[1] else 0,
+            'longitude': float(row[2]) if row[2] else 0,
+            'altitude': int(row[3]) if row[3] else 0,
+            'angle': int(row[5]) if row[5] else 0,
+            'satellites': int(row[6]) if row[6] else 0,
+            'speed_kmh': float(row[4]) if row[4] else 0
+        },
+        'io': {
+            'ignition': {'value': 1 if row[9] else 0},
+            'movement': {'value': 1 if row[10] else 0},
+            'external_voltage': {'value': row[7]},
+            'battery_voltage': {'value': row[8]},
+            'gsm_signal': {'value': row[11]},
+            'total_odometer': {'value': row[12]},
+            **io_elements  # Include all other IO elements
+        }
+    }
 
 # ROOT ROUTE - Serve the dashboard HTML
 @app.route('/')
 def serve_dashboard():
     """Serve the dashboard HTML at root route for Railway deployment"""
-    return send_from_directory('.', 'dashboard_ENHANCED.html')
+    response = send_from_directory('.', 'dashboard_ENHANCED.html', max_age=DASHBOARD_MAX_AGE)
+    # Read the file into the body so compress_response can encode it
+    response.direct_passthrough = False
+    response.cache_control.public = True
+    return response
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -76,37 +567,50 @@ def health_check():
             'timestamp': datetime.utcnow().isoformat(),
             'database': 'Timescale Cloud',
             'table': 'telemetry',
-            'deployment': 'Railway'
+            'deployment': 'Railway',
+            'pool': timescale_pool.stats(),
+            'stream': telemetry_listener.stats(),
+            'cache': response_cache.stats(),
+            'geofences': geofence_engine.stats(),
+            'hot_state': hot.stats(),
+            'ring_buffer': ring_buffer.stats(),
+            'trips': trip_engine.trip_updater.stats(),
+            'io_fallback': telemetry_io.fallback_stats()
         })
     except Exception as e:
         return jsonify({
             'status': 'error',
-            'error': str(e)
+            'error': str(e),
+            'pool': timescale_pool.stats(),
+            'stream': telemetry_listener.stats(),
+            'cache': response_cache.stats(),
+            'geofences': geofence_engine.stats(),
+            'hot_state': hot.stats(),
+            'ring_buffer': ring_buffer.stats(),
+            'trips': trip_engine.trip_updater.stats(),
+            'io_fallback': telemetry_io.fallback_stats()
         }), 500
 
 @app.route('/api/devices', methods=['GET'])
 def list_devices():
     """List all active devices"""
     try:
+        ready = live_state_ready()
+        rows = hot.devices(datetime.now(timezone.utc) - timedelta(days=7)) if ready else None
+        if rows is not None:
+            return jsonify({
+                'count': len(rows),
+                'devices': [device_entry(row) for row in rows]
+            })
+        
         conn = get_timescale_connection()
         cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT DISTINCT imei, vin, 
-                   MAX(time) as last_seen
-            FROM telemetry
-            WHERE time > NOW() - INTERVAL '7 days'
-            GROUP BY imei, vin
-            ORDER BY last_seen DESC
-        """)
-        
-        devices = []
-        for row in cursor.fetchall():
-            devices.append({
-                'imei': row[0],
-                'vin': row[1] if row[1] else 'Unknown',
-                'last_seen': row[2].isoformat() if row[2] else None
-            })
+        cursor.execute(DEVICES_SQL)
+        rows = cursor.fetchall()
+        if ready:
+            hot.seed_devices(rows)
+        devices = [device_entry(row) for row in rows]
         
         cursor.close()
         return jsonify({
@@ -119,143 +623,182 @@ def list_devices():
 
 @app.route('/api/latest', methods=['GET'])
 @app.route('/api/latest/<imei>', methods=['GET'])
+@conditional_response('latest')
 def get_latest_data(imei=None):
     """Get the most recent telemetry data for a device (or all devices)"""
     try:
+        fields = request.args.get('fields') or None
+        if fields:
+            try:
+                fields, io_ids = parse_fields(fields)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
         conn = get_timescale_connection()
         cursor = conn.cursor()
         
         # If no IMEI provided, get the most recent from any device
         if not imei:
-            cursor.execute("""
-                SELECT imei FROM telemetry
-                ORDER BY time DESC
-                LIMIT 1
-            """)
-            result = cursor.fetchone()
-            if not result:
+            imei = get_default_imei(cursor)
+            if not imei:
                 return jsonify({'error': 'No data found'}), 404
-            imei = result[0]
         
-        # Get latest record for this IMEI
-        cursor.execute("""
-            SELECT 
-                time, imei, latitude, longitude, altitude, speed_kmh, heading,
-                satellites, external_voltage_mv, internal_voltage_mv, ignition,
-                movement, gsm_signal, odometer_m, vin, raw_json
-            FROM telemetry
-            WHERE imei = %s
-            ORDER BY time DESC
-            LIMIT 1
-        """, (imei,))
+        ready = live_state_ready()
+        
+        # ?fields= reads only the requested columns and IO elements
+        if fields is not None:
+            row = recent_latest(cursor, imei, [RECORD_FIELDS[f][0] for f in fields]) if ready else None
+            if row is None:
+                cursor.execute(projected_latest_sql(fields), (imei,))
+                row = cursor.fetchone()
+            if not row:
+                cursor.close()
+                return jsonify({'error': 'No data found for this IMEI'}), 404
+            io_elements = None
+            if io_ids is None or io_ids:
+                if ready:
+                    io_elements = latest_io(cursor, imei, row[0], io_ids)
+                else:
+                    io_elements = telemetry_io.fetch_io(cursor, [(imei, row[0])], io_ids).get((imei, row[0]), {})
+            cursor.close()
+            return jsonify(projected_latest_result(imei, row, fields, io_elements))
         
-        row = cursor.fetchone()
+        row = None
+        if ready:
+            # Another worker may already have built this response
+            body, _ = hot.get_latest(imei)
+            if body is not None:
+                cursor.close()
+                return app.response_class(body, mimetype='application/json')
+            row = recent_latest(cursor, imei, LATEST_COLUMNS)
+        
+        # Get latest record for this IMEI
+        if row is None:
+            cursor.execute(LATEST_SQL, (imei,))
+            row = cursor.fetchone()
         if not row:
             cursor.close()
             return jsonify({'error': 'No data found for this IMEI'}), 404
         
-        # Parse all IO elements from raw_json
-        io_elements = parse_raw_json(row[15])
+        # All IO elements, decoded at ingest (telemetry_io)
+        if ready:
+            io_elements = latest_io(cursor, row[1], row[0])
+        else:
+            io_elements = telemetry_io.fetch_io(cursor, [(row[1], row[0])]).get((row[1], row[0]), {})
         
-        # Build comprehensive response with ALL 53 IO elements
-        result = {
-            'imei': row[1],
-            'timestamp': int(row[0].timestamp() * 1000),
-            'vin': row[14] if row[14] else 'Unknown',
-            'data': {
-                'timestamp': int(row[0].timestamp() * 1000),
-                'datetime': row[0].isoformat(),
-                'priority': 0,
-                'gps': {
-                    'latitude': float(row[2]) if row[2] else 0,
-                    'longitude': float(row[3]) if row[3] else 0,
-                    'altitude': int(row[4]) if row[4] else 0,
-                    'angle': int(row[6]) if row[6] else 0,
-                    'satellites': int(row[7]) if row[7] else 0,
-                    'speed_kmh': float(row[5]) if row[5] else 0,
-                    'valid': (row[7] or 0) > 0
-                },
-                'io': {
-                    # Core metrics from main table
-                    'ignition': {'id': 239, 'value': 1 if row[10] else 0, 'description': 'Ignition'},
-                    'movement': {'id': 240, 'value': 1 if row[11] else 0, 'description': 'Movement'},
-                    'external_voltage': {'id': 66, 'value': row[8], 'description': 'External Voltage (mV)'},
-                    'battery_voltage': {'id': 67, 'value': row[9], 'description': 'Battery Voltage (mV)'},
-                    'gsm_signal': {'id': 21, 'value': row[12], 'description': 'GSM Signal Strength'},
-                    'total_odometer': {'id': 16, 'value': row[13], 'description': 'Total Odometer (m)'},
-                }
-            }
-        }
+        cursor.close()
+        response = jsonify(latest_result(row, io_elements))
+        if ready:
+            hot.set_latest(imei, row[14], row[0], response.get_data())
+        return response
         
-        # Add ALL additional IO elements from raw_json
-        for io_name, io_data in io_elements.items():
-            if io_name not in result['data']['io']:
-                result['data']['io'][io_name] = io_data
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/fleet/latest', methods=['GET'])
+def get_fleet_latest():
+    """Get the latest record of every active device in one query"""
+    try:
+        active_hours = int(request.args.get('active_hours', 168))
+        fields = request.args.get('fields')
+        if fields:
+            try:
+                fields, io_ids = parse_fields(fields)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            fields, io_ids = DEFAULT_FLEET_FIELDS, set()
         
+        conn = get_timescale_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute(fleet_sql(fields), (active_hours,))
+        rows = cursor.fetchall()
+        
+        io_map = {}
+        if io_ids is None or io_ids:
+            io_map = telemetry_io.fetch_io(cursor, [(row[0], row[1]) for row in rows], io_ids)
+        devices = [{'imei': row[0], **build_record(row[1], fields, row[2:], io_map.get((row[0], row[1])))}
+                   for row in rows]
         cursor.close()
-        return jsonify(result)
+        return jsonify({
+            'count': len(devices),
+            'devices': devices
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/history', methods=['GET'])
 @app.route('/api/history/<imei>', methods=['GET'])
+@conditional_response('history')
 def get_history(imei=None):
     """Get historical telemetry data"""
     try:
         hours = int(request.args.get('hours', 24))
         limit = int(request.args.get('limit', 1000))
+        try:
+            tolerance_m, max_points = get_simplify_params()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        simplify = tolerance_m is not None or max_points is not None
+        fields = request.args.get('fields') or None
+        if fields:
+            try:
+                fields, io_ids = parse_fields(fields)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
         
         conn = get_timescale_connection()
         cursor = conn.cursor()
         
         # If no IMEI, get most recent device
         if not imei:
-            cursor.execute("SELECT imei FROM telemetry ORDER BY time DESC LIMIT 1")
-            result = cursor.fetchone()
-            if not result:
+            imei = get_default_imei(cursor)
+            if not imei:
                 return jsonify({'error': 'No data found'}), 404
-            imei = result[0]
         
         start_time = datetime.utcnow() - timedelta(hours=hours)
+        # Recent windows come from the ring buffer when it reaches back far enough
+        ready = live_state_ready()
         
-        cursor.execute("""
-            SELECT 
-                time, latitude, longitude, altitude, speed_kmh, heading,
-                satellites, external_voltage_mv, internal_voltage_mv, ignition,
-                movement, gsm_signal, odometer_m, vin, raw_json
-            FROM telemetry
-            WHERE imei = %s AND time >= %s
-            ORDER BY time DESC
-            LIMIT %s
-        """, (imei, start_time, limit))
-        
-        records = []
-        for row in cursor.fetchall():
-            io_elements = parse_raw_json(row[14])
+        # ?fields= reads only the requested columns and IO elements
+        if fields is not None:
+            columns = projected_history_columns(fields, simplify)
+            rows = recent_rows(cursor, imei, columns, start_time, limit) if ready else None
+            if rows is None:
+                cursor.execute(projected_history_sql(fields, simplify), (imei, start_time, limit))
+                rows = cursor.fetchall()
             
-            records.append({
-                'timestamp': int(row[0].timestamp() * 1000),
-                'datetime': row[0].isoformat(),
-                'gps': {
-                    'latitude': float(row[1]) if row[1] else 0,
-                    'longitude': float(row[2]) if row[2] else 0,
-                    'altitude': int(row[3]) if row[3] else 0,
-                    'angle': int(row[5]) if row[5] else 0,
-                    'satellites': int(row[6]) if row[6] else 0,
-                    'speed_kmh': float(row[4]) if row[4] else 0
-                },
-                'io': {
-                    'ignition': {'value': 1 if row[9] else 0},
-                    'movement': {'value': 1 if row[10] else 0},
-                    'external_voltage': {'value': row[7]},
-                    'battery_voltage': {'value': row[8]},
-                    'gsm_signal': {'value': row[11]},
-                    'total_odometer': {'value': row[12]},
-                    **io_elements  # Include all other IO elements
-                }
+            if simplify:
+                rows = simplify_rows(rows, -3, -2, -1, tolerance_m, max_points)
+            
+            io_map = {}
+            if io_ids is None or io_ids:
+                io_map = telemetry_io.fetch_io(cursor, [(imei, row[0]) for row in rows], io_ids)
+            cursor.close()
+            
+            records = [build_record(row[0], fields, row[1:len(fields) + 1], io_map.get((imei, row[0])))
+                       for row in rows]
+            return jsonify({
+                'imei': imei,
+                'count': len(records),
+                'records': records
             })
         
+        rows = recent_rows(cursor, imei, HISTORY_COLUMNS, start_time, limit) if ready else None
+        if rows is None:
+            cursor.execute(HISTORY_SQL, (imei, start_time, limit))
+            rows = cursor.fetchall()
+        
+        # Thin the track before any IO elements are fetched
+        if simplify:
+            rows = simplify_rows(rows, 1, 2, 4, tolerance_m, max_points)
+        
+        io_map = telemetry_io.fetch_io(cursor, [(imei, row[0]) for row in rows])
+        
+        records = [history_record(row, io_map.get((imei, row[0]), {})) for row in rows]
+        
         cursor.close()
         return jsonify({
             'imei': imei,
@@ -266,179 +809,501 @@ def get_history(imei=None):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Rows per round trip from the server-side cursor of the NDJSON stream
+STREAM_FETCH_SIZE = 2000
+
+# SSE and NDJSON streams each hold a worker thread for as long as they're
+# open; keep some threads for everything else (gunicorn.conf.py sets
+# threads // 2)
+STREAM_MAX_CONCURRENT = int(os.environ.get('STREAM_MAX_CONCURRENT', 4))
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONCURRENT)
+
+def stream_slot(view):
+    """Answer 503 when every stream slot of this worker is taken; the slot is freed when the response closes"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not stream_slots.acquire(blocking=False):
+            response = jsonify({'error': 'Too many open streams, try again later'})
+            response.status_code = 503
+            response.headers['Retry-After'] = '30'
+            return response
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            stream_slots.release()
+            raise
+        response.call_on_close(stream_slots.release)
+        return response
+    return wrapper
+
+def parse_stream_request(args, imei=None):
+    """
+    Build the NDJSON history query from request arguments.
+    Returns (query, params, fields, io_ids, limit); raises ValueError.
+    """
+    fields = args.get('fields')
+    if fields:
+        fields, io_ids = parse_fields(fields)
+    else:
+        fields, io_ids = DEFAULT_FLEET_FIELDS, None
+    end_time = args.get('end')
+    end_time = datetime.fromisoformat(end_time) if end_time else datetime.now(timezone.utc)
+    start_time = args.get('start')
+    if start_time:
+        start_time = datetime.fromisoformat(start_time)
+    else:
+        start_time = end_time - timedelta(hours=int(args.get('hours', 24)))
+    limit = int(args['limit']) if args.get('limit') else None
+    cursor_token = args.get('cursor')
+    after = None
+    if cursor_token:
+        after_time, after_imei = decode_cursor(cursor_token).split('|', 1)
+        after = (datetime.fromisoformat(after_time), after_imei)
+    
+    conditions = ['time >= %s', 'time < %s']
+    params = [start_time, end_time]
+    if imei:
+        conditions.append('imei = %s')
+        params.append(imei)
+    if after:
+        conditions.append('(time, imei) > (%s, %s)')
+        params.extend(after)
+    limit_sql = ''
+    if limit is not None:
+        # One extra row tells whether another page follows
+        limit_sql = 'LIMIT %s'
+        params.append(limit + 1)
+    columns = ''.join(f', {RECORD_FIELDS[f][0]}' for f in fields)
+    query = f"""
+        SELECT time, imei{columns}
+        FROM telemetry
+        WHERE {' AND '.join(conditions)}
+        ORDER BY time, imei
+        {limit_sql}
+    """
+    return query, params, fields, io_ids, limit
+
+def stream_records(rows, fields, io_map):
+    return [{'imei': row[1], **build_record(row[0], fields, row[2:], io_map.get((row[1], row[0])))}
+            for row in rows]
+
+@app.route('/api/history/stream', methods=['GET'])
+@app.route('/api/history/stream/<imei>', methods=['GET'])
+@stream_slot
+def stream_history(imei=None):
+    """
+    Stream telemetry as NDJSON, one record per line, oldest first (all
+    devices when no IMEI is given). Rows come from a server-side cursor, so
+    memory stays flat for any window. With ?limit= the last line carries a
+    next_cursor token that resumes after the last (time, imei) sent.
+    """
+    try:
+        query, params, fields, io_ids, limit = parse_stream_request(request.args, imei)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_timescale_connection()
+    
+    def generate():
+        cursor = conn.cursor(name='history_stream')
+        io_cursor = conn.cursor()
+        sent = 0
+        last = None
+        more = False
+        try:
+            cursor.execute(query, params)
+            while not more:
+                rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+                if not rows:
+                    break
+                if limit is not None and sent + len(rows) > limit:
+                    rows = rows[:limit - sent]
+                    more = True
+                io_map = {}
+                if io_ids is None or io_ids:
+                    io_map = telemetry_io.fetch_io(io_cursor, [(row[1], row[0]) for row in rows], io_ids)
+                records = stream_records(rows, fields, io_map)
+                sent += len(rows)
+                if rows:
+                    last = rows[-1]
+                    yield from json_codec.iter_lines(records)
+            next_cursor = encode_cursor(f"{last[0].isoformat()}|{last[1]}") if more else None
+            yield json_codec.dumps({'count': sent, 'next_cursor': next_cursor}) + b'\n'
+        except Exception as e:
+            # Headers are already sent; report the failure in-band
+            yield json_codec.dumps({'error': str(e), 'count': sent}) + b'\n'
+        finally:
+            cursor.close()
+            io_cursor.close()
+            conn.rollback()
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/export', methods=['GET'])
+def export_telemetry():
+    """
+    Bulk export of a time range as CSV, Arrow IPC or Parquet
+    (?format=csv|arrow|parquet&start=&end=&imei=a,b&io=name,io_123)
+    """
+    try:
+        fmt = request.args.get('format', 'csv')
+        telemetry_export.check_format(fmt)
+        end_time = request.args.get('end')
+        end_time = telemetry_export.parse_time(end_time) if end_time else datetime.now(timezone.utc)
+        start_time = request.args.get('start')
+        start_time = telemetry_export.parse_time(start_time) if start_time else end_time - timedelta(hours=24)
+        if start_time >= end_time:
+            raise ValueError('start must be before end')
+        if end_time - start_time > timedelta(hours=EXPORT_MAX_HOURS):
+            raise ValueError(f'Exports cover at most {EXPORT_MAX_HOURS} hours; '
+                             'use telemetry_export.py for longer ranges')
+        imeis = request.args.get('imei')
+        imeis = imeis.split(',') if imeis else None
+        if imeis and len(imeis) > EXPORT_MAX_DEVICES:
+            raise ValueError(f'Exports cover at most {EXPORT_MAX_DEVICES} devices; '
+                             'use telemetry_export.py for more')
+        io_ids = None
+        if request.args.get('io'):
+            _, io_ids = parse_fields(request.args['io'])
+            if io_ids is not None and not io_ids:
+                raise ValueError('io= takes IO element names')
+    except (ValueError, telemetry_export.ExportError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Exports hold a connection for as long as the client reads; keep them
+    # to a few per worker so they can't take the pool from the dashboard
+    if not export_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many exports running, try again later'}), 503
+    try:
+        conn = timescale_pool.getconn()
+    except Exception as e:
+        export_slots.release()
+        return jsonify({'error': str(e)}), 500
+    released = []
+    
+    def release():
+        if not released:
+            released.append(True)
+            timescale_pool.putconn(conn)
+            export_slots.release()
+    
+    try:
+        chunks = telemetry_export.export(conn, fmt, start_time, end_time, imeis, io_ids)
+    except Exception as e:
+        release()
+        return jsonify({'error': str(e)}), 500
+    
+    mimetype, extension = telemetry_export.FORMATS[fmt]
+    filename = f"telemetry_{start_time:%Y%m%dT%H%M}_{end_time:%Y%m%dT%H%M}.{extension}"
+    response = Response(chunks, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    })
+    # Runs when the server closes the response: finished, failed or the
+    # client went away, even before the first chunk was sent
+    response.call_on_close(release)
+    return response
+
 @app.route('/api/trips', methods=['GET'])
 @app.route('/api/trips/<imei>', methods=['GET'])
+@conditional_response('trips', updated_at=trips_updated_at)
+@cached_response('trips')
 def get_trips(imei=None):
     """Get trip history for a device"""
     try:
         hours = int(request.args.get('hours', 168))  # Default 7 days
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else None
+        unknown = [f for f in fields or () if f not in trip_engine.SUMMARY_FIELDS]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
         
         conn = get_timescale_connection()
         cursor = conn.cursor()
         
         # If no IMEI, get most recent device
         if not imei:
-            cursor.execute("SELECT imei FROM telemetry ORDER BY time DESC LIMIT 1")
-            result = cursor.fetchone()
-            if not result:
+            imei = get_default_imei(cursor)
+            if not imei:
                 return jsonify({'error': 'No data found'}), 404
-            imei = result[0]
         
         start_time = datetime.utcnow() - timedelta(hours=hours)
         
-        # Get all records for trip detection
+        # Summaries from the trips table, kept up to date by trip_updater.
+        # Track points are served separately by get_trip_points.
+        trips = trip_engine.fetch_trips(cursor, imei, start_time, fields)
+        
+        cursor.close()
+        return jsonify({
+            'imei': imei,
+            'count': len(trips),
+            'trips': trips
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Point fields selectable with ?fields= on the trip points endpoint
+TRIP_POINT_FIELDS = {
+    'latitude': 'latitude',
+    'longitude': 'longitude',
+    'altitude': 'altitude',
+    'speed_kmh': 'speed_kmh',
+    'angle': 'heading',
+    'satellites': 'satellites',
+    'io': None  # all IO elements, from telemetry_io
+}
+DEFAULT_TRIP_POINT_FIELDS = ['latitude', 'longitude', 'speed_kmh']
+
+def encode_cursor(value):
+    """Encode a pagination position as an opaque token"""
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Decode a token produced by encode_cursor"""
+    return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+
+@app.route('/api/trips/<imei>/<int:trip_id>/points', methods=['GET'])
+def get_trip_points(imei, trip_id):
+    """Get the track points of one trip, a page at a time"""
+    try:
+        limit = min(int(request.args.get('limit', 500)), 5000)
+        try:
+            tolerance_m, max_points = get_simplify_params()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        simplify = tolerance_m is not None or max_points is not None
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else DEFAULT_TRIP_POINT_FIELDS
+        unknown = [f for f in fields if f not in TRIP_POINT_FIELDS]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+        include_io = 'io' in fields
+        fields = [f for f in fields if f != 'io']
+        
+        conn = get_timescale_connection()
+        cursor = conn.cursor()
+        
         cursor.execute("""
-            SELECT 
-                time, latitude, longitude, speed_kmh, ignition, odometer_m, vin, raw_json
+            SELECT start_time, end_time, ongoing FROM trips
+            WHERE id = %s AND imei = %s
+        """, (trip_id, imei))
+        trip = cursor.fetchone()
+        if not trip:
+            cursor.close()
+            return jsonify({'error': 'Trip not found'}), 404
+        start_time, end_time, ongoing = trip
+        
+        # Resume after the last point of the previous page
+        cursor_token = request.args.get('cursor')
+        after = datetime.fromisoformat(decode_cursor(cursor_token)) if cursor_token else None
+        
+        columns = ['time'] + [TRIP_POINT_FIELDS[f] for f in fields]
+        if simplify:
+            columns += ['latitude', 'longitude', 'speed_kmh']
+        conditions = ['imei = %s', 'time >= %s']
+        params = [imei, start_time]
+        if not ongoing:
+            conditions.append('time <= %s')
+            params.append(end_time)
+        if after:
+            conditions.append('time > %s')
+            params.append(after)
+        params.append(limit + 1)
+        
+        cursor.execute(f"""
+            SELECT {', '.join(columns)}
             FROM telemetry
-            WHERE imei = %s AND time >= %s
+            WHERE {' AND '.join(conditions)}
             ORDER BY time ASC
-        """, (imei, start_time))
-        
+            LIMIT %s
+        """, params)
         rows = cursor.fetchall()
         
-        # Trip detection logic
-        trips = []
-        current_trip = None
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][0].isoformat())
+        
+        # Simplification applies within the page; the cursor still
+        # advances over every raw point
+        if simplify:
+            keep = track_simplify.simplify_indices(
+                [row[-3] for row in rows], [row[-2] for row in rows],
+                [row[-1] for row in rows], tolerance_m, max_points
+            )
+            rows = [rows[i] for i in keep]
+        
+        io_map = telemetry_io.fetch_io(cursor, [(imei, row[0]) for row in rows]) if include_io else {}
+        cursor.close()
         
+        points = []
         for row in rows:
-            timestamp = int(row[0].timestamp() * 1000)
-            latitude = float(row[1]) if row[1] else None
-            longitude = float(row[2]) if row[2] else None
-            speed_kmh = float(row[3]) if row[3] else 0
-            ignition = row[4]
-            odometer = row[5]
-            vin = row[6]
-            
-            io_elements = parse_raw_json(row[7])
-            
-            # Trip start: ignition on
-            if ignition and current_trip is None and latitude and longitude:
-                current_trip = {
-                    'start_time': timestamp,
-                    'start_location': {'latitude': latitude, 'longitude': longitude},
-                    'start_datetime': row[0].isoformat(),
-                    'start_odometer': odometer,
-                    'max_speed': speed_kmh,
-                    'speed_sum': 0,
-                    'speed_count': 0,
-                    'points': [],
-                    'vin': vin if vin else 'Unknown'
-                }
-            
-            # Trip ongoing: collect data
-            if current_trip is not None:
-                current_trip['points'].append({
-                    'timestamp': timestamp,
-                    'gps': {
-                        'latitude': latitude,
-                        'longitude': longitude,
-                        'speed_kmh': speed_kmh
-                    },
-                    'io': io_elements
-                })
-                current_trip['end_time'] = timestamp
-                current_trip['end_datetime'] = row[0].isoformat()
-                current_trip['end_location'] = {'latitude': latitude, 'longitude': longitude}
-                current_trip['end_odometer'] = odometer
-                
-                if speed_kmh > current_trip['max_speed']:
-                    current_trip['max_speed'] = speed_kmh
-                
-                if speed_kmh > 1:
-                    current_trip['speed_sum'] += speed_kmh
-                    current_trip['speed_count'] += 1
-            
-            # Trip end: ignition off
-            if not ignition and current_trip is not None:
-                duration_ms = current_trip['end_time'] - current_trip['start_time']
-                
-                # Calculate distance
-                if current_trip['end_odometer'] and current_trip['start_odometer']:
-                    distance = current_trip['end_odometer'] - current_trip['start_odometer']
+            point = {'timestamp': int(row[0].timestamp() * 1000)}
+            gps = {}
+            for field, value in zip(fields, row[1:]):
+                if field in ('latitude', 'longitude'):
+                    gps[field] = float(value) if value else None
+                elif field == 'speed_kmh':
+                    gps[field] = float(value) if value else 0
                 else:
-                    # Calculate from GPS
-                    distance = 0
-                    for i in range(1, len(current_trip['points'])):
-                        prev = current_trip['points'][i-1]
-                        curr = current_trip['points'][i]
-                        if prev['gps']['latitude'] and curr['gps']['latitude']:
-                            distance += haversine_distance(
-                                prev['gps']['latitude'], prev['gps']['longitude'],
-                                curr['gps']['latitude'], curr['gps']['longitude']
-                            )
-                
-                avg_speed = current_trip['speed_sum'] / current_trip['speed_count'] if current_trip['speed_count'] > 0 else 0
-                
-                # Only add trips longer than 1 minute
-                if duration_ms > 60000:
-                    trips.append({
-                        'id': len(trips) + 1,
-                        'start_time': current_trip['start_time'],
-                        'start_datetime': current_trip['start_datetime'],
-                        'start_location': current_trip['start_location'],
-                        'end_time': current_trip['end_time'],
-                        'end_datetime': current_trip['end_datetime'],
-                        'end_location': current_trip['end_location'],
-                        'duration_ms': duration_ms,
-                        'distance': distance / 1000,  # Convert to km
-                        'max_speed': round(current_trip['max_speed'], 1),
-                        'avg_speed': round(avg_speed, 1),
-                        'points': current_trip['points'],
-                        'ongoing': False,
-                        'vin': current_trip['vin']
-                    })
-                
-                current_trip = None
-        
-        # Add ongoing trip if exists
-        if current_trip is not None:
-            duration_ms = current_trip['end_time'] - current_trip['start_time']
-            
-            if current_trip['end_odometer'] and current_trip['start_odometer']:
-                distance = current_trip['end_odometer'] - current_trip['start_odometer']
-            else:
-                distance = 0
-                for i in range(1, len(current_trip['points'])):
-                    prev = current_trip['points'][i-1]
-                    curr = current_trip['points'][i]
-                    if prev['gps']['latitude'] and curr['gps']['latitude']:
-                        distance += haversine_distance(
-                            prev['gps']['latitude'], prev['gps']['longitude'],
-                            curr['gps']['latitude'], curr['gps']['longitude']
-                        )
-            
-            avg_speed = current_trip['speed_sum'] / current_trip['speed_count'] if current_trip['speed_count'] > 0 else 0
-            
-            trips.append({
-                'id': len(trips) + 1,
-                'start_time': current_trip['start_time'],
-                'start_datetime': current_trip['start_datetime'],
-                'start_location': current_trip['start_location'],
-                'end_time': current_trip['end_time'],
-                'end_datetime': current_trip.get('end_datetime', current_trip['start_datetime']),
-                'end_location': current_trip.get('end_location', current_trip['start_location']),
-                'duration_ms': duration_ms,
-                'distance': distance / 1000,
-                'max_speed': round(current_trip['max_speed'], 1),
-                'avg_speed': round(avg_speed, 1),
-                'points': current_trip['points'],
-                'ongoing': True,
-                'vin': current_trip['vin']
-            })
+                    gps[field] = int(value) if value else 0
+            if gps:
+                point['gps'] = gps
+            if include_io:
+                point['io'] = io_map.get((imei, row[0]), {})
+            points.append(point)
         
-        cursor.close()
         return jsonify({
             'imei': imei,
-            'count': len(trips),
-            'trips': trips
+            'trip_id': trip_id,
+            'count': len(points),
+            'points': points,
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stream', methods=['GET'])
+@app.route('/api/stream/<imei>', methods=['GET'])
+@stream_slot
+def stream_telemetry(imei=None):
+    """Server-Sent Events stream of new telemetry for a device (or all devices)"""
+    subscription = telemetry_listener.subscribe(imei)
+    
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                record = subscription.get(timeout=15)
+                if record is None:
+                    # Keep proxies from closing an idle stream
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: telemetry\ndata: {json_codec.dumps(record).decode()}\n\n"
+        finally:
+            telemetry_listener.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def load_geofences(conn):
+    """Make sure the fence index is loaded and the listener is feeding it"""
+    geofence_engine.refresh(conn)
+    telemetry_listener.start()
+
+def parse_fence(body):
+    """Validate a POST /api/geofences body into (name, kind, geometry)"""
+    name = (body.get('name') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    kind = body.get('type')
+    if kind == 'circle':
+        geometry = {'center': body.get('center'), 'radius_m': body.get('radius_m')}
+    elif kind == 'polygon':
+        geometry = {'points': body.get('points')}
+    else:
+        raise ValueError("type must be 'circle' or 'polygon'")
+    try:
+        fence = Fence(None, name, kind, geometry)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid {kind}: {e}")
+    if kind == 'circle':
+        geometry = {'center': list(fence.center), 'radius_m': fence.radius}
+    else:
+        geometry = {'points': [list(point) for point in fence.points]}
+    return name, kind, geometry
+
+@app.route('/api/geofences', methods=['GET'])
+def list_geofences():
+    """All fences"""
+    try:
+        load_geofences(get_timescale_connection())
+        fences = geofence_engine.fences()
+        return jsonify({'count': len(fences), 'geofences': fences})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/geofences', methods=['POST'])
+def create_geofence():
+    """Create a circle {name, type, center: [lat, lon], radius_m} or polygon {name, type, points: [[lat, lon], ...]}"""
+    try:
+        name, kind, geometry = parse_fence(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        conn = get_timescale_connection()
+        load_geofences(conn)
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO geofences (name, kind, geometry) VALUES (%s, %s, %s) RETURNING id",
+            (name, kind, json.dumps(geometry))
+        )
+        fence = Fence(cursor.fetchone()[0], name, kind, geometry)
+        cursor.close()
+        conn.commit()
+        geofence_engine.add_fence(fence)
+        return jsonify(fence.to_dict()), 201
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/geofences/<int:fence_id>', methods=['DELETE'])
+def delete_geofence(fence_id):
+    """Delete a fence with its state and events"""
+    try:
+        conn = get_timescale_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM geofences WHERE id = %s", (fence_id,))
+        deleted = cursor.rowcount
+        cursor.close()
+        conn.commit()
+        geofence_engine.remove_fence(fence_id)
+        if not deleted:
+            return jsonify({'error': 'Geofence not found'}), 404
+        return jsonify({'deleted': fence_id})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/geofences/events', methods=['GET'])
+def get_geofence_events():
+    """Enter/exit events, newest first (?imei=, ?fence_id=, ?hours=, ?limit=)"""
+    try:
+        hours = request.args.get('hours', type=int)
+        fence_id = request.args.get('fence_id', type=int)
+        limit = min(request.args.get('limit', 500, type=int), 5000)
+        start_time = datetime.now(timezone.utc) - timedelta(hours=hours) if hours else None
+        
+        conn = get_timescale_connection()
+        load_geofences(conn)
+        cursor = conn.cursor()
+        events = geofence.fetch_events(cursor, request.args.get('imei'), fence_id, start_time, limit)
+        cursor.close()
+        return jsonify({'count': len(events), 'events': events})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/geofences/inside/<imei>', methods=['GET'])
+def get_geofences_inside(imei):
+    """Fences a device is currently inside"""
+    try:
+        conn = get_timescale_connection()
+        load_geofences(conn)
+        # Only the leader's memory follows every record; the table is current everywhere
+        cursor = conn.cursor()
+        cursor.execute("SELECT fence_id FROM geofence_state WHERE imei = %s", (imei,))
+        inside = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+        fences = [fence for fence in geofence_engine.fences() if fence['id'] in inside]
+        return jsonify({'imei': imei, 'count': len(fences), 'geofences': fences})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/stats', methods=['GET'])
 @app.route('/api/stats/<imei>', methods=['GET'])
+@conditional_response('stats', updated_at=trips_updated_at)
+@cached_response('stats')
 def get_stats(imei=None):
     """Get statistics for a device"""
     try:
@@ -449,35 +1314,32 @@ def get_stats(imei=None):
         
         # If no IMEI, get most recent device
         if not imei:
-            cursor.execute("SELECT imei FROM telemetry ORDER BY time DESC LIMIT 1")
-            result = cursor.fetchone()
-            if not result:
+            imei = get_default_imei(cursor)
+            if not imei:
                 return jsonify({'error': 'No data found'}), 404
-            imei = result[0]
         
-        start_time = datetime.utcnow() - timedelta(hours=hours)
+        end_time = datetime.now(timezone.utc)
+        start_time = end_time - timedelta(hours=hours)
         
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total_records,
-                MAX(speed_kmh) as max_speed,
-                MAX(odometer_m) - MIN(odometer_m) as distance_m,
-                MIN(time) as first_seen,
-                MAX(time) as last_seen
-            FROM telemetry
-            WHERE imei = %s AND time >= %s
-        """, (imei, start_time))
+        # Hourly/daily rollups plus raw rows for the partial hours at the edges
+        window = telemetry_rollups.window_stats(cursor, imei, start_time, end_time)
         
-        row = cursor.fetchone()
+        # Ignition-on time is the time spent in trips (ignition on -> off)
+        ignition_on = trip_engine.ignition_on_seconds(cursor, imei, start_time, end_time)
         
+        odometer_min, odometer_max = window['odometer_min'], window['odometer_max']
         stats = {
             'imei': imei,
             'period_hours': hours,
-            'total_records': int(row[0]) if row[0] else 0,
-            'max_speed_kmh': float(row[1]) if row[1] else 0,
-            'total_distance_km': float(row[2]) / 1000 if row[2] else 0,
-            'first_seen': row[3].isoformat() if row[3] else None,
-            'last_seen': row[4].isoformat() if row[4] else None
+            'total_records': window['records'],
+            'max_speed_kmh': window['max_speed'],
+            'avg_speed_kmh': round(window['avg_speed'], 1),
+            'total_distance_km': float(odometer_max - odometer_min) / 1000 if odometer_max and odometer_min is not None else 0,
+            'ignition_on_hours': round(ignition_on / 3600, 2),
+            'min_external_voltage_mv': window['voltage_min'],
+            'max_external_voltage_mv': window['voltage_max'],
+            'first_seen': window['first_seen'].isoformat() if window['first_seen'] else None,
+            'last_seen': window['last_seen'].isoformat() if window['last_seen'] else None
         }
         
         cursor.close()
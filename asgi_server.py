@@ -0,0 +1,410 @@
+"""
+POPTOP ASGI Server - Async serving mode for the dashboard endpoints
+The polling and streaming endpoints (health, devices, latest, fleet/latest,
+history, history/stream, stream) run as coroutines on an async psycopg 3
+pool, so a worker waiting on Timescale keeps serving other requests and
+SSE streams cost no thread each. Queries and JSON builders come from
+api_server_NEW, so the response shapes are the same; every other route
+(dashboard, trips, stats, export, geofences, metrics) is served by the
+Flask app mounted behind it.
+
+    uvicorn asgi_server:app --host 0.0.0.0 --port $PORT
+"""
+
+import asyncio
+import functools
+import gzip
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+from a2wsgi import WSGIMiddleware
+from psycopg import AsyncClientCursor
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import http_date, parse_accept_header, parse_date, parse_etags, quote_etag
+
+import api_server_NEW as api
+import json_codec
+import telemetry_io
+from db_pool import DB_CONFIG
+from geofence import geofence_engine
+from live_stream import AsyncSubscription, telemetry_listener
+from response_cache import response_cache
+
+ASYNC_POOL_MIN = int(os.environ.get('TIMESCALE_ASYNC_POOL_MIN', 2))
+ASYNC_POOL_MAX = int(os.environ.get('TIMESCALE_ASYNC_POOL_MAX', 20))
+
+# Each NDJSON history stream holds a pool connection for as long as the
+# client reads; keep the rest of the pool for the other routes
+HISTORY_STREAM_MAX_CONCURRENT = int(os.environ.get('HISTORY_STREAM_MAX_CONCURRENT', max(ASYNC_POOL_MAX // 2, 1)))
+history_stream_slots = asyncio.Semaphore(HISTORY_STREAM_MAX_CONCURRENT)
+
+# Client-side parameter binding, as with psycopg2, so the shared SQL
+# (untyped literals like `%s * INTERVAL '1 hour'`) means the same thing
+pool = AsyncConnectionPool(
+    make_conninfo(
+        host=DB_CONFIG['host'], port=DB_CONFIG['port'], dbname=DB_CONFIG['database'],
+        user=DB_CONFIG['user'], password=DB_CONFIG['password'],
+        connect_timeout=DB_CONFIG['connect_timeout']
+    ),
+    min_size=ASYNC_POOL_MIN,
+    max_size=ASYNC_POOL_MAX,
+    timeout=float(os.environ.get('TIMESCALE_POOL_TIMEOUT', 10)),
+    kwargs={'autocommit': True, 'cursor_factory': AsyncClientCursor},
+    open=False
+)
+
+async def fetch_io(cursor, keys, io_ids=None):
+    """Async telemetry_io.fetch_io"""
+    keys = list(keys)
+    if not keys:
+        return {}
+    await cursor.execute(*telemetry_io.fetch_io_query(keys, io_ids))
+    result = telemetry_io.io_map_from_rows(await cursor.fetchall())
+    missing = [key for key in keys if key not in result]
+    if missing:
+        await cursor.execute(telemetry_io.RAW_JSON_SQL, telemetry_io.raw_json_params(missing))
+        telemetry_io.merge_raw_json(result, await cursor.fetchall(), io_ids, missing)
+    return result
+
+async def get_default_imei(cursor):
+    await cursor.execute(api.DEFAULT_IMEI_SQL)
+    result = await cursor.fetchone()
+    return result[0] if result else None
+
+async def get_newest_time(cursor, imei=None):
+    if imei:
+        await cursor.execute(api.NEWEST_TIME_SQL, (imei,))
+        result = await cursor.fetchone()
+        return result[0] if result else None
+    await cursor.execute(api.DEFAULT_IMEI_SQL)
+    result = await cursor.fetchone()
+    return result[1] if result else None
+
+def jsonify(request, obj, status=200):
+    """JSON response, compressed like the Flask app's compress_response"""
+    body = json_codec.dumps(obj) + b'\n'
+    headers = {}
+    if status == 200:
+        headers['Vary'] = 'Accept-Encoding'
+        if len(body) >= api.COMPRESS_MIN_SIZE:
+            accept = parse_accept_header(request.headers.get('accept-encoding'))
+            encoding = accept.best_match(['br', 'gzip'] if api.brotli else ['gzip'])
+            if encoding == 'br':
+                body = api.brotli.compress(body, quality=5)
+            elif encoding == 'gzip':
+                body = gzip.compress(body, compresslevel=6)
+            if encoding:
+                headers['Content-Encoding'] = encoding
+    return Response(body, status_code=status, media_type='application/json', headers=headers)
+
+def conditional_response(endpoint):
+    """Async api.conditional_response: 304 until the device has newer telemetry"""
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request):
+            imei = request.path_params.get('imei')
+            try:
+                async with pool.connection() as conn:
+                    newest = await get_newest_time(conn.cursor(), imei)
+            except Exception as e:
+                return jsonify(request, {'error': str(e)}, 500)
+            if newest is None:
+                return await view(request)
+
+            etag, last_modified = api.response_validators(endpoint, imei, request.url.query, newest)
+            if_none_match = request.headers.get('if-none-match')
+            if if_none_match:
+                not_modified = parse_etags(if_none_match).contains_weak(etag)
+            else:
+                since = parse_date(request.headers.get('if-modified-since'))
+                not_modified = since is not None and last_modified <= since
+            if not_modified:
+                response = Response(status_code=304)
+            else:
+                response = await view(request)
+                if response.status_code != 200:
+                    return response
+            response.headers['ETag'] = quote_etag(etag, weak=True)
+            response.headers['Last-Modified'] = http_date(last_modified)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+async def health_check(request):
+    """Health check endpoint"""
+    try:
+        async with pool.connection() as conn:
+            await conn.execute("SELECT 1")
+        return jsonify(request, {
+            'status': 'ok',
+            'timestamp': datetime.utcnow().isoformat(),
+            'database': 'Timescale Cloud',
+            'table': 'telemetry',
+            'deployment': 'Railway',
+            'pool': pool.get_stats(),
+            'stream': telemetry_listener.stats(),
+            'cache': response_cache.stats(),
+            'geofences': geofence_engine.stats(),
+            'io_fallback': telemetry_io.fallback_stats()
+        })
+    except Exception as e:
+        return jsonify(request, {
+            'status': 'error',
+            'error': str(e),
+            'pool': pool.get_stats(),
+            'stream': telemetry_listener.stats(),
+            'cache': response_cache.stats(),
+            'geofences': geofence_engine.stats(),
+            'io_fallback': telemetry_io.fallback_stats()
+        }, 500)
+
+async def list_devices(request):
+    """List all active devices"""
+    try:
+        async with pool.connection() as conn:
+            cursor = await conn.execute(api.DEVICES_SQL)
+            devices = [api.device_entry(row) for row in await cursor.fetchall()]
+        return jsonify(request, {
+            'count': len(devices),
+            'devices': devices
+        })
+    except Exception as e:
+        return jsonify(request, {'error': str(e)}, 500)
+
+@conditional_response('latest')
+async def get_latest_data(request):
+    """Get the most recent telemetry data for a device (or all devices)"""
+    imei = request.path_params.get('imei')
+    try:
+        fields = request.query_params.get('fields') or None
+        if fields:
+            try:
+                fields, io_ids = api.parse_fields(fields)
+            except ValueError as e:
+                return jsonify(request, {'error': str(e)}, 400)
+
+        async with pool.connection() as conn:
+            cursor = conn.cursor()
+            if not imei:
+                imei = await get_default_imei(cursor)
+                if not imei:
+                    return jsonify(request, {'error': 'No data found'}, 404)
+
+            # ?fields= reads only the requested columns and IO elements
+            if fields is not None:
+                await cursor.execute(api.projected_latest_sql(fields), (imei,))
+                row = await cursor.fetchone()
+                if not row:
+                    return jsonify(request, {'error': 'No data found for this IMEI'}, 404)
+                io_elements = None
+                if io_ids is None or io_ids:
+                    io_elements = (await fetch_io(cursor, [(imei, row[0])], io_ids)).get((imei, row[0]), {})
+                return jsonify(request, api.projected_latest_result(imei, row, fields, io_elements))
+
+            await cursor.execute(api.LATEST_SQL, (imei,))
+            row = await cursor.fetchone()
+            if not row:
+                return jsonify(request, {'error': 'No data found for this IMEI'}, 404)
+            io_elements = (await fetch_io(cursor, [(row[1], row[0])])).get((row[1], row[0]), {})
+        return jsonify(request, api.latest_result(row, io_elements))
+
+    except Exception as e:
+        return jsonify(request, {'error': str(e)}, 500)
+
+async def get_fleet_latest(request):
+    """Get the latest record of every active device in one query"""
+    try:
+        active_hours = int(request.query_params.get('active_hours', 168))
+        fields = request.query_params.get('fields')
+        if fields:
+            try:
+                fields, io_ids = api.parse_fields(fields)
+            except ValueError as e:
+                return jsonify(request, {'error': str(e)}, 400)
+        else:
+            fields, io_ids = api.DEFAULT_FLEET_FIELDS, set()
+
+        async with pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(api.fleet_sql(fields), (active_hours,))
+            rows = await cursor.fetchall()
+            io_map = {}
+            if io_ids is None or io_ids:
+                io_map = await fetch_io(cursor, [(row[0], row[1]) for row in rows], io_ids)
+        devices = [{'imei': row[0], **api.build_record(row[1], fields, row[2:], io_map.get((row[0], row[1])))}
+                   for row in rows]
+        return jsonify(request, {
+            'count': len(devices),
+            'devices': devices
+        })
+
+    except Exception as e:
+        return jsonify(request, {'error': str(e)}, 500)
+
+@conditional_response('history')
+async def get_history(request):
+    """Get historical telemetry data"""
+    imei = request.path_params.get('imei')
+    args = request.query_params
+    try:
+        hours = int(args.get('hours', 24))
+        limit = int(args.get('limit', 1000))
+        try:
+            tolerance_m, max_points = api.get_simplify_params(args)
+        except ValueError as e:
+            return jsonify(request, {'error': str(e)}, 400)
+        simplify = tolerance_m is not None or max_points is not None
+        fields = args.get('fields') or None
+        if fields:
+            try:
+                fields, io_ids = api.parse_fields(fields)
+            except ValueError as e:
+                return jsonify(request, {'error': str(e)}, 400)
+
+        async with pool.connection() as conn:
+            cursor = conn.cursor()
+            if not imei:
+                imei = await get_default_imei(cursor)
+                if not imei:
+                    return jsonify(request, {'error': 'No data found'}, 404)
+
+            start_time = datetime.utcnow() - timedelta(hours=hours)
+
+            # ?fields= reads only the requested columns and IO elements
+            if fields is not None:
+                await cursor.execute(api.projected_history_sql(fields, simplify), (imei, start_time, limit))
+                rows = await cursor.fetchall()
+                if simplify:
+                    rows = api.simplify_rows(rows, -3, -2, -1, tolerance_m, max_points)
+                io_map = {}
+                if io_ids is None or io_ids:
+                    io_map = await fetch_io(cursor, [(imei, row[0]) for row in rows], io_ids)
+                records = [api.build_record(row[0], fields, row[1:len(fields) + 1], io_map.get((imei, row[0])))
+                           for row in rows]
+            else:
+                await cursor.execute(api.HISTORY_SQL, (imei, start_time, limit))
+                rows = await cursor.fetchall()
+                # Thin the track before any IO elements are fetched
+                if simplify:
+                    rows = api.simplify_rows(rows, 1, 2, 4, tolerance_m, max_points)
+                io_map = await fetch_io(cursor, [(imei, row[0]) for row in rows])
+                records = [api.history_record(row, io_map.get((imei, row[0]), {})) for row in rows]
+
+        return jsonify(request, {
+            'imei': imei,
+            'count': len(records),
+            'records': records
+        })
+
+    except Exception as e:
+        return jsonify(request, {'error': str(e)}, 500)
+
+async def stream_history(request):
+    """NDJSON history from a server-side cursor (see api_server_NEW.stream_history)"""
+    try:
+        query, params, fields, io_ids, limit = api.parse_stream_request(
+            request.query_params, request.path_params.get('imei'))
+    except ValueError as e:
+        return jsonify(request, {'error': str(e)}, 400)
+
+    if history_stream_slots.locked():
+        response = jsonify(request, {'error': 'Too many open streams, try again later'}, 503)
+        response.headers['Retry-After'] = '30'
+        return response
+    # Doesn't wait: a slot is free and nothing runs in between
+    await history_stream_slots.acquire()
+
+    async def generate():
+        sent = 0
+        last = None
+        more = False
+        try:
+            async with pool.connection() as conn:
+                # Server-side cursors live inside a transaction
+                async with conn.transaction():
+                    async with conn.cursor(name='history_stream') as cursor:
+                        io_cursor = conn.cursor()
+                        await cursor.execute(query, params)
+                        while not more:
+                            rows = await cursor.fetchmany(api.STREAM_FETCH_SIZE)
+                            if not rows:
+                                break
+                            if limit is not None and sent + len(rows) > limit:
+                                rows = rows[:limit - sent]
+                                more = True
+                            io_map = {}
+                            if io_ids is None or io_ids:
+                                io_map = await fetch_io(io_cursor, [(row[1], row[0]) for row in rows], io_ids)
+                            records = api.stream_records(rows, fields, io_map)
+                            sent += len(rows)
+                            if rows:
+                                last = rows[-1]
+                                for chunk in json_codec.iter_lines(records):
+                                    yield chunk
+            next_cursor = api.encode_cursor(f"{last[0].isoformat()}|{last[1]}") if more else None
+            yield json_codec.dumps({'count': sent, 'next_cursor': next_cursor}) + b'\n'
+        except Exception as e:
+            # Headers are already sent; report the failure in-band
+            yield json_codec.dumps({'error': str(e), 'count': sent}) + b'\n'
+        finally:
+            history_stream_slots.release()
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+async def stream_telemetry(request):
+    """Server-Sent Events stream of new telemetry for a device (or all devices)"""
+    subscription = telemetry_listener.attach(
+        AsyncSubscription(asyncio.get_running_loop(), request.path_params.get('imei')))
+
+    async def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                record = await subscription.get(timeout=15)
+                if record is None:
+                    # Keep proxies from closing an idle stream
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: telemetry\ndata: {json_codec.dumps(record).decode()}\n\n"
+        finally:
+            telemetry_listener.unsubscribe(subscription)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@asynccontextmanager
+async def lifespan(app):
+    await pool.open()
+    telemetry_listener.start()
+    yield
+    await pool.close()
+
+app = Starlette(
+    routes=[
+        Route('/api/health', health_check),
+        Route('/api/devices', list_devices),
+        Route('/api/latest', get_latest_data),
+        Route('/api/latest/{imei}', get_latest_data),
+        Route('/api/fleet/latest', get_fleet_latest),
+        Route('/api/history', get_history),
+        Route('/api/history/stream', stream_history),
+        Route('/api/history/stream/{imei}', stream_history),
+        Route('/api/history/{imei}', get_history),
+        Route('/api/stream', stream_telemetry),
+        Route('/api/stream/{imei}', stream_telemetry),
+        # Everything else: the Flask app, on a thread pool
+        Mount('/', WSGIMiddleware(api.app))
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
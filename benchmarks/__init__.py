@@ -0,0 +1,4 @@
+"""
+POPTOP Benchmarks
+Run from the repository root, e.g. `python -m benchmarks.bench_codec`.
+"""
@@ -0,0 +1,83 @@
+"""
+Codec 8/8E parser microbenchmark
+Builds large synthetic AVL packets and reports decoded records/sec.
+
+    python -m benchmarks.bench_codec --records 255 --io 53 --packets 200
+"""
+
+import argparse
+import random
+import time
+
+from teltonika_codec import CODEC_8, CODEC_8E, IO_CATALOG, build_packet, parse_packet
+
+def synthetic_record(timestamp_ms, io_count, codec_id):
+    """A record with io_count IO elements spread over all value sizes"""
+    known_ids = sorted(IO_CATALOG)
+    io = {}
+    for n in range(io_count):
+        io_id = known_ids[n] if n < len(known_ids) else 300 + n
+        if codec_id == CODEC_8 and io_id > 0xFF:
+            io_id = 100 + n
+        value = random.choice([
+            random.randint(0, 0xFF),
+            random.randint(0x100, 0xFFFF),
+            random.randint(0x10000, 0xFFFFFFFF),
+            random.randint(0x100000000, 0xFFFFFFFFFFFF),
+        ])
+        io[f'io_{io_id}'] = {'id': io_id, 'value': value}
+    if codec_id == CODEC_8E:
+        # 17-byte VIN as a variable-length element
+        io['vin'] = {'id': 256, 'value': b'WD0PF445585238717'.hex()}
+    return {
+        'timestamp': timestamp_ms,
+        'priority': 0,
+        'gps': {
+            'latitude': 38.5 + random.uniform(-0.1, 0.1),
+            'longitude': -121.4 + random.uniform(-0.1, 0.1),
+            'altitude': random.randint(0, 500),
+            'angle': random.randint(0, 359),
+            'satellites': random.randint(4, 14),
+            'speed_kmh': random.randint(0, 120)
+        },
+        'event_io_id': 0,
+        'io': io
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=255, help='records per packet (max 255)')
+    parser.add_argument('--io', type=int, default=53, help='IO elements per record')
+    parser.add_argument('--packets', type=int, default=200, help='packets to decode')
+    parser.add_argument('--codec', choices=['8', '8E'], default='8E')
+    parser.add_argument('--verify-crc', action='store_true')
+    args = parser.parse_args()
+
+    codec_id = CODEC_8E if args.codec == '8E' else CODEC_8
+    random.seed(42)
+    start_ms = int(time.time() * 1000)
+    packets = [
+        build_packet(
+            [synthetic_record(start_ms + (p * args.records + r) * 1000, args.io, codec_id) for r in range(args.records)],
+            codec_id
+        )
+        for p in range(min(args.packets, 20))
+    ]
+    packets = (packets * (args.packets // len(packets) + 1))[:args.packets]
+    total_bytes = sum(len(packet) for packet in packets)
+
+    # Warm up, and check the round trip decodes every record
+    assert parse_packet(packets[0], verify_crc=True)['num_records'] == args.records
+
+    began = time.perf_counter()
+    records = 0
+    for packet in packets:
+        records += len(parse_packet(packet, verify_crc=args.verify_crc)['records'])
+    elapsed = time.perf_counter() - began
+
+    print(f"Codec {args.codec}: {args.packets} packets x {args.records} records x {args.io} IO elements")
+    print(f"  {records} records in {elapsed:.3f}s")
+    print(f"  {records / elapsed:,.0f} records/sec, {total_bytes / elapsed / 1e6:.1f} MB/s")
+
+if __name__ == '__main__':
+    main()
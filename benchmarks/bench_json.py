@@ -0,0 +1,91 @@
+"""
+JSON serialization microbenchmark
+Serializes a history-shaped response (records with 53 IO elements) and a
+trips response carrying DynamoDB Decimals, the old way (decimal_to_number
+pre-walk + Flask's default stdlib encoder with sorted keys) and through
+json_codec, and reports time per response.
+
+    python -m benchmarks.bench_json --records 5000 --repeat 20
+"""
+
+import argparse
+import datetime
+import decimal
+import json
+import random
+import time
+
+import json_codec
+from benchmarks.bench_codec import synthetic_record
+from teltonika_codec import CODEC_8E
+
+def decimal_to_number(obj):
+    """The recursive pre-walk api_server.py used before json_codec"""
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+    if isinstance(obj, dict):
+        return {k: decimal_to_number(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [decimal_to_number(item) for item in obj]
+    return obj
+
+def history_response(count):
+    start_ms = int(time.time() * 1000) - count * 10_000
+    records = []
+    for n in range(count):
+        record = synthetic_record(start_ms + n * 10_000, 53, CODEC_8E)
+        record['datetime'] = datetime.datetime.fromtimestamp(record['timestamp'] / 1000, datetime.timezone.utc).isoformat()
+        records.append(record)
+    return {'imei': '350000000000001', 'count': count, 'records': records}
+
+def trips_response(count):
+    """Trip summaries as built from DynamoDB items (numbers arrive as Decimal)"""
+    trips = []
+    for n in range(count):
+        start = decimal.Decimal(1_700_000_000_000 + n * 3_600_000)
+        trips.append({
+            'start_time': start,
+            'end_time': start + decimal.Decimal(random.randint(60_000, 3_000_000)),
+            'total_distance': decimal.Decimal(random.randint(500, 90_000)),
+            'max_speed': decimal.Decimal(f'{random.uniform(20, 140):.1f}'),
+            'avg_speed': decimal.Decimal(f'{random.uniform(10, 80):.1f}'),
+            'start_odometer': decimal.Decimal(random.randint(0, 10 ** 8)),
+            'num_points': random.randint(10, 2000),
+            'ongoing': False,
+            'vin': 'WBA3A5C55DF000000'
+        })
+    return {'count': count, 'trips': trips, 'imei': '350000000000001'}
+
+def legacy_dumps(obj):
+    # Flask's DefaultJSONProvider: stdlib, compact separators, sorted keys
+    return json.dumps(decimal_to_number(obj), separators=(',', ':'), sort_keys=True).encode()
+
+def measure(label, func, payload, repeat):
+    func(payload)  # warm up
+    began = time.perf_counter()
+    for _ in range(repeat):
+        size = len(func(payload))
+    elapsed = (time.perf_counter() - began) / repeat
+    print(f"  {label:<28} {elapsed * 1000:>8.2f} ms/response  {size / elapsed / 1e6:>7.1f} MB/s")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=5000, help='records in the history response')
+    parser.add_argument('--trips', type=int, default=2000, help='trips in the trips response')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(42)
+    payloads = [('history', history_response(args.records)), ('trips', trips_response(args.trips))]
+    print(f"json_codec backend: {json_codec.BACKEND}")
+    for name, payload in payloads:
+        # Same document either way (key order aside)
+        assert json.loads(legacy_dumps(payload)) == json.loads(json_codec.dumps(payload))
+        print(f"{name}:")
+        legacy = measure('pre-walk + stdlib (sorted)', legacy_dumps, payload, args.repeat)
+        codec = measure(f'json_codec ({json_codec.BACKEND})', json_codec.dumps, payload, args.repeat)
+        print(f"  speedup {legacy / codec:.1f}x")
+
+if __name__ == '__main__':
+    main()
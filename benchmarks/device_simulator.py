@@ -0,0 +1,83 @@
+"""
+Simulated Teltonika devices for the TCP ingestion server
+Opens one socket per device, performs the IMEI handshake, sends AVL
+packets and checks every ACK.
+
+    python teltonika_server.py --port 5027 &
+    python -m benchmarks.device_simulator --devices 1000 --packets 20
+"""
+
+import argparse
+import asyncio
+import random
+import struct
+import time
+
+from benchmarks.bench_codec import synthetic_record
+from teltonika_codec import CODEC_8E, build_packet
+
+async def run_device(host, port, imei, packets, records_per_packet, interval, latencies, failures):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(struct.pack('>H', len(imei)) + imei.encode())
+        await writer.drain()
+        if await reader.readexactly(1) != b'\x01':
+            failures.append(f'{imei}: rejected')
+            return
+
+        timestamp_ms = int(time.time() * 1000)
+        for _ in range(packets):
+            records = []
+            for _ in range(records_per_packet):
+                records.append(synthetic_record(timestamp_ms, 20, CODEC_8E))
+                timestamp_ms += 1000
+            packet = build_packet(records, CODEC_8E)
+
+            sent = time.perf_counter()
+            writer.write(packet)
+            await writer.drain()
+            accepted = struct.unpack('>I', await reader.readexactly(4))[0]
+            latencies.append(time.perf_counter() - sent)
+            if accepted != records_per_packet:
+                failures.append(f'{imei}: ACK {accepted}, expected {records_per_packet}')
+            await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+    finally:
+        writer.close()
+
+async def simulate(args):
+    latencies = []
+    failures = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_device(args.host, args.port, f'86{i:013d}', args.packets, args.records,
+                   args.interval, latencies, failures)
+        for i in range(args.devices)
+    ), return_exceptions=False)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"{args.devices} devices, {total} packets, {total * args.records} records in {elapsed:.2f}s")
+    if total:
+        print(f"  {total / elapsed:,.0f} packets/sec, {total * args.records / elapsed:,.0f} records/sec")
+        print(f"  ACK latency p50 {latencies[total // 2] * 1000:.1f} ms, "
+              f"p99 {latencies[min(total - 1, int(total * 0.99))] * 1000:.1f} ms")
+    for failure in failures[:10]:
+        print(f"  FAIL {failure}")
+    if failures:
+        print(f"  {len(failures)} failures")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5027)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--packets', type=int, default=10, help='packets per device')
+    parser.add_argument('--records', type=int, default=5, help='records per packet')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between packets')
+    args = parser.parse_args()
+    random.seed(7)
+    asyncio.run(simulate(args))
+
+if __name__ == '__main__':
+    main()
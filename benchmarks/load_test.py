@@ -0,0 +1,136 @@
+"""
+Dashboard load test for the API server
+Each worker behaves like an open dashboard tab: it polls /api/latest,
+/api/trips?hours=72 and /api/stats?hours=72 for one device, then waits for
+the poll interval. Reports latency percentiles and throughput per endpoint.
+
+    python api_server_NEW.py &
+    python -m benchmarks.load_test --url http://localhost:5000 --workers 100 --duration 60
+
+--conditional makes workers revalidate with If-None-Match like a browser.
+"""
+
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+ENDPOINTS = (
+    ('latest', '/api/latest/{imei}'),
+    ('trips', '/api/trips/{imei}?hours=72'),
+    ('stats', '/api/stats/{imei}?hours=72'),
+)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+class Results:
+    """Latencies and status counts per endpoint, shared by all workers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {name: [] for name, _ in ENDPOINTS}
+        self.statuses = {name: {} for name, _ in ENDPOINTS}
+        self.bytes = {name: 0 for name, _ in ENDPOINTS}
+
+    def add(self, name, latency, status, size):
+        with self._lock:
+            self.latencies[name].append(latency)
+            self.statuses[name][status] = self.statuses[name].get(status, 0) + 1
+            self.bytes[name] += size
+
+def fetch_devices(host, port, path_prefix):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    conn.request('GET', f'{path_prefix}/api/fleet/latest?fields=latitude')
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    if response.status != 200:
+        raise SystemExit(f'/api/fleet/latest returned {response.status}: {body[:200]!r}')
+    return [device['imei'] for device in json.loads(body)['devices']]
+
+def worker(host, port, path_prefix, imei, interval, deadline, conditional, results):
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    etags = {}
+    # Spread the first polls like tabs opened at different times
+    time.sleep(random.uniform(0, interval))
+    while time.monotonic() < deadline:
+        cycle_started = time.monotonic()
+        for name, template in ENDPOINTS:
+            path = path_prefix + template.format(imei=imei)
+            headers = {'Accept-Encoding': 'gzip'}
+            if conditional and path in etags:
+                headers['If-None-Match'] = etags[path]
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                results.add(name, time.perf_counter() - started, type(e).__name__, 0)
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=60)
+                continue
+            results.add(name, time.perf_counter() - started, response.status, len(body))
+            if response.getheader('ETag'):
+                etags[path] = response.getheader('ETag')
+        time.sleep(max(0.0, interval - (time.monotonic() - cycle_started)))
+    conn.close()
+
+def report(results, elapsed):
+    print(f"{'endpoint':<8} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'KB/req':>7}  statuses")
+    total = 0
+    for name, _ in ENDPOINTS:
+        latencies = sorted(results.latencies[name])
+        count = len(latencies)
+        total += count
+        statuses = ' '.join(f'{status}:{n}' for status, n in sorted(results.statuses[name].items(), key=str))
+        print(f"{name:<8} {count:>9} {count / elapsed:>8.1f} "
+              f"{percentile(latencies, 0.50) * 1000:>8.1f} {percentile(latencies, 0.95) * 1000:>8.1f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.1f} {(latencies[-1] if latencies else 0) * 1000:>8.1f} "
+              f"{results.bytes[name] / max(count, 1) / 1024:>7.1f}  {statuses}")
+    print(f"total    {total:>9} {total / elapsed:>8.1f} req/s over {elapsed:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--workers', type=int, default=50, help='concurrent dashboard tabs')
+    parser.add_argument('--devices', type=int, default=0, help='limit to this many devices (default all)')
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds between poll cycles per worker')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds to run')
+    parser.add_argument('--conditional', action='store_true', help='send If-None-Match with the last ETag')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    url = urlsplit(args.url)
+    host, port, path_prefix = url.hostname, url.port or 80, url.path.rstrip('/')
+    imeis = fetch_devices(host, port, path_prefix)
+    if args.devices:
+        imeis = imeis[:args.devices]
+    if not imeis:
+        raise SystemExit('No active devices; generate some with benchmarks.fleet_generator')
+    print(f"{args.workers} workers polling {len(imeis)} devices every {args.interval:g}s for {args.duration:g}s")
+
+    results = Results()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=worker, daemon=True, args=(
+            host, port, path_prefix, imeis[i % len(imeis)], args.interval, deadline, args.conditional, results
+        ))
+        for i in range(args.workers)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(results, time.monotonic() - started)
+
+if __name__ == '__main__':
+    main()
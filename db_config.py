@@ -0,0 +1,16 @@
+"""
+POPTOP Database Config - Timescale connection settings
+Kept free of other project imports so standalone writers (the ingest
+Lambda, CLIs) can connect without pulling in the API's pool and metrics.
+"""
+
+import os
+
+DB_CONFIG = {
+    'host': os.environ.get('TIMESCALE_HOST', 'pfz4m2fxdm.ubqkw0pnd9.tsdb.cloud.timescale.com'),
+    'port': int(os.environ.get('TIMESCALE_PORT', 38416)),
+    'database': os.environ.get('TIMESCALE_DB', 'tsdb'),
+    'user': os.environ.get('TIMESCALE_USER', 'tsdbadmin'),
+    'password': os.environ.get('TIMESCALE_PASSWORD', 'u2c06kpgklnlvq6g'),
+    'connect_timeout': 10
+}
@@ -0,0 +1,221 @@
+"""
+POPTOP Database Pool - Thread-safe Timescale connection pool
+Each request checks out its own connection and returns it when done.
+Broken or aborted connections are recycled instead of being handed to the
+next request, and reconnects back off while the database is unreachable.
+The pool is topped up to minconn connections on checkout (so the first
+request opens them all), not at import, so a worker starts even while the
+database is down.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from db_config import DB_CONFIG
+from metrics import TimedCursor
+
+POOL_MIN = int(os.environ.get('TIMESCALE_POOL_MIN', 1))
+POOL_MAX = int(os.environ.get('TIMESCALE_POOL_MAX', 10))
+POOL_TIMEOUT = float(os.environ.get('TIMESCALE_POOL_TIMEOUT', 10))   # seconds to wait for a free connection
+IDLE_TIMEOUT = float(os.environ.get('TIMESCALE_IDLE_TIMEOUT', 300))  # close idle connections above POOL_MIN after this
+
+# Reconnect backoff: 0.5s, 1s, 2s, ... capped at 30s
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the checkout timeout"""
+
+class TimescalePool:
+    """Bounded pool of psycopg2 connections shared by all request threads"""
+
+    def __init__(self, minconn=POOL_MIN, maxconn=POOL_MAX, timeout=POOL_TIMEOUT,
+                 cursor_factory=TimedCursor, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.cursor_factory = cursor_factory
+        self.connect_kwargs = connect_kwargs or DB_CONFIG
+        self._cond = threading.Condition()
+        self._idle = []          # (connection, returned_at)
+        self._in_use = 0
+        self._connecting = 0
+        self._failures = 0
+        self._retry_at = 0.0
+        self._stats = {
+            'checkouts': 0,
+            'connects': 0,
+            'connect_errors': 0,
+            'recycled': 0,
+            'timeouts': 0
+        }
+
+    def _size(self):
+        return len(self._idle) + self._in_use + self._connecting
+
+    def _connect(self):
+        """Open a new connection, failing fast while backing off"""
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise psycopg2.OperationalError(
+                f'Database unavailable, retrying in {self._retry_at - now:.1f}s'
+            )
+        try:
+            conn = psycopg2.connect(cursor_factory=self.cursor_factory, **self.connect_kwargs)
+        except psycopg2.Error:
+            with self._cond:
+                self._failures += 1
+                self._stats['connect_errors'] += 1
+                delay = min(BACKOFF_BASE * (2 ** (self._failures - 1)), BACKOFF_MAX)
+                self._retry_at = time.monotonic() + delay
+            raise
+        with self._cond:
+            self._failures = 0
+            self._retry_at = 0.0
+            self._stats['connects'] += 1
+        return conn
+
+    def _prune_idle(self):
+        """Close connections idle longer than IDLE_TIMEOUT, keeping minconn"""
+        cutoff = time.monotonic() - IDLE_TIMEOUT
+        while len(self._idle) > self.minconn and self._idle[0][1] < cutoff:
+            conn, _ = self._idle.pop(0)
+            conn.close()
+
+    def _fill_min(self):
+        """Open idle connections until the pool holds minconn"""
+        with self._cond:
+            missing = max(self.minconn - self._size(), 0)
+            self._connecting += missing
+        while missing:
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                with self._cond:
+                    self._connecting -= missing
+                    self._cond.notify_all()
+                    if not self._idle:
+                        # Nothing to check out either; report the real error
+                        raise
+                # Not fatal while idle connections are left to hand out
+                print(f"Could not open minimum pool connections: {e}")
+                return
+            missing -= 1
+            with self._cond:
+                self._connecting -= 1
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        """Check out a connection, opening one on demand up to maxconn"""
+        deadline = time.monotonic() + self.timeout
+        if self._size() < self.minconn and time.monotonic() >= self._retry_at:
+            self._fill_min()
+        with self._cond:
+            self._prune_idle()
+            while True:
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if conn.closed:
+                        self._stats['recycled'] += 1
+                        continue
+                    self._in_use += 1
+                    self._stats['checkouts'] += 1
+                    return conn
+                if self._size() < self.maxconn:
+                    self._connecting += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'No database connection free after {self.timeout}s')
+                self._cond.wait(remaining)
+
+        # Connect outside the lock so other threads can keep checking out
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._connecting -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._connecting -= 1
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+        return conn
+
+    def putconn(self, conn):
+        """Return a connection, rolling back or discarding it as needed"""
+        healthy = not conn.closed
+        if healthy:
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                healthy = False
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                # Open or aborted transaction: reset it before reuse
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    healthy = False
+        if not healthy:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+        with self._cond:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._stats['recycled'] += 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and back in"""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        """Pool size and counters for the health endpoint"""
+        with self._cond:
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'connecting': self._connecting,
+                'consecutive_failures': self._failures,
+                **self._stats
+            }
+
+    def closeall(self):
+        """Close every idle connection"""
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+
+def try_advisory_lock(conn, name):
+    """
+    Take the session-level advisory lock `name` without waiting. True when
+    this session holds it; it is released when the connection closes.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (name,))
+    held = cursor.fetchone()[0]
+    cursor.close()
+    conn.commit()
+    return held
+
+timescale_pool = TimescalePool()
@@ -0,0 +1,117 @@
+"""
+POPTOP DynamoDB Reader - Complete, projected, parallel time-window queries
+Used by the legacy DynamoDB API (api_server.py). A window of a device's
+items is split into SEGMENT_HOURS-long time segments that are queried
+concurrently on a thread pool; each segment follows LastEvaluatedKey until
+it is exhausted, so windows larger than DynamoDB's 1 MB page are complete.
+ProjectionExpression limits each item to the attributes the caller needs,
+and the `records` JSON strings are decoded in the worker threads while
+other segments are still in flight.
+
+boto3 resources aren't thread-safe, so every worker thread builds its own
+session and Table objects.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+import json_codec
+
+REGION = os.environ.get('AWS_REGION', 'us-west-1')
+
+# Segment length and concurrency for long windows
+SEGMENT_HOURS = float(os.environ.get('DYNAMO_SEGMENT_HOURS', 24))
+MAX_WORKERS = int(os.environ.get('DYNAMO_READ_WORKERS', 8))
+
+_local = threading.local()
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='dynamo-read')
+
+def get_table(name):
+    """Table object owned by the calling thread"""
+    tables = getattr(_local, 'tables', None)
+    if tables is None:
+        session = boto3.session.Session()
+        _local.resource = session.resource('dynamodb', region_name=REGION)
+        tables = _local.tables = {}
+    if name not in tables:
+        tables[name] = _local.resource.Table(name)
+    return tables[name]
+
+def query_all(table, **kwargs):
+    """Yield every item of a query, following LastEvaluatedKey across pages"""
+    while True:
+        response = table.query(**kwargs)
+        yield from response['Items']
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            return
+        kwargs['ExclusiveStartKey'] = last_key
+
+def time_segments(start_ms, end_ms, segment_ms):
+    """Split [start_ms, end_ms] into inclusive (start, end) ranges of at most segment_ms"""
+    segments = []
+    start = start_ms
+    while end_ms - start >= segment_ms:
+        segments.append((start, start + segment_ms - 1))
+        start += segment_ms
+    if start <= end_ms or not segments:
+        segments.append((start, end_ms))
+    return segments
+
+def _query_segment(table_name, imei, start_ms, end_ms, attributes, decode_records):
+    names = {'#ts': 'timestamp'}
+    values = {':imei': imei, ':start': start_ms}
+    if end_ms is None:
+        condition = 'imei = :imei AND #ts >= :start'
+    else:
+        condition = 'imei = :imei AND #ts BETWEEN :start AND :end'
+        values[':end'] = end_ms
+    kwargs = {
+        'KeyConditionExpression': condition,
+        'ExpressionAttributeValues': values,
+        'ScanIndexForward': True
+    }
+    if attributes:
+        # Alias every attribute; several (timestamp, ...) are reserved words
+        projection = []
+        for i, attribute in enumerate(attributes):
+            names[f'#p{i}'] = attribute
+            projection.append(f'#p{i}')
+        kwargs['ProjectionExpression'] = ', '.join(projection)
+    kwargs['ExpressionAttributeNames'] = names
+
+    items = list(query_all(get_table(table_name), **kwargs))
+    if decode_records:
+        for item in items:
+            item['records'] = json_codec.loads(item.get('records') or '[]')
+    return items
+
+def query_window(table_name, imei, start_ms, end_ms=None, attributes=None,
+                 decode_records=False, segment_hours=SEGMENT_HOURS):
+    """
+    All items of a device from start_ms to end_ms (inclusive, None for no
+    upper bound), oldest first. attributes restricts the returned
+    attributes; decode_records replaces each item's `records` JSON string
+    with the decoded list.
+    """
+    segment_ms = int(segment_hours * 3600 * 1000)
+    if end_ms is None:
+        # Split up to now; the last segment stays open for items still arriving
+        segments = time_segments(start_ms, int(time.time() * 1000), segment_ms)
+        segments[-1] = (segments[-1][0], None)
+    else:
+        segments = time_segments(start_ms, end_ms, segment_ms)
+
+    args = (table_name, imei)
+    if len(segments) == 1:
+        return _query_segment(*args, *segments[0], attributes, decode_records)
+    futures = [_executor.submit(_query_segment, *args, start, end, attributes, decode_records)
+               for start, end in segments]
+    items = []
+    for future in futures:
+        items.extend(future.result())
+    return items
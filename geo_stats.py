@@ -0,0 +1,74 @@
+"""
+POPTOP Geo Stats - Batched distance and speed statistics
+Array versions of the per-point haversine loops. Callers pass whole
+columns of latitude/longitude/speed/time; missing fixes are NaN.
+"""
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000
+
+# Speed at or below which a vehicle counts as stationary for averages
+MOVING_SPEED_KMH = 1.0
+
+# Steps implying a faster speed than this are treated as GPS jumps
+MAX_PLAUSIBLE_SPEED_KMH = 300.0
+
+def to_array(values):
+    """Float array with None and 0 (no fix) mapped to NaN"""
+    arr = np.array(values, dtype=float)
+    arr[arr == 0] = np.nan
+    return arr
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between arrays of points"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def step_distances(lat, lon, time_s=None, max_step_m=None, max_speed_kmh=None):
+    """
+    Distance from each fix to the previous one, in meters.
+    Element 0 is always 0. Steps touching a missing fix, longer than
+    max_step_m, or implying more than max_speed_kmh are set to 0.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    steps = np.zeros(len(lat))
+    if len(lat) < 2:
+        return steps
+    d = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    bad = np.isnan(d)
+    if max_step_m is not None:
+        bad |= d >= max_step_m
+    if max_speed_kmh is not None and time_s is not None:
+        dt = np.diff(np.asarray(time_s, dtype=float))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            implied_kmh = d / dt * 3.6
+        bad |= (dt > 0) & (implied_kmh > max_speed_kmh)
+    d[bad] = 0
+    steps[1:] = d
+    return steps
+
+def cumulative_distance(lat, lon, time_s=None, max_step_m=None, max_speed_kmh=None):
+    """Running distance in meters along the track"""
+    return np.cumsum(step_distances(lat, lon, time_s, max_step_m, max_speed_kmh))
+
+def speed_stats(speed, moving_kmh=MOVING_SPEED_KMH):
+    """(max speed, sum of moving speeds, count of moving samples)"""
+    speed = np.nan_to_num(np.asarray(speed, dtype=float))
+    if len(speed) == 0:
+        return 0.0, 0.0, 0
+    moving = speed[speed > moving_kmh]
+    return float(speed.max()), float(moving.sum()), int(len(moving))
+
+def trip_stats(lat, lon, speed, time_s=None, max_step_m=None, max_speed_kmh=MAX_PLAUSIBLE_SPEED_KMH):
+    """Distance, max speed and average moving speed for one track"""
+    distance = float(step_distances(lat, lon, time_s, max_step_m, max_speed_kmh).sum())
+    max_speed, speed_sum, speed_count = speed_stats(speed)
+    return {
+        'distance_m': distance,
+        'max_speed': max_speed,
+        'avg_speed': speed_sum / speed_count if speed_count else 0.0,
+        'moving_samples': speed_count
+    }
@@ -0,0 +1,431 @@
+"""
+POPTOP Geofences - Enter/exit events for depots and customer sites
+Fences (circles and polygons) live in the `geofences` table and in an
+in-memory grid index: each fence is registered in every CELL_DEG x CELL_DEG
+cell its bounding box touches, so a position is only tested against the
+fences of its own cell. Per-device "inside" sets are kept in memory (and in
+`geofence_state`), and each new record produces enter/exit events by
+comparing the fences that contain it with the fences the device was in.
+
+Records arrive through the telemetry listener (NOTIFY), so every ingest
+path (Lambda, TCP server) is covered without changes to the writers. The
+listener only queues them: a geofence thread evaluates and stores them on
+its own connection, in whichever process holds the geofence advisory lock,
+so each record is evaluated once however many API processes run.
+"""
+
+import json
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+
+import metrics
+from db_pool import DB_CONFIG, try_advisory_lock
+from geo_stats import EARTH_RADIUS_M
+
+log = logging.getLogger(__name__)
+
+# Grid cell size in degrees (~1.1 km of latitude)
+CELL_DEG = float(os.environ.get('GEOFENCE_CELL_DEG', 0.01))
+
+# Largest fence, as degrees of latitude or longitude its bounding box spans;
+# bounds the grid cells a fence registers in ((span / CELL_DEG)² at most)
+MAX_SPAN_DEG = float(os.environ.get('GEOFENCE_MAX_SPAN_DEG', 1.0))
+
+# Other processes may change fences; reload them this often
+RELOAD_INTERVAL = 60
+
+# Records waiting for the geofence thread; newer ones are dropped when full
+QUEUE_SIZE = int(os.environ.get('GEOFENCE_QUEUE_SIZE', 10000))
+
+# Seconds between attempts to become the evaluating process
+LEADER_RETRY = 15
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS geofences (
+    id BIGSERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('circle', 'polygon')),
+    geometry JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS geofence_state (
+    imei TEXT NOT NULL,
+    fence_id BIGINT NOT NULL REFERENCES geofences (id) ON DELETE CASCADE,
+    entered_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (imei, fence_id)
+);
+
+CREATE TABLE IF NOT EXISTS geofence_events (
+    id BIGSERIAL PRIMARY KEY,
+    imei TEXT NOT NULL,
+    fence_id BIGINT NOT NULL REFERENCES geofences (id) ON DELETE CASCADE,
+    event TEXT NOT NULL,
+    time TIMESTAMPTZ NOT NULL,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    UNIQUE (imei, fence_id, time, event)
+);
+
+CREATE INDEX IF NOT EXISTS geofence_events_time_idx ON geofence_events (time DESC);
+CREATE INDEX IF NOT EXISTS geofence_events_imei_time_idx ON geofence_events (imei, time DESC);
+"""
+
+_schema_ready = False
+
+def ensure_schema(conn):
+    """Create the geofence tables if they don't exist"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA_SQL)
+    cursor.close()
+    conn.commit()
+    _schema_ready = True
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Haversine distance in meters between two points"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+class Fence:
+    """A circle ({'center': [lat, lon], 'radius_m': r}) or polygon ({'points': [[lat, lon], ...]})"""
+
+    def __init__(self, fence_id, name, kind, geometry):
+        self.id = fence_id
+        self.name = name
+        self.kind = kind
+        self.geometry = geometry
+        if kind == 'circle':
+            lat, lon = (float(v) for v in geometry['center'])
+            radius = float(geometry['radius_m'])
+            if not (math.isfinite(radius) and radius > 0):
+                raise ValueError('radius_m must be > 0')
+            self.center = (lat, lon)
+            self.radius = radius
+            dlat = radius / 111320
+            dlon = radius / (111320 * max(math.cos(math.radians(lat)), 0.01))
+            self.bbox = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        elif kind == 'polygon':
+            points = [(float(lat), float(lon)) for lat, lon in geometry['points']]
+            if len(points) < 3:
+                raise ValueError('a polygon needs at least 3 points')
+            self.points = points
+            lats = [p[0] for p in points]
+            lons = [p[1] for p in points]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+        else:
+            raise ValueError(f"Unknown fence kind {kind!r} (expected circle or polygon)")
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not max_lat - min_lat <= MAX_SPAN_DEG or not max_lon - min_lon <= MAX_SPAN_DEG:
+            raise ValueError(f'a fence may span at most {MAX_SPAN_DEG}° of latitude and longitude')
+
+    def contains(self, lat, lon):
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        if self.kind == 'circle':
+            return distance_m(lat, lon, *self.center) <= self.radius
+        # Ray casting; fences are small enough to treat lat/lon as planar
+        inside = False
+        points = self.points
+        j = len(points) - 1
+        for i in range(len(points)):
+            lat_i, lon_i = points[i]
+            lat_j, lon_j = points[j]
+            if (lon_i > lon) != (lon_j > lon):
+                if lat < (lat_j - lat_i) * (lon - lon_i) / (lon_j - lon_i) + lat_i:
+                    inside = not inside
+            j = i
+        return inside
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'type': self.kind, **self.geometry}
+
+class GridIndex:
+    """Uniform lat/lon grid mapping cells to the fences whose bounding box touches them"""
+
+    def __init__(self, cell_deg=CELL_DEG):
+        self.cell_deg = cell_deg
+        self._cells = {}     # (row, col) -> set of fence ids
+        self._fence_cells = {}
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def insert(self, fence):
+        min_row, min_col = self._cell(fence.bbox[0], fence.bbox[1])
+        max_row, max_col = self._cell(fence.bbox[2], fence.bbox[3])
+        cells = [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(fence.id)
+        self._fence_cells[fence.id] = cells
+
+    def remove(self, fence_id):
+        for cell in self._fence_cells.pop(fence_id, ()):
+            ids = self._cells.get(cell)
+            if ids is not None:
+                ids.discard(fence_id)
+                if not ids:
+                    del self._cells[cell]
+
+    def candidates(self, lat, lon):
+        return self._cells.get(self._cell(lat, lon), ())
+
+    def __len__(self):
+        return len(self._cells)
+
+class GeofenceEngine:
+    """Fence index plus per-device inside state; turns records into enter/exit events"""
+
+    def __init__(self, cell_deg=CELL_DEG, queue_size=QUEUE_SIZE):
+        self.cell_deg = cell_deg
+        self._fences = {}
+        self._index = GridIndex(cell_deg)
+        self._inside = {}        # imei -> set of fence ids
+        self._last_time = {}     # imei -> newest evaluated timestamp (ms)
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._listener = None
+        self.leader = False
+        self.records = 0
+        self.tests = 0
+        self.events = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def load(self, conn):
+        """(Re)load fences and inside state from the database"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, kind, geometry FROM geofences")
+        fences = {}
+        for fence_id, name, kind, geometry in cursor.fetchall():
+            if isinstance(geometry, str):
+                geometry = json.loads(geometry)
+            try:
+                fences[fence_id] = Fence(fence_id, name, kind, geometry)
+            except (KeyError, TypeError, ValueError) as e:
+                # e.g. stored before MAX_SPAN_DEG was lowered
+                log.warning("Skipping geofence %s: %s", fence_id, e)
+        cursor.execute("SELECT imei, fence_id FROM geofence_state")
+        inside = {}
+        for imei, fence_id in cursor.fetchall():
+            inside.setdefault(imei, set()).add(fence_id)
+        cursor.close()
+        conn.commit()
+
+        index = GridIndex(self.cell_deg)
+        for fence in fences.values():
+            index.insert(fence)
+        with self._lock:
+            self._fences, self._index, self._inside = fences, index, inside
+            self._loaded_at = time.monotonic()
+
+    def needs_reload(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > RELOAD_INTERVAL
+
+    def refresh(self, conn):
+        """Reload fences for a request if they're stale; the leader's thread keeps its own current"""
+        if not self.leader and self.needs_reload():
+            self.load(conn)
+
+    def fences(self):
+        with self._lock:
+            return [fence.to_dict() for fence in sorted(self._fences.values(), key=lambda f: f.id)]
+
+    def inside(self, imei):
+        with self._lock:
+            return sorted(self._inside.get(imei, ()))
+
+    def add_fence(self, fence):
+        with self._lock:
+            self._fences[fence.id] = fence
+            self._index.insert(fence)
+
+    def remove_fence(self, fence_id):
+        with self._lock:
+            self._fences.pop(fence_id, None)
+            self._index.remove(fence_id)
+            for fence_ids in self._inside.values():
+                fence_ids.discard(fence_id)
+
+    def evaluate(self, imei, timestamp_ms, lat, lon):
+        """
+        Update the device's inside set with one position.
+        Returns [(fence_id, 'enter' | 'exit')]; positions older than the
+        newest one already evaluated for the device are ignored.
+        """
+        with self._lock:
+            if timestamp_ms < self._last_time.get(imei, 0):
+                return []
+            self._last_time[imei] = timestamp_ms
+            self.records += 1
+            previous = self._inside.get(imei, set())
+            # Only the fences of this cell, plus the ones the device is in
+            checked = set(self._index.candidates(lat, lon)) | previous
+            self.tests += len(checked)
+            current = {fence_id for fence_id in checked
+                       if fence_id in self._fences and self._fences[fence_id].contains(lat, lon)}
+            if current == previous:
+                return []
+            self._inside[imei] = current
+            events = [(fence_id, 'exit') for fence_id in sorted(previous - current)]
+            events += [(fence_id, 'enter') for fence_id in sorted(current - previous)]
+            self.events += len(events)
+            return events
+
+    def save_events(self, conn, imei, timestamp_ms, lat, lon, events):
+        """Persist events and the resulting inside state"""
+        event_time = datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+        cursor = conn.cursor()
+        for fence_id, event in events:
+            cursor.execute("""
+                INSERT INTO geofence_events (imei, fence_id, event, time, latitude, longitude)
+                SELECT %s, %s, %s, %s, %s, %s
+                WHERE EXISTS (SELECT 1 FROM geofences WHERE id = %s)
+                ON CONFLICT DO NOTHING
+            """, (imei, fence_id, event, event_time, lat, lon, fence_id))
+            if event == 'enter':
+                cursor.execute("""
+                    INSERT INTO geofence_state (imei, fence_id, entered_at)
+                    SELECT %s, %s, %s
+                    WHERE EXISTS (SELECT 1 FROM geofences WHERE id = %s)
+                    ON CONFLICT DO NOTHING
+                """, (imei, fence_id, event_time, fence_id))
+            else:
+                cursor.execute("DELETE FROM geofence_state WHERE imei = %s AND fence_id = %s",
+                               (imei, fence_id))
+        cursor.close()
+        conn.commit()
+
+    def on_record(self, record):
+        """Telemetry listener callback: queue a record for the geofence thread"""
+        if not self.leader:
+            return  # another process evaluates it
+        lat, lon = record['gps']['latitude'], record['gps']['longitude']
+        if not lat and not lon:
+            return  # no GPS fix
+        try:
+            self._queue.put_nowait((record['imei'], record['timestamp'], lat, lon))
+        except queue.Full:
+            self.dropped += 1
+
+    def process(self, conn, imei, timestamp_ms, lat, lon):
+        """Evaluate one queued position and persist its events"""
+        events = self.evaluate(imei, timestamp_ms, lat, lon)
+        if events:
+            self.save_events(conn, imei, timestamp_ms, lat, lon, events)
+
+    def start(self, listener):
+        """Feed the engine from a TelemetryListener and start the geofence thread"""
+        with self._lock:
+            if self._thread is None:
+                self._listener = listener
+                listener.add_callback(self.on_record)
+                self._thread = threading.Thread(target=self._run, name='geofence', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = None
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    self.leader = False
+                    conn = psycopg2.connect(**DB_CONFIG)
+                if not self.leader:
+                    if not try_advisory_lock(conn, 'geofence'):
+                        time.sleep(LEADER_RETRY)
+                        continue
+                    self.leader = True
+                    self._listener.start()
+                    # Start from the state the previous leader stored
+                    self.load(conn)
+                if self.needs_reload():
+                    self.load(conn)
+                try:
+                    position = self._queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                try:
+                    with metrics.timed('geofence_evaluate'):
+                        self.process(conn, *position)
+                except Exception:
+                    if conn.closed:
+                        raise
+                    conn.rollback()
+                    self.errors += 1
+                    metrics.BACKGROUND_ERRORS.inc('geofence_evaluate')
+                    log.exception("Geofence evaluation failed for %s", position[0])
+            except Exception:
+                self.errors += 1
+                metrics.BACKGROUND_ERRORS.inc('geofence_thread')
+                log.exception("Geofence thread error")
+                # Closing the session releases the lock for another process
+                if conn is not None:
+                    conn.close()
+                conn = None
+                self.leader = False
+                time.sleep(1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'fences': len(self._fences),
+                'grid_cells': len(self._index),
+                'devices_inside': sum(1 for fence_ids in self._inside.values() if fence_ids),
+                'records': self.records,
+                'fence_tests': self.tests,
+                'events': self.events,
+                'leader': self.leader,
+                'queued': self._queue.qsize(),
+                'dropped': self.dropped,
+                'errors': self.errors
+            }
+
+def fetch_events(cursor, imei=None, fence_id=None, start_time=None, limit=500):
+    """Newest events first"""
+    conditions = []
+    params = []
+    if imei:
+        conditions.append('e.imei = %s')
+        params.append(imei)
+    if fence_id:
+        conditions.append('e.fence_id = %s')
+        params.append(fence_id)
+    if start_time:
+        conditions.append('e.time >= %s')
+        params.append(start_time)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    params.append(limit)
+    cursor.execute(f"""
+        SELECT e.id, e.imei, e.fence_id, f.name, e.event, e.time, e.latitude, e.longitude
+        FROM geofence_events e
+        JOIN geofences f ON f.id = e.fence_id
+        {where}
+        ORDER BY e.time DESC, e.id DESC
+        LIMIT %s
+    """, params)
+    return [{
+        'id': row[0],
+        'imei': row[1],
+        'fence_id': row[2],
+        'fence_name': row[3],
+        'event': row[4],
+        'timestamp': int(row[5].timestamp() * 1000),
+        'datetime': row[5].isoformat(),
+        'latitude': row[6],
+        'longitude': row[7]
+    } for row in cursor.fetchall()]
+
+geofence_engine = GeofenceEngine()
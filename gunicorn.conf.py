@@ -0,0 +1,96 @@
+"""
+Production launcher for the API server
+
+    gunicorn -c gunicorn.conf.py                      # Procfile
+    GUNICORN_WORKERS=4 GUNICORN_THREADS=16 gunicorn -c gunicorn.conf.py
+
+Each worker is a separate process with its own Timescale pool (sized to
+its threads) and telemetry listener. The latest-record / device-list hot
+state lives in shared memory created here, in the master, before the
+workers are forked, so they all see the same segment. `kill -HUP <master>`
+reloads gracefully: new workers start before the old ones finish their
+requests. Each worker keeps its own metrics and writes a snapshot to
+METRICS_DIR (a fresh temporary directory unless set), so /metrics on any
+worker reports the sum over all of them.
+
+For the async server, run GUNICORN_APP=asgi_server:app with
+GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker.
+"""
+
+import glob
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+# The config is loaded before the app, from wherever gunicorn was started
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import hot_state
+
+wsgi_app = os.environ.get('GUNICORN_APP', 'api_server_NEW:app')
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+workers = int(os.environ.get('GUNICORN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+# Workers import the app themselves, so pools, listener threads and
+# sockets are never shared across a fork
+preload_app = False
+
+# SSE and NDJSON streams hold a request open; gthread workers heartbeat
+# from the main thread, so a long stream doesn't trip the timeout
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+
+# One pool per worker, sized to the threads that share it
+os.environ.setdefault('TIMESCALE_POOL_MAX', str(threads + 2))
+
+# Every open dashboard tab holds one thread for /api/stream, so a gthread
+# deployment serves at most workers x STREAM_MAX_CONCURRENT tabs (503 above
+# that; the dashboard then polls). Half the threads are left for the other
+# routes. For more tabs than that, run the uvicorn worker, where streams are
+# coroutines and don't hold a thread.
+os.environ.setdefault('STREAM_MAX_CONCURRENT', str(max(threads // 2, 1)))
+
+_own_metrics_dir = None
+
+def on_starting(server):
+    global _own_metrics_dir
+    segment = hot_state.init()
+    server.log.info(f"Hot state: {segment.slots} slots x {segment.slot_size} bytes in shared memory")
+    # Set before the workers fork so they all write to the same directory;
+    # snapshots left by an earlier run would be counted again, so clear them
+    if os.environ.get('METRICS_DIR'):
+        os.makedirs(os.environ['METRICS_DIR'], exist_ok=True)
+        for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], 'metrics_*.json')):
+            os.remove(path)
+    else:
+        _own_metrics_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='poptop-metrics-')
+    server.log.info(f"Metrics snapshots in {os.environ['METRICS_DIR']}")
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} started ({threads} threads)")
+
+def worker_exit(server, worker):
+    import metrics
+    from db_pool import timescale_pool
+    # Keep what this worker counted after it is recycled
+    metrics.dump()
+    timescale_pool.closeall()
+
+def on_exit(server):
+    if hot_state.hot_state is not None:
+        hot_state.hot_state.close()
+    if _own_metrics_dir:
+        shutil.rmtree(_own_metrics_dir, ignore_errors=True)
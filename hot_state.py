@@ -0,0 +1,265 @@
+"""
+POPTOP Hot State - Latest record and device list shared by all workers
+A shared-memory segment, created by the gunicorn master before it forks
+(or by the process itself when running single-process), holds one slot
+per device: IMEI, VIN, time of the newest row, and the serialized
+/api/latest response for it. Any worker that builds a latest response
+stores it; every worker can then answer from the segment without a query.
+Telemetry notifications update a device's time and drop its stored
+response, so stale bodies are never served.
+
+Slots are found by open addressing on crc32(imei). Writers serialize on a
+process-shared lock; readers take no lock and retry when a slot's sequence
+number shows a write in progress (a seqlock).
+
+Every worker's listener registers its pid while connected. The table only
+misses notifications when no listener was connected at all, so it is
+cleared when a listener connects and finds no other live one registered.
+"""
+
+import multiprocessing
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+from multiprocessing import shared_memory
+
+SLOTS = int(os.environ.get('HOT_STATE_SLOTS', 2048))
+SLOT_SIZE = int(os.environ.get('HOT_STATE_SLOT_SIZE', 16384))
+
+# Segment header: magic, slots, slot size, devices seeded flag, clears
+_HEADER = struct.Struct('<IIIIQ')
+_MAGIC = 0x504F5054
+# Pids of the workers whose telemetry listener is connected (0 = free)
+MAX_LISTENERS = 64
+_LISTENERS = struct.Struct(f'<{MAX_LISTENERS}I')
+_DATA = _HEADER.size + _LISTENERS.size
+# Slot header: sequence, imei, vin, newest row time (µs since epoch), body length
+_SLOT = struct.Struct('<I20s20sqI')
+
+_READ_RETRIES = 5
+
+def to_micros(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    delta = dt - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+def _key(imei):
+    return imei.encode()[:20].ljust(20, b'\0')
+
+def from_micros(micros):
+    return datetime.fromtimestamp(micros // 1_000_000, tz=timezone.utc).replace(microsecond=micros % 1_000_000)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class HotState:
+    """Fixed-size table of per-device slots in shared memory"""
+
+    def __init__(self, slots=SLOTS, slot_size=SLOT_SIZE):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_body = slot_size - _SLOT.size
+        self._shm = shared_memory.SharedMemory(create=True, size=_DATA + slots * slot_size)
+        self._buf = self._shm.buf
+        self._lock = multiprocessing.Lock()
+        self._owner = os.getpid()
+        _HEADER.pack_into(self._buf, 0, _MAGIC, slots, slot_size, 0, 0)
+        # Per-process counters
+        self.hits = 0
+        self.misses = 0
+        self._full_logged = False
+
+    def _offset(self, index):
+        return _DATA + index * self.slot_size
+
+    def _set_seeded(self, seeded):
+        magic, slots, slot_size, _, clears = _HEADER.unpack_from(self._buf, 0)
+        _HEADER.pack_into(self._buf, 0, magic, slots, slot_size, int(seeded), clears)
+
+    def _find(self, key, create=False):
+        """Slot index holding key (or the free slot for it when create), else None"""
+        start = zlib.crc32(key) % self.slots
+        for probe in range(self.slots):
+            index = (start + probe) % self.slots
+            slot_key = bytes(self._buf[self._offset(index) + 4:self._offset(index) + 24])
+            if slot_key == key:
+                return index
+            if slot_key == bytes(20):
+                return index if create else None
+        return None
+
+    def _read(self, index):
+        """(imei, vin, time_us, body) of a slot, consistent with one write"""
+        offset = self._offset(index)
+        for _ in range(_READ_RETRIES):
+            seq, imei, vin, time_us, length = _SLOT.unpack_from(self._buf, offset)
+            if seq % 2:
+                continue
+            body = bytes(self._buf[offset + _SLOT.size:offset + _SLOT.size + length]) if length else None
+            if _SLOT.unpack_from(self._buf, offset)[0] == seq:
+                return imei.rstrip(b'\0').decode(), vin.rstrip(b'\0').decode(), time_us, body
+        return None
+
+    def _write(self, index, key, vin, time_us, body):
+        offset = self._offset(index)
+        seq = _SLOT.unpack_from(self._buf, offset)[0]
+        struct.pack_into('<I', self._buf, offset, seq + 1)
+        if body:
+            self._buf[offset + _SLOT.size:offset + _SLOT.size + len(body)] = body
+        _SLOT.pack_into(self._buf, offset, seq + 1, key, vin.encode()[:20], time_us, len(body or b''))
+        struct.pack_into('<I', self._buf, offset, seq + 2)
+
+    def get_latest(self, imei):
+        """(body, newest time) for a device, body None when no response is stored"""
+        index = self._find(_key(imei))
+        slot = self._read(index) if index is not None else None
+        if slot is None or not slot[2]:
+            self.misses += 1
+            return None, None
+        if slot[3] is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return slot[3], from_micros(slot[2])
+
+    def newest(self, imei):
+        """Time of the device's newest announced row, or None"""
+        index = self._find(_key(imei))
+        slot = self._read(index) if index is not None else None
+        return from_micros(slot[2]) if slot and slot[2] else None
+
+    def set_latest(self, imei, vin, newest, body):
+        """Store a latest response built from the row at `newest` unless a newer row was announced"""
+        if len(body) > self.max_body:
+            return
+        key = _key(imei)
+        time_us = to_micros(newest)
+        with self._lock:
+            index = self._find(key, create=True)
+            if index is None:
+                return  # table full
+            current = _SLOT.unpack_from(self._buf, self._offset(index))
+            if current[3] > time_us:
+                return
+            self._write(index, key, vin or '', time_us, body)
+
+    def touch(self, imei, vin, newest):
+        """
+        A new row arrived: record its time and drop the stored response.
+        Returns False when the table is full; the device list is then
+        incomplete, so it is no longer served from here.
+        """
+        key = _key(imei)
+        time_us = to_micros(newest)
+        with self._lock:
+            index = self._find(key, create=True)
+            if index is None:
+                self._set_seeded(False)
+                return False
+            if _SLOT.unpack_from(self._buf, self._offset(index))[3] <= time_us:
+                self._write(index, key, vin or '', time_us, None)
+            return True
+
+    def seed_devices(self, rows):
+        """Register (imei, vin, last_seen) rows and mark the device list complete if they all fit"""
+        complete = True
+        for imei, vin, last_seen in rows:
+            if last_seen is not None and not self.touch(imei, vin, last_seen):
+                complete = False
+        if not complete:
+            if not self._full_logged:
+                print(f"Hot state is full ({self.slots} slots); the device list is read from Timescale. "
+                      "Raise HOT_STATE_SLOTS.")
+                self._full_logged = True
+            return
+        with self._lock:
+            self._set_seeded(True)
+
+    def devices(self, since):
+        """[(imei, vin, last_seen)] seen after since, newest first; None until seeded"""
+        if not _HEADER.unpack_from(self._buf, 0)[3]:
+            return None
+        since_us = to_micros(since)
+        devices = []
+        for index in range(self.slots):
+            slot = self._read(index)
+            if slot and slot[0] and slot[2] > since_us:
+                devices.append((slot[0], slot[1] or None, from_micros(slot[2])))
+        devices.sort(key=lambda device: device[2], reverse=True)
+        return devices
+
+    def clear(self):
+        """Forget everything (e.g. after notifications may have been missed)"""
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._buf[_DATA:] = bytes(self.slots * self.slot_size)
+        magic, slots, slot_size, _, clears = _HEADER.unpack_from(self._buf, 0)
+        _HEADER.pack_into(self._buf, 0, magic, slots, slot_size, 0, clears + 1)
+
+    def _listeners(self):
+        return [pid for pid in _LISTENERS.unpack_from(self._buf, _HEADER.size) if pid]
+
+    def _set_listeners(self, pids):
+        pids = pids[:MAX_LISTENERS]
+        _LISTENERS.pack_into(self._buf, _HEADER.size, *pids, *[0] * (MAX_LISTENERS - len(pids)))
+
+    def listener_connected(self, pid=None):
+        """
+        Register a process's (re)connected listener. Returns True when the
+        table was cleared because no other live listener was registered,
+        i.e. notifications may have gone unseen by every worker.
+        """
+        pid = pid or os.getpid()
+        with self._lock:
+            # Workers that died without unregistering are dropped here
+            others = [other for other in self._listeners() if other != pid and _alive(other)]
+            if not others:
+                self._clear()
+            self._set_listeners(others + [pid])
+            return not others
+
+    def listener_disconnected(self, pid=None):
+        pid = pid or os.getpid()
+        with self._lock:
+            self._set_listeners([other for other in self._listeners() if other != pid])
+
+    def stats(self):
+        used = sum(1 for index in range(self.slots)
+                   if bytes(self._buf[self._offset(index) + 4:self._offset(index) + 5]) != b'\0')
+        header = _HEADER.unpack_from(self._buf, 0)
+        return {
+            'slots': self.slots,
+            'used': used,
+            'devices_seeded': bool(header[3]),
+            'clears': header[4],
+            'listeners': len(self._listeners()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'pid': os.getpid()
+        }
+
+    def close(self):
+        """Release the segment; the creating process also removes it"""
+        self._buf = None
+        self._shm.close()
+        if os.getpid() == self._owner:
+            self._shm.unlink()
+
+hot_state = None
+
+def init(slots=SLOTS, slot_size=SLOT_SIZE):
+    """Create the segment (gunicorn master before forking, or a single process)"""
+    global hot_state
+    if hot_state is None:
+        hot_state = HotState(slots, slot_size)
+    return hot_state
@@ -0,0 +1,101 @@
+"""
+POPTOP JSON Codec - One-pass serialization for API responses
+Decimal (DynamoDB items, NUMERIC columns), datetime/date and numpy scalars
+are converted inside the encoder, so responses no longer need a recursive
+pre-walk. orjson is used when installed (several times faster than the
+stdlib encoder and produces bytes directly); otherwise the stdlib encoder
+is used with the same conversions.
+
+    json_codec.init_app(app)             # Flask jsonify / request.json
+    json_codec.dumps(obj) -> bytes
+    json_codec.iter_lines(records)       # NDJSON chunks for streamed arrays
+"""
+
+import datetime
+import decimal
+import json
+import numbers
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is used without it
+    orjson = None
+
+BACKEND = 'orjson' if orjson else 'json'
+
+# Records encoded per yielded chunk when streaming
+STREAM_BATCH = 500
+
+def default(obj):
+    """Convert the non-JSON types our responses carry"""
+    if isinstance(obj, decimal.Decimal):
+        if obj.is_finite() and obj == obj.to_integral_value():
+            return int(obj)
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, numbers.Integral):
+        return int(obj)
+    if isinstance(obj, numbers.Real):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+_encoder = json.JSONEncoder(default=default, separators=(',', ':'), ensure_ascii=False)
+_sorted_encoder = json.JSONEncoder(default=default, separators=(',', ':'), ensure_ascii=False, sort_keys=True)
+
+if orjson:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def dumps(obj, sort_keys=False):
+    """Serialize to UTF-8 JSON bytes"""
+    if orjson:
+        try:
+            options = _OPTIONS | orjson.OPT_SORT_KEYS if sort_keys else _OPTIONS
+            return orjson.dumps(obj, default=default, option=options)
+        except TypeError:
+            # Beyond orjson's range (e.g. integers over 64 bits); the stdlib copes
+            pass
+    return (_sorted_encoder if sort_keys else _encoder).encode(obj).encode()
+
+def loads(data):
+    """Parse JSON from str or bytes"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def iter_lines(items, batch_size=STREAM_BATCH):
+    """Encode an iterable as NDJSON, yielding one bytes chunk per batch_size items"""
+    lines = []
+    for item in items:
+        lines.append(dumps(item))
+        if len(lines) == batch_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+def init_app(app):
+    """
+    Use this codec for jsonify and request parsing. Call before
+    metrics.init_app, which wraps whichever provider is installed.
+    """
+    from flask.json.provider import DefaultJSONProvider
+
+    class FastJSONProvider(DefaultJSONProvider):
+        # Keys stay in the order the endpoints build them
+        sort_keys = False
+
+        def dumps(self, obj, **kwargs):
+            return dumps(obj, sort_keys=kwargs.get('sort_keys', self.sort_keys)).decode()
+
+        def loads(self, s, **kwargs):
+            return loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(dumps(obj, sort_keys=self.sort_keys) + b'\n',
+                                            mimetype=self.mimetype)
+
+    app.json = FastJSONProvider(app)
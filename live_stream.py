@@ -0,0 +1,289 @@
+"""
+POPTOP Live Stream - Push new telemetry to connected dashboards
+A trigger on `telemetry` publishes every insert with pg_notify. One
+background thread LISTENs on a dedicated connection and fans each
+notification out to the subscribed streams, so any number of viewers
+share a single database subscription.
+
+The trigger is installed by migrate.py (install_trigger); replacing it
+locks the telemetry hypertable, so listeners only check that it exists.
+"""
+
+import asyncio
+import json
+import queue
+import select
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+from psycopg2 import extensions
+
+from db_pool import DB_CONFIG
+
+CHANNEL = 'telemetry'
+
+# Per-subscriber backlog; slow consumers drop their oldest records
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Reconnect delays for the listener connection
+RECONNECT_DELAY = 1.0
+RECONNECT_DELAY_MAX = 30.0
+
+# Only the columns needed by live views go in the payload (8000 byte limit)
+NOTIFY_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION notify_telemetry() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('telemetry', json_build_object(
+        'imei', NEW.imei,
+        'time', NEW.time,
+        'latitude', NEW.latitude,
+        'longitude', NEW.longitude,
+        'altitude', NEW.altitude,
+        'speed_kmh', NEW.speed_kmh,
+        'heading', NEW.heading,
+        'satellites', NEW.satellites,
+        'external_voltage_mv', NEW.external_voltage_mv,
+        'internal_voltage_mv', NEW.internal_voltage_mv,
+        'ignition', NEW.ignition,
+        'movement', NEW.movement,
+        'gsm_signal', NEW.gsm_signal,
+        'odometer_m', NEW.odometer_m,
+        'vin', NEW.vin
+    )::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS telemetry_notify ON telemetry;
+CREATE TRIGGER telemetry_notify
+    AFTER INSERT ON telemetry
+    FOR EACH ROW EXECUTE FUNCTION notify_telemetry();
+"""
+
+TRIGGER_EXISTS_SQL = """
+    SELECT 1 FROM pg_trigger
+    WHERE tgname = 'telemetry_notify' AND tgrelid = 'telemetry'::regclass
+"""
+
+def install_trigger(conn):
+    """Create (or replace) the notify trigger on telemetry"""
+    cursor = conn.cursor()
+    cursor.execute(NOTIFY_TRIGGER_SQL)
+    cursor.close()
+    conn.commit()
+
+def notification_to_record(payload):
+    """Convert a NOTIFY payload into the /api/latest record shape"""
+    row = json.loads(payload)
+    timestamp = int(datetime.fromisoformat(row['time']).timestamp() * 1000)
+    return {
+        'imei': row['imei'],
+        'vin': row['vin'] if row.get('vin') else 'Unknown',
+        'timestamp': timestamp,
+        'datetime': row['time'],
+        'priority': 0,
+        'gps': {
+            'latitude': float(row['latitude']) if row['latitude'] else 0,
+            'longitude': float(row['longitude']) if row['longitude'] else 0,
+            'altitude': int(row['altitude']) if row['altitude'] else 0,
+            'angle': int(row['heading']) if row['heading'] else 0,
+            'satellites': int(row['satellites']) if row['satellites'] else 0,
+            'speed_kmh': float(row['speed_kmh']) if row['speed_kmh'] else 0,
+            'valid': (row['satellites'] or 0) > 0
+        },
+        'io': {
+            'ignition': {'id': 239, 'value': 1 if row['ignition'] else 0, 'description': 'Ignition'},
+            'movement': {'id': 240, 'value': 1 if row['movement'] else 0, 'description': 'Movement'},
+            'external_voltage': {'id': 66, 'value': row['external_voltage_mv'], 'description': 'External Voltage (mV)'},
+            'battery_voltage': {'id': 67, 'value': row['internal_voltage_mv'], 'description': 'Battery Voltage (mV)'},
+            'gsm_signal': {'id': 21, 'value': row['gsm_signal'], 'description': 'GSM Signal Strength'},
+            'total_odometer': {'id': 16, 'value': row['odometer_m'], 'description': 'Total Odometer (m)'},
+        }
+    }
+
+class Subscription:
+    """A bounded queue of records for one stream, optionally for one IMEI"""
+
+    def __init__(self, imei=None):
+        self.imei = imei
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, record):
+        if self.imei and record['imei'] != self.imei:
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """Next record, or None if nothing arrived within the timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AsyncSubscription(Subscription):
+    """A subscription consumed from an asyncio event loop (asgi_server.py)"""
+
+    def __init__(self, loop, imei=None):
+        self.imei = imei
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, record):
+        # Called from the listener thread; hand the record to the loop
+        if self.imei and record['imei'] != self.imei:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._put, record)
+        except RuntimeError:
+            pass  # loop closed
+
+    def _put(self, record):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(record)
+
+    async def get(self, timeout=None):
+        """Next record, or None if nothing arrived within the timeout"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class TelemetryListener:
+    """Single LISTEN connection fanned out to every subscription"""
+
+    def __init__(self, channel=CHANNEL):
+        self.channel = channel
+        self._subscribers = set()
+        self._callbacks = []
+        self._connection_callbacks = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self.connected = False
+        # Incremented on every (re)connect; notifications sent while
+        # disconnected are lost, so state derived from them is stale
+        self.generation = 0
+        self.notifications = 0
+
+    def start(self):
+        """Start the listener thread if it isn't running yet"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='telemetry-listener', daemon=True)
+                self._thread.start()
+
+    def add_callback(self, callback):
+        """Call callback(record) from the listener thread for every notification"""
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def add_connection_callback(self, callback):
+        """
+        Call callback(connected) from the listener thread after LISTEN
+        succeeds (before any notification of that connection is handled)
+        and after the connection is lost
+        """
+        with self._lock:
+            self._connection_callbacks.append(callback)
+
+    def _notify_connection(self, connected):
+        with self._lock:
+            callbacks = list(self._connection_callbacks)
+        for callback in callbacks:
+            try:
+                callback(connected)
+            except Exception as e:
+                print(f"Telemetry connection callback error: {e}")
+
+    def subscribe(self, imei=None):
+        return self.attach(Subscription(imei))
+
+    def attach(self, subscription):
+        """Start delivering records to an existing subscription"""
+        with self._lock:
+            self._subscribers.add(subscription)
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        with self._lock:
+            subscribers = len(self._subscribers)
+        return {
+            'connected': self.connected,
+            'subscribers': subscribers,
+            'generation': self.generation,
+            'notifications': self.notifications
+        }
+
+    def _publish(self, payload):
+        try:
+            record = notification_to_record(payload)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring malformed telemetry notification: {e}")
+            return
+        self.notifications += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(record)
+            except Exception as e:
+                print(f"Telemetry callback error: {e}")
+        for subscription in subscribers:
+            subscription.put(record)
+
+    def _listen(self):
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            cursor.execute(TRIGGER_EXISTS_SQL)
+            if cursor.fetchone() is None:
+                print("Warning: telemetry_notify trigger is missing, run migrate.py; no live updates will arrive")
+            cursor.execute(f"LISTEN {self.channel}")
+            cursor.close()
+            self._notify_connection(True)
+            self.generation += 1
+            self.connected = True
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._publish(conn.notifies.pop(0).payload)
+        finally:
+            if self.connected:
+                self.connected = False
+                self._notify_connection(False)
+            conn.close()
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            started = time.monotonic()
+            try:
+                self._listen()
+            except Exception as e:
+                print(f"Telemetry listener error: {e}")
+            # Reset the backoff once a connection has stayed up for a while
+            if time.monotonic() - started > RECONNECT_DELAY_MAX:
+                delay = RECONNECT_DELAY
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+telemetry_listener = TelemetryListener()
@@ -0,0 +1,305 @@
+"""
+POPTOP Metrics - Request, query and serialization instrumentation
+Histograms and counters are kept in-process and rendered in the Prometheus
+text format at /metrics:
+
+- http_request_duration_seconds / http_response_size_bytes per route
+- db_query_duration_seconds / db_query_rows per statement (TimedCursor)
+- stage_duration_seconds for named stages (pool checkout, trip update,
+  JSON serialization, ...) timed with `with timed('stage'):`
+- background_errors_total for failed passes of the trip updater and
+  geofence threads
+
+Requests slower than SLOW_REQUEST_MS are logged with their breakdown.
+
+Each gunicorn worker records into its own registry. With METRICS_DIR set
+(gunicorn.conf.py points it at a fresh directory), every worker writes a
+snapshot there at most every METRICS_DUMP_SECONDS and /metrics sums the
+snapshots of all workers, past and present, so whichever worker answers a
+scrape reports the whole server. Without METRICS_DIR only the answering
+process is reported.
+"""
+
+import contextvars
+import glob
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2 import extensions
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+METRICS_DUMP_SECONDS = float(os.environ.get('METRICS_DUMP_SECONDS', 5))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# Per-request accumulator: {'queries', 'query_seconds', 'rows', 'stages'}
+_request = contextvars.ContextVar('request_metrics', default=None)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sort_key(item):
+    return tuple(str(value) for value in item[0])
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+        _maybe_dump()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), value] for label_values, value in self._values.items()]
+
+    def render(self, snapshots=None):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        values = {}
+        for snapshot in snapshots if snapshots is not None else [self.snapshot()]:
+            for label_values, value in snapshot:
+                key = tuple(label_values)
+                values[key] = values.get(key, 0) + value
+        for label_values, value in sorted(values.items(), key=_sort_key):
+            lines.append(f'{self.name}{_labels(self.labels, label_values)} {value}')
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+        _maybe_dump()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), list(series)] for label_values, series in self._series.items()]
+
+    def render(self, snapshots=None):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        merged = {}
+        for snapshot in snapshots if snapshots is not None else [self.snapshot()]:
+            for label_values, series in snapshot:
+                key = tuple(label_values)
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = list(series)
+                elif len(total) == len(series):
+                    merged[key] = [a + b for a, b in zip(total, series)]
+        for label_values, series in sorted(merged.items(), key=_sort_key):
+            for bound, count in zip(self.buckets, series):
+                le = _labels(self.labels, label_values, [('le', bound)])
+                lines.append(f'{self.name}_bucket{le} {count}')
+            le = _labels(self.labels, label_values, [('le', '+Inf')])
+            lines.append(f'{self.name}_bucket{le} {series[-1]}')
+            base = _labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{base} {round(series[-2], 6)}')
+            lines.append(f'{self.name}_count{base} {series[-1]}')
+        return lines
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Request latency',
+                             ('route', 'method', 'status'))
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Response body size',
+                          ('route',), SIZE_BUCKETS)
+QUERY_DURATION = Histogram('db_query_duration_seconds', 'Query execution time', ('statement',))
+QUERY_ROWS = Histogram('db_query_rows', 'Rows returned or affected per query', ('statement',), ROW_BUCKETS)
+STAGE_DURATION = Histogram('stage_duration_seconds', 'Time spent in named stages', ('stage',))
+SLOW_REQUESTS = Counter('http_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS', ('route',))
+BACKGROUND_ERRORS = Counter('background_errors_total', 'Failed passes of background threads', ('task',))
+
+REGISTRY = [REQUEST_DURATION, RESPONSE_SIZE, QUERY_DURATION, QUERY_ROWS, STAGE_DURATION, SLOW_REQUESTS,
+            BACKGROUND_ERRORS]
+
+_dump_lock = threading.Lock()
+_last_dump = 0.0
+
+def _snapshot_path(pid=None):
+    return os.path.join(os.environ['METRICS_DIR'], f'metrics_{pid or os.getpid()}.json')
+
+def dump():
+    """Write this process's registry to METRICS_DIR (no-op without it)"""
+    global _last_dump
+    if not os.environ.get('METRICS_DIR'):
+        return
+    with _dump_lock:
+        _last_dump = time.monotonic()
+        path = _snapshot_path()
+        tmp = f'{path}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({metric.name: metric.snapshot() for metric in REGISTRY}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Metrics snapshot failed: {e}")
+
+def _maybe_dump():
+    if os.environ.get('METRICS_DIR') and time.monotonic() - _last_dump >= METRICS_DUMP_SECONDS:
+        if not _dump_lock.locked():
+            dump()
+
+def _load_snapshots():
+    """Every worker's last snapshot, this process's one fresh"""
+    dump()
+    own = _snapshot_path()
+    snapshots = []
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], 'metrics_*.json')):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Skipping metrics snapshot {path}: {e}")
+    snapshots.append({metric.name: metric.snapshot() for metric in REGISTRY})
+    return snapshots
+
+def render():
+    """All metrics in the Prometheus text exposition format, summed over workers"""
+    snapshots = _load_snapshots() if os.environ.get('METRICS_DIR') else None
+    lines = []
+    for metric in REGISTRY:
+        if snapshots is None:
+            lines.extend(metric.render())
+        else:
+            lines.extend(metric.render([s.get(metric.name, []) for s in snapshots]))
+    return '\n'.join(lines) + '\n'
+
+_STATEMENT = re.compile(r'\b(SELECT|INSERT|UPDATE|DELETE|COPY|CREATE|DECLARE|CALL|LISTEN)\b', re.I)
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|COPY|ON)\s+([a-z_][a-z0-9_]*)', re.I)
+
+def statement_label(sql):
+    """Low-cardinality label for a query: verb and first table, e.g. select:telemetry"""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    verb = _STATEMENT.search(sql)
+    table = _TABLE.search(sql)
+    return f"{verb.group(1).lower() if verb else 'other'}:{table.group(1).lower() if table else '-'}"
+
+def _record_query(sql, elapsed, rows):
+    label = statement_label(sql)
+    QUERY_DURATION.observe(elapsed, label)
+    QUERY_ROWS.observe(max(rows, 0), label)
+    current = _request.get()
+    if current is not None:
+        current['queries'] += 1
+        current['query_seconds'] += elapsed
+        current['rows'] += max(rows, 0)
+
+class TimedCursor(extensions.cursor):
+    """psycopg2 cursor that records execution time and row counts"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record_query(query, time.perf_counter() - started, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _record_query(query, time.perf_counter() - started, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _record_query(sql, time.perf_counter() - started, self.rowcount)
+
+@contextmanager
+def timed(stage):
+    """Time a block as a named stage (also added to the current request's breakdown)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_DURATION.observe(elapsed, stage)
+        current = _request.get()
+        if current is not None:
+            current['stages'][stage] = current['stages'].get(stage, 0) + elapsed
+
+def init_app(app):
+    """Instrument a Flask app: request hooks, timed JSON serialization and /metrics"""
+    from flask import Response, g, request
+
+    provider_class = type(app.json)
+
+    class TimedJSONProvider(provider_class):
+        def response(self, *args, **kwargs):
+            with timed('serialize'):
+                return super().response(*args, **kwargs)
+
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = _request.set({'queries': 0, 'query_seconds': 0.0, 'rows': 0, 'stages': {}})
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.pop('metrics_started', None)
+        token = g.pop('metrics_token', None)
+        if started is None:
+            return response
+        current = _request.get()
+        if token is not None:
+            _request.reset(token)
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_DURATION.observe(elapsed, route, request.method, response.status_code)
+        size = response.calculate_content_length()
+        if size is not None:
+            RESPONSE_SIZE.observe(size, route)
+        if elapsed * 1000 >= SLOW_REQUEST_MS:
+            SLOW_REQUESTS.inc(route)
+            stages = ', '.join(f'{name} {seconds * 1000:.1f}ms' for name, seconds in current['stages'].items())
+            print(f"SLOW {request.method} {request.full_path} {response.status_code} "
+                  f"{elapsed * 1000:.1f}ms: {current['queries']} queries "
+                  f"{current['query_seconds'] * 1000:.1f}ms, {current['rows']} rows, "
+                  f"{size if size is not None else 'streamed'} bytes"
+                  + (f", {stages}" if stages else ''))
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
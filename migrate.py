@@ -0,0 +1,75 @@
+"""
+POPTOP Migrations - Create the tables the API and ingest servers use
+Indexes, tables, hypertables, continuous aggregates, their refresh policies
+and the telemetry notify trigger are created here, once per deploy, never from a
+request or a listener connect:
+
+    python migrate.py
+
+Every step is idempotent, so running it again is harmless.
+"""
+
+import psycopg2
+
+import geofence
+import live_stream
+import telemetry_io
+import telemetry_rollups
+import trip_engine
+from db_pool import DB_CONFIG
+
+# Per-device "latest record" lookups (latest, fleet, history) use these
+TELEMETRY_INDEXES = {
+    'telemetry_imei_time_idx': 'ON telemetry (imei, time DESC)',
+}
+
+def ensure_telemetry_indexes(conn):
+    """
+    Build the telemetry indexes without blocking ingest. Hypertables don't
+    support CREATE INDEX CONCURRENTLY; Timescale builds their indexes one
+    chunk per transaction instead, so only the chunk being indexed is
+    locked. An interrupted build leaves an invalid index behind: drop it
+    and run again.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT 1 FROM timescaledb_information.hypertables
+            WHERE hypertable_name = 'telemetry'
+        """)
+        hypertable = cursor.fetchone() is not None
+        for name, definition in TELEMETRY_INDEXES.items():
+            if hypertable:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} {definition} WITH (timescaledb.transaction_per_chunk)")
+            else:
+                cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}")
+        cursor.close()
+    finally:
+        conn.autocommit = autocommit
+
+STEPS = [
+    ('telemetry indexes', ensure_telemetry_indexes),
+    ('trips', trip_engine.ensure_schema),
+    ('telemetry_io', telemetry_io.ensure_schema),
+    ('rollups', telemetry_rollups.ensure_schema),
+    ('geofences', geofence.ensure_schema),
+    ('notify trigger', live_stream.install_trigger),
+]
+
+def migrate(conn):
+    for name, step in STEPS:
+        print(f"Migrating {name}...")
+        step(conn)
+
+def main():
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        migrate(conn)
+        print("Done")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
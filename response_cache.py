@@ -0,0 +1,113 @@
+"""
+POPTOP Response Cache - In-process LRU cache for computed API responses
+Entries are keyed by endpoint, IMEI and query arguments, evicted least
+recently used once max_entries is reached, and expire after ttl seconds.
+invalidate(imei) drops every entry for a device when new telemetry for it
+arrives; entries stored under ANY_IMEI (requests that resolved the
+default device) are dropped on every invalidation.
+
+A response is computed before it is stored, so an invalidation can land in
+between. Callers take version(imei) before computing and pass it to set(),
+which then refuses to store a response that is already stale.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+ANY_IMEI = '*'
+
+CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1024))
+CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+class ResponseCache:
+    """Size-bounded LRU with TTL and per-IMEI invalidation"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (expires_at, imei, value)
+        self._by_imei = {}              # imei -> set of keys
+        self._versions = {}             # imei -> invalidations so far
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _remove(self, key):
+        _, imei, _ = self._entries.pop(key)
+        keys = self._by_imei.get(imei)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_imei[imei]
+
+    def get(self, key):
+        """Cached value, or None on a miss or expiry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def version(self, imei):
+        """Invalidation counter for an IMEI (any invalidation counts for ANY_IMEI)"""
+        with self._lock:
+            return self._versions.get(imei, 0)
+
+    def set(self, key, imei, value, version=None):
+        """
+        Store a value. With version (from version(imei) before the value was
+        computed), nothing is stored if the IMEI was invalidated since;
+        returns whether the value was stored.
+        """
+        with self._lock:
+            if version is not None and self._versions.get(imei, 0) != version:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, imei, value)
+            self._by_imei.setdefault(imei, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def invalidate(self, imei):
+        """Drop every entry for this device and for the default device"""
+        with self._lock:
+            for target in (imei, ANY_IMEI):
+                for key in list(self._by_imei.get(target, ())):
+                    self._remove(key)
+                self._versions[target] = self._versions.get(target, 0) + 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_imei.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+response_cache = ResponseCache()
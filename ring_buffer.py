@@ -0,0 +1,302 @@
+"""
+POPTOP Ring Buffer - Recent telemetry of every device, in memory
+Each telemetry notification is appended to a fixed-size ring for its
+device: one numpy column per telemetry field, plus the IO elements of the
+newest row once a reader has fetched them. /api/latest and short
+/api/history windows are answered from the ring; windows reaching further
+back than it covers go to Timescale.
+
+A ring answers nothing until it has been seeded with the device's newest
+rows from the database. From then on it holds every row of the device at
+or after `complete_from`, which moves forward as the ring wraps. Rings are
+per worker process and are dropped whenever the telemetry listener
+reconnects, since notifications may have been missed.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from hot_state import from_micros, to_micros
+
+# Rows kept per device, and devices kept per worker (least recently used go first)
+SIZE = int(os.environ.get('RING_BUFFER_SIZE', 512))
+MAX_DEVICES = int(os.environ.get('RING_BUFFER_DEVICES', 2000))
+
+# Telemetry column -> (dtype, marker stored for NULL)
+COLUMNS = {
+    'latitude': (np.float64, np.nan),
+    'longitude': (np.float64, np.nan),
+    'altitude': (np.int32, np.iinfo(np.int32).min),
+    'speed_kmh': (np.float64, np.nan),
+    'heading': (np.int16, np.iinfo(np.int16).min),
+    'satellites': (np.int16, np.iinfo(np.int16).min),
+    'external_voltage_mv': (np.int32, np.iinfo(np.int32).min),
+    'internal_voltage_mv': (np.int32, np.iinfo(np.int32).min),
+    'ignition': (np.int8, np.iinfo(np.int8).min),
+    'movement': (np.int8, np.iinfo(np.int8).min),
+    'gsm_signal': (np.int16, np.iinfo(np.int16).min),
+    'odometer_m': (np.int64, np.iinfo(np.int64).min)
+}
+
+# The newest rows of a device; vin is kept per device, not per row
+SEED_SQL = f"""
+    SELECT time, {', '.join(COLUMNS)}, vin
+    FROM telemetry
+    WHERE imei = %s
+    ORDER BY time DESC
+    LIMIT %s
+"""
+
+def record_values(record):
+    """Column values (in COLUMNS order) of a notification record"""
+    gps = record['gps']
+    io = record['io']
+    return (
+        gps['latitude'], gps['longitude'], gps['altitude'], gps['speed_kmh'],
+        gps['angle'], gps['satellites'],
+        io['external_voltage']['value'], io['battery_voltage']['value'],
+        io['ignition']['value'], io['movement']['value'],
+        io['gsm_signal']['value'], io['total_odometer']['value']
+    )
+
+class DeviceRing:
+    """The last `size` rows of one device, in time order starting at `start`"""
+
+    def __init__(self, imei, size=SIZE):
+        self.imei = imei
+        self.size = size
+        self.times = np.zeros(size, np.int64)  # µs since epoch
+        self.columns = {name: np.full(size, missing, dtype) for name, (dtype, missing) in COLUMNS.items()}
+        self.start = 0
+        self.count = 0
+        self.vin = None
+        # Every row at or after this time (µs) is in the ring; None until seeded
+        self.complete_from = None
+        self.io_time = None
+        self.io_elements = None
+
+    def _order(self):
+        """Slot indices from oldest to newest"""
+        return (self.start + np.arange(self.count)) % self.size
+
+    def newest(self):
+        return int(self.times[(self.start + self.count - 1) % self.size]) if self.count else None
+
+    def _set(self, index, time_us, values):
+        self.times[index] = time_us
+        for (name, (_, missing)), value in zip(COLUMNS.items(), values):
+            self.columns[name][index] = missing if value is None else value
+
+    def add(self, time_us, values):
+        if self.complete_from is not None and time_us < self.complete_from:
+            return  # older than anything the ring vouches for
+        newest = self.newest()
+        if newest is not None and time_us <= newest:
+            self._insert(time_us, values)
+            return
+        if self.count == self.size:
+            index = self.start
+            self.start = (self.start + 1) % self.size
+        else:
+            index = (self.start + self.count) % self.size
+            self.count += 1
+        self._set(index, time_us, values)
+        if self.count == self.size and self.complete_from is not None:
+            self.complete_from = int(self.times[self.start])
+
+    def _insert(self, time_us, values):
+        """A late (buffered on the device) or repeated row: put it in time order"""
+        order = self._order()
+        times = self.times[order]
+        position = int(np.searchsorted(times, time_us))
+        if position < self.count and times[position] == time_us:
+            self._set(order[position], time_us, values)
+            return
+        times = np.insert(times, position, time_us)
+        columns = {name: np.insert(self.columns[name][order], position, missing if value is None else value)
+                   for (name, (_, missing)), value in zip(COLUMNS.items(), values)}
+        drop = max(len(times) - self.size, 0)
+        self.count = len(times) - drop
+        self.start = 0
+        self.times[:self.count] = times[drop:]
+        for name, column in columns.items():
+            self.columns[name][:self.count] = column[drop:]
+        if drop and self.complete_from is not None:
+            self.complete_from = int(self.times[0])
+
+    def seed(self, rows):
+        """
+        Fill the ring from SEED_SQL rows (newest first). Rows notified while
+        the query ran are kept: newer ones are appended again and repeats
+        of seeded rows are overwritten.
+        """
+        order = self._order()
+        pending = [(int(self.times[i]), [self.columns[name][i] for name in COLUMNS]) for i in order]
+        self.start = 0
+        self.count = 0
+        for row in reversed(rows):
+            self._set(self.count, to_micros(row[0]), row[1:-1])
+            self.count += 1
+        # Fewer rows than fit means the ring holds the device's whole history
+        self.complete_from = int(self.times[0]) if len(rows) >= self.size else 0
+        if rows and rows[0][-1] and self.vin is None:
+            self.vin = rows[0][-1]
+        for time_us, values in pending:
+            self.add(time_us, values)
+
+    def _column(self, name, indices):
+        values = self.columns[name][indices]
+        missing = np.isnan(values) if values.dtype.kind == 'f' else values == COLUMNS[name][1]
+        if not missing.any():
+            return values.tolist()
+        return [None if null else value for value, null in zip(values.tolist(), missing.tolist())]
+
+    def _rows(self, indices, columns):
+        """(time, *columns) tuples for the given slots"""
+        values = [[from_micros(t) for t in self.times[indices].tolist()]]
+        for name in columns:
+            if name == 'imei':
+                values.append([self.imei] * len(indices))
+            elif name == 'vin':
+                values.append([self.vin] * len(indices))
+            else:
+                values.append(self._column(name, indices))
+        return list(zip(*values))
+
+    def latest(self, columns):
+        if self.complete_from is None or not self.count:
+            return None
+        return self._rows([(self.start + self.count - 1) % self.size], columns)[0]
+
+    def rows(self, columns, since_us, limit):
+        """
+        Rows at or after since_us, newest first and at most limit of them,
+        or None when the answer could include rows the ring doesn't hold
+        """
+        if self.complete_from is None:
+            return None
+        order = self._order()[::-1]
+        times = self.times[order]
+        if since_us >= self.complete_from:
+            count = int(np.count_nonzero(times >= since_us))
+        else:
+            # The window starts before the ring's horizon; only a full page
+            # of rows inside it is a complete answer
+            count = int(np.count_nonzero(times >= self.complete_from))
+            if count < limit:
+                return None
+        return self._rows(order[:min(count, limit)], columns)
+
+class RingBuffers:
+    """A DeviceRing per IMEI, fed by the telemetry listener"""
+
+    def __init__(self, size=SIZE, max_devices=MAX_DEVICES):
+        self.size = size
+        self.max_devices = max_devices
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.seeds = 0
+
+    def _ring(self, imei, create=False):
+        ring = self._rings.get(imei)
+        if ring is None and create:
+            ring = self._rings[imei] = DeviceRing(imei, self.size)
+            if len(self._rings) > self.max_devices:
+                self._rings.popitem(last=False)
+        if ring is not None:
+            self._rings.move_to_end(imei)
+        return ring
+
+    def on_record(self, record):
+        """Listener callback: append a notified row to its device's ring"""
+        time_us = to_micros(datetime.fromisoformat(record['datetime']))
+        with self._lock:
+            ring = self._ring(record['imei'], create=True)
+            ring.add(time_us, record_values(record))
+            if record['vin'] != 'Unknown':
+                ring.vin = record['vin']
+
+    def sync(self, generation):
+        """Drop every ring when the listener has reconnected since the last call"""
+        with self._lock:
+            if generation != self.generation:
+                self._rings.clear()
+                self.generation = generation
+
+    def seed(self, cursor, imei):
+        """Seed a device's ring from Timescale unless that's already done"""
+        with self._lock:
+            ring = self._rings.get(imei)
+            if ring is not None and ring.complete_from is not None:
+                return
+            generation = self.generation
+        cursor.execute(SEED_SQL, (imei, self.size))
+        rows = cursor.fetchall()
+        with self._lock:
+            # A reconnect while the query ran may have lost notifications
+            if generation != self.generation:
+                return
+            ring = self._ring(imei, create=True)
+            if ring.complete_from is None:
+                ring.seed(rows)
+                self.seeds += 1
+
+    def latest(self, imei, columns):
+        """(time, *columns) of the device's newest row, or None"""
+        with self._lock:
+            ring = self._ring(imei)
+            row = ring.latest(columns) if ring is not None else None
+            self._count(row is not None)
+        return row
+
+    def rows(self, imei, columns, since, limit):
+        """(time, *columns) rows at or after since, newest first, or None beyond the ring's horizon"""
+        with self._lock:
+            ring = self._ring(imei)
+            rows = ring.rows(columns, to_micros(since), limit) if ring is not None else None
+            self._count(rows is not None)
+        return rows
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def io_snapshot(self, imei, time):
+        """IO elements of the device's newest row if that's the row at time, else None"""
+        with self._lock:
+            ring = self._ring(imei)
+            if ring is None or ring.io_time != to_micros(time):
+                return None
+            return ring.io_elements
+
+    def set_io(self, imei, time, io_elements):
+        """Keep the IO elements of the row at time if it is the device's newest"""
+        time_us = to_micros(time)
+        with self._lock:
+            ring = self._ring(imei)
+            if ring is not None and ring.newest() == time_us:
+                ring.io_time = time_us
+                ring.io_elements = io_elements
+
+    def stats(self):
+        with self._lock:
+            seeded = sum(1 for ring in self._rings.values() if ring.complete_from is not None)
+            return {
+                'devices': len(self._rings),
+                'seeded': seeded,
+                'size': self.size,
+                'seeds': self.seeds,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+ring_buffer = RingBuffers()
@@ -0,0 +1,243 @@
+"""
+POPTOP Telemetry Export - Bulk extraction as CSV, Arrow IPC or Parquet
+Streams a time range for a set of devices (or all of them) straight from a
+server-side cursor, one row group of ROW_GROUP_SIZE rows at a time, so
+memory stays bounded for any range. IO elements from telemetry_io become
+typed columns (unsigned integers, or strings for variable-length values).
+Arrow IPC and Parquet need pyarrow; CSV works without it.
+
+    python telemetry_export.py --start 2025-01-01 --end 2025-02-01 \\
+        --format parquet -o january.parquet [--imei IMEI ...] [--io NAME ...]
+"""
+
+import argparse
+import csv
+import io
+import sys
+from datetime import datetime, timedelta, timezone
+
+import telemetry_io
+from telemetry_sink import TELEMETRY_COLUMNS
+from teltonika_codec import get_io_info
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional; only needed for the arrow and parquet formats
+    pa = pq = None
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
+
+# Rows per server-side cursor round trip and per Parquet row group / Arrow batch
+ROW_GROUP_SIZE = 50000
+
+EXPORT_COLUMNS = tuple(column for column in TELEMETRY_COLUMNS if column != 'raw_json')
+
+# IO elements already exported as telemetry columns
+CORE_IO_IDS = {16, 21, 66, 67, 239, 240, 256}
+
+FLOAT_COLUMNS = {'latitude', 'longitude', 'speed_kmh'}
+INT_COLUMNS = {'altitude', 'heading', 'satellites', 'external_voltage_mv',
+               'internal_voltage_mv', 'gsm_signal', 'odometer_m'}
+
+def _arrow_type(column):
+    if column == 'time':
+        return pa.timestamp('us', tz='UTC')
+    if column in FLOAT_COLUMNS:
+        return pa.float64()
+    if column in INT_COLUMNS:
+        return pa.int64()
+    if column in ('ignition', 'movement'):
+        return pa.bool_()
+    return pa.string()
+
+class ExportError(Exception):
+    """Export request that can't be served (bad format, missing pyarrow)"""
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format {fmt!r} (expected one of {', '.join(FORMATS)})")
+    if fmt != 'csv' and pa is None:
+        raise ExportError(f"The {fmt} format needs pyarrow (pip install pyarrow)")
+
+def discover_io_columns(cursor, imeis, start, end, io_ids=None):
+    """
+    IO elements present in the range: [(io_id, column name, is_text)].
+    Rows that were never decoded into telemetry_io (see
+    telemetry_io.backfill) don't contribute columns.
+    """
+    conditions = ['time >= %s', 'time < %s']
+    params = [start, end]
+    if imeis:
+        conditions.append('imei = ANY(%s)')
+        params.append(list(imeis))
+    if io_ids is not None:
+        conditions.append('io_id = ANY(%s)')
+        params.append(list(io_ids))
+    cursor.execute(f"""
+        SELECT io_id, bool_or(value_text IS NOT NULL)
+        FROM telemetry_io
+        WHERE {' AND '.join(conditions)}
+        GROUP BY io_id
+        ORDER BY io_id
+    """, params)
+    return [(io_id, get_io_info(io_id)['name'], is_text)
+            for io_id, is_text in cursor.fetchall() if io_id not in CORE_IO_IDS]
+
+def iter_row_groups(conn, imeis, start, end, io_columns, group_size=ROW_GROUP_SIZE):
+    """Yield lists of flattened rows (EXPORT_COLUMNS, then one value per IO column)"""
+    conditions = ['time >= %s', 'time < %s']
+    params = [start, end]
+    if imeis:
+        conditions.append('imei = ANY(%s)')
+        params.append(list(imeis))
+    cursor = conn.cursor(name='telemetry_export')
+    io_cursor = conn.cursor()
+    io_ids = [io_id for io_id, _, _ in io_columns]
+    converters = [float if column in FLOAT_COLUMNS else int if column in INT_COLUMNS else None
+                  for column in EXPORT_COLUMNS]
+    try:
+        cursor.execute(f"""
+            SELECT {', '.join(EXPORT_COLUMNS)}
+            FROM telemetry
+            WHERE {' AND '.join(conditions)}
+            ORDER BY time, imei
+        """, params)
+        while True:
+            rows = cursor.fetchmany(group_size)
+            if not rows:
+                return
+            io_map = {}
+            if io_ids:
+                io_map = telemetry_io.fetch_io(io_cursor, [(row[1], row[0]) for row in rows], io_ids)
+            group = []
+            for row in rows:
+                values = [value if value is None or convert is None else convert(value)
+                          for value, convert in zip(row, converters)]
+                by_id = {element['id']: element['value']
+                         for element in io_map.get((row[1], row[0]), {}).values()}
+                values.extend(by_id.get(io_id) for io_id in io_ids)
+                group.append(values)
+            yield group
+    finally:
+        cursor.close()
+        io_cursor.close()
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose contents are collected with take()"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _csv_chunks(groups, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for group in groups:
+        writer.writerows(group)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+def _arrow_chunks(groups, columns, io_columns, fmt):
+    types = [_arrow_type(column) for column in EXPORT_COLUMNS]
+    types += [pa.string() if is_text else pa.uint64() for _, _, is_text in io_columns]
+    schema = pa.schema(list(zip(columns, types)))
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    for group in groups:
+        arrays = [pa.array(values, type=type_) for values, type_ in zip(zip(*group), types)]
+        batch = pa.record_batch(arrays, schema=schema)
+        if fmt == 'parquet':
+            # One row group per cursor batch
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+def export(conn, fmt, start, end, imeis=None, io_ids=None, group_size=ROW_GROUP_SIZE):
+    """Generate the export file as a stream of bytes chunks"""
+    check_format(fmt)
+    cursor = conn.cursor()
+    io_columns = discover_io_columns(cursor, imeis, start, end, io_ids)
+    cursor.close()
+    columns = list(EXPORT_COLUMNS) + [name for _, name, _ in io_columns]
+    groups = iter_row_groups(conn, imeis, start, end, io_columns, group_size)
+    if fmt == 'csv':
+        return _csv_chunks(groups, columns)
+    return _arrow_chunks(groups, columns, io_columns, fmt)
+
+def parse_time(value):
+    """ISO date/time; naive values are taken as UTC"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export telemetry as CSV, Arrow IPC or Parquet')
+    parser.add_argument('--start', type=parse_time, help='ISO start (default: 24 hours ago)')
+    parser.add_argument('--end', type=parse_time, help='ISO end, exclusive (default: now)')
+    parser.add_argument('--imei', action='append', help='device to export (repeatable; default all)')
+    parser.add_argument('--io', action='append', help='IO element name or io_<id> (repeatable; default all)')
+    parser.add_argument('--format', choices=list(FORMATS), default='csv')
+    parser.add_argument('--group-size', type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument('-o', '--output', help='output file (default stdout)')
+    args = parser.parse_args()
+
+    end = args.end or datetime.now(timezone.utc)
+    start = args.start or end - timedelta(hours=24)
+    io_ids = None
+    if args.io:
+        from teltonika_codec import IO_IDS
+        try:
+            io_ids = [int(name[3:]) if name.startswith('io_') and name[3:].isdigit() else IO_IDS[name]
+                      for name in args.io]
+        except KeyError as e:
+            parser.error(f"Unknown IO element {e}")
+
+    import psycopg2
+    from db_pool import DB_CONFIG
+    conn = psycopg2.connect(**DB_CONFIG)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        written = 0
+        for chunk in export(conn, args.format, start, end, args.imei, io_ids, args.group_size):
+            out.write(chunk)
+            written += len(chunk)
+        print(f"Exported {written:,} bytes", file=sys.stderr)
+    except ExportError as e:
+        parser.error(str(e))
+    finally:
+        if args.output:
+            out.close()
+        conn.close()
+
+if __name__ == '__main__':
+    main()
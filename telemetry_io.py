@@ -0,0 +1,272 @@
+"""
+POPTOP Telemetry IO - IO elements decoded once at write time
+Every IO element of a record is stored as one row of the narrow
+`telemetry_io` hypertable, next to its telemetry row (same imei and time).
+Readers fetch the elements of many rows in one grouped query instead of
+parsing raw_json per row, and SQL can filter or aggregate a single element:
+
+    SELECT time_bucket('1 hour', time), avg(value)
+    FROM telemetry_io
+    WHERE imei = '...' AND io_id = 89        -- fuel level
+    GROUP BY 1 ORDER BY 1;
+
+Rows written before this table existed have no IO rows; fetch_io falls back
+to their raw_json until backfill() has converted them. Fallbacks are counted
+(fallback_stats(), shown by /api/health) and logged at most once a minute;
+rows with neither IO rows nor raw_json come back with an empty io.
+
+    python telemetry_io.py --backfill [--imei IMEI]
+"""
+
+import argparse
+import csv
+import io
+import json
+import threading
+import time as _time
+
+from teltonika_codec import get_io_info
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS telemetry_io (
+    imei TEXT NOT NULL,
+    time TIMESTAMPTZ NOT NULL,
+    io_id INTEGER NOT NULL,
+    value BIGINT,
+    value_text TEXT
+);
+
+SELECT create_hypertable('telemetry_io', 'time', if_not_exists => TRUE);
+
+CREATE INDEX IF NOT EXISTS telemetry_io_imei_time_idx ON telemetry_io (imei, time DESC);
+CREATE INDEX IF NOT EXISTS telemetry_io_imei_id_time_idx ON telemetry_io (imei, io_id, time DESC);
+"""
+
+IO_COLUMNS = ('imei', 'time', 'io_id', 'value', 'value_text')
+
+# IO values are unsigned; U64 values above the BIGINT range are stored
+# wrapped (two's complement) and unwrapped again on read
+BIGINT_MAX = 2 ** 63 - 1
+U64_RANGE = 2 ** 64
+
+# Rows converted per round trip by backfill()
+BACKFILL_BATCH = 5000
+
+_schema_ready = False
+
+def ensure_schema(conn):
+    """Create the telemetry_io table if it doesn't exist"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA_SQL)
+    cursor.close()
+    conn.commit()
+    _schema_ready = True
+
+def record_to_io_rows(imei, time, io_elements):
+    """telemetry_io rows for the IO elements of one record"""
+    rows = []
+    for element in io_elements.values():
+        value = element['value']
+        if isinstance(value, int):
+            rows.append((imei, time, element['id'], value - U64_RANGE if value > BIGINT_MAX else value, None))
+        else:
+            rows.append((imei, time, element['id'], None, None if value is None else str(value)))
+    return rows
+
+def io_from_arrays(io_ids, values, texts):
+    """Rebuild the {name: {id, value, description}} dict from aggregated columns"""
+    elements = {}
+    for io_id, value, text in zip(io_ids, values, texts):
+        info = get_io_info(io_id)
+        if value is None:
+            value = text
+        elif value < 0:
+            value += U64_RANGE
+        elements[info['name']] = {'id': io_id, 'value': value, 'description': info['description']}
+    return elements
+
+def io_from_raw_json(raw_json):
+    """IO dict of a raw_json record (rows without telemetry_io rows)"""
+    try:
+        data = json.loads(raw_json) if isinstance(raw_json, str) else raw_json
+        return data.get('io', {}) or {}
+    except (ValueError, TypeError, AttributeError):
+        return {}
+
+def fetch_io_query(keys, io_ids=None):
+    """(sql, params) reading the IO elements of the (imei, time) keys"""
+    # The id filter goes into the aggregates rather than WHERE, so rows whose
+    # IO rows don't include the requested ids still show up (as NULLs) and
+    # aren't mistaken for rows that were never decoded
+    if io_ids is not None:
+        agg_filter = ' FILTER (WHERE i.io_id = ANY(%(io_ids)s))'
+    else:
+        agg_filter = ''
+    return f"""
+        SELECT i.imei, i.time,
+            array_agg(i.io_id){agg_filter},
+            array_agg(i.value){agg_filter},
+            array_agg(i.value_text){agg_filter}
+        FROM telemetry_io i
+        JOIN unnest(%(imeis)s::text[], %(times)s::timestamptz[]) AS k (imei, time)
+            ON i.imei = k.imei AND i.time = k.time
+        GROUP BY i.imei, i.time
+    """, {'imeis': [key[0] for key in keys], 'times': [key[1] for key in keys], 'io_ids': list(io_ids or ())}
+
+def io_map_from_rows(rows):
+    return {(row[0], row[1]): io_from_arrays(row[2] or (), row[3] or (), row[4] or ()) for row in rows}
+
+# Rows without telemetry_io rows (stored before it existed, not backfilled)
+RAW_JSON_SQL = """
+    SELECT t.imei, t.time, t.raw_json
+    FROM telemetry t
+    JOIN unnest(%s::text[], %s::timestamptz[]) AS k (imei, time)
+        ON t.imei = k.imei AND t.time = k.time
+"""
+
+def raw_json_params(missing):
+    return [key[0] for key in missing], [key[1] for key in missing]
+
+# Seconds between fallback log lines
+FALLBACK_LOG_SECONDS = 60
+
+_fallbacks = {'raw_json_rows': 0, 'empty_rows': 0}
+_fallback_lock = threading.Lock()
+_fallback_logged = 0.0
+
+def _count_fallbacks(raw_json_rows, empty_rows):
+    global _fallback_logged
+    with _fallback_lock:
+        _fallbacks['raw_json_rows'] += raw_json_rows
+        _fallbacks['empty_rows'] += empty_rows
+        now = _time.monotonic()
+        if now - _fallback_logged < FALLBACK_LOG_SECONDS:
+            return
+        _fallback_logged = now
+        totals = dict(_fallbacks)
+    print(f"IO fallback: {raw_json_rows} rows read from raw_json, {empty_rows} with no IO at all "
+          f"(totals {totals}); run python telemetry_io.py --backfill")
+
+def fallback_stats():
+    """Rows served from raw_json, and rows with no IO rows or raw_json, since start"""
+    with _fallback_lock:
+        return dict(_fallbacks)
+
+def merge_raw_json(result, rows, io_ids=None, missing=()):
+    """
+    Add elements decoded from raw_json rows for keys telemetry_io didn't have.
+    missing: the keys looked up, so keys with no row at all are counted too.
+    """
+    raw_json_rows = empty_rows = 0
+    for imei, time, raw_json in rows:
+        if raw_json is None:
+            empty_rows += 1
+        else:
+            raw_json_rows += 1
+        elements = io_from_raw_json(raw_json)
+        if io_ids is not None:
+            elements = {name: element for name, element in elements.items()
+                        if element.get('id') in io_ids}
+        result.setdefault((imei, time), elements)
+    empty_rows += sum(1 for key in missing if key not in result)
+    if raw_json_rows or empty_rows:
+        _count_fallbacks(raw_json_rows, empty_rows)
+    return result
+
+def fetch_io(cursor, keys, io_ids=None):
+    """
+    IO elements of many telemetry rows in one query.
+    keys: iterable of (imei, time); io_ids optionally limits the elements.
+    Returns {(imei, time): {name: element}}.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    cursor.execute(*fetch_io_query(keys, io_ids))
+    result = io_map_from_rows(cursor.fetchall())
+    missing = [key for key in keys if key not in result]
+    if missing:
+        cursor.execute(RAW_JSON_SQL, raw_json_params(missing))
+        merge_raw_json(result, cursor.fetchall(), io_ids, missing)
+    return result
+
+def copy_io_rows(cursor, rows):
+    """Write telemetry_io rows with one COPY"""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cursor.copy_expert(
+        f"COPY telemetry_io ({', '.join(IO_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buf
+    )
+
+def backfill(conn, imei=None, batch_size=BACKFILL_BATCH):
+    """
+    Decode raw_json of telemetry rows that have no telemetry_io rows yet.
+    Walks the table in time order, committing once per batch; returns the
+    number of telemetry rows converted.
+    """
+    ensure_schema(conn)
+    converted = 0
+    after = None
+    while True:
+        conditions = ['t.raw_json IS NOT NULL', """NOT EXISTS (
+            SELECT 1 FROM telemetry_io i WHERE i.imei = t.imei AND i.time = t.time
+        )"""]
+        params = []
+        if imei:
+            conditions.append('t.imei = %s')
+            params.append(imei)
+        if after:
+            conditions.append('(t.time, t.imei) > (%s, %s)')
+            params.extend(after)
+        params.append(batch_size)
+
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT t.imei, t.time, t.raw_json
+            FROM telemetry t
+            WHERE {' AND '.join(conditions)}
+            ORDER BY t.time, t.imei
+            LIMIT %s
+        """, params)
+        rows = cursor.fetchall()
+        if not rows:
+            cursor.close()
+            return converted
+
+        io_rows = []
+        for row_imei, time, raw_json in rows:
+            io_rows.extend(record_to_io_rows(row_imei, time, io_from_raw_json(raw_json)))
+        if io_rows:
+            copy_io_rows(cursor, io_rows)
+        cursor.close()
+        conn.commit()
+
+        converted += len(rows)
+        after = (rows[-1][1], rows[-1][0])
+        print(f"Backfilled {converted} rows (up to {after[0].isoformat()})")
+
+def main():
+    parser = argparse.ArgumentParser(description='telemetry_io maintenance')
+    parser.add_argument('--backfill', action='store_true', help='decode raw_json of rows without IO rows')
+    parser.add_argument('--imei', help='only backfill this device')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH)
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.print_help()
+        return
+
+    import psycopg2
+    from db_pool import DB_CONFIG
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        print(f"Done: {backfill(conn, args.imei, args.batch_size)} rows backfilled")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+POPTOP Telemetry Rollups - Hourly and daily per-device aggregates
+Two Timescale continuous aggregates, kept up to date by refresh policies,
+hold per-device record counts, speed, odometer and voltage extremes.
+window_stats() answers a time window from whole days (telemetry_daily),
+whole hours (telemetry_hourly) and raw rows only for the partial hours at
+either edge, so a month-long window reads a few dozen rollup rows.
+
+Policies only refresh recent buckets; materialize older history once with
+
+    python telemetry_rollups.py --refresh
+"""
+
+import argparse
+from datetime import datetime, timedelta, timezone
+
+ROLLUP_AGGREGATES = """
+    count(*) AS records,
+    max(speed_kmh) AS max_speed,
+    sum(speed_kmh) AS speed_sum,
+    count(speed_kmh) AS speed_count,
+    min(odometer_m) AS odometer_min,
+    max(odometer_m) AS odometer_max,
+    min(external_voltage_mv) AS voltage_min,
+    max(external_voltage_mv) AS voltage_max,
+    min(time) AS first_seen,
+    max(time) AS last_seen
+"""
+
+# Real-time aggregation (materialized_only = false) covers buckets the
+# policies haven't materialized yet
+ROLLUP_VIEWS = {
+    'telemetry_hourly': ('1 hour', "INTERVAL '31 days'", "INTERVAL '1 hour'", "INTERVAL '30 minutes'"),
+    'telemetry_daily': ('1 day', "INTERVAL '93 days'", "INTERVAL '1 day'", "INTERVAL '6 hours'"),
+}
+
+SCHEMA_SQL = ''.join(f"""
+CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT imei, time_bucket('{width}', time) AS bucket,{ROLLUP_AGGREGATES}
+FROM telemetry
+GROUP BY imei, bucket
+WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('{view}',
+    start_offset => {start_offset},
+    end_offset => {end_offset},
+    schedule_interval => {schedule},
+    if_not_exists => TRUE);
+""" for view, (width, start_offset, end_offset, schedule) in ROLLUP_VIEWS.items())
+
+# Combines rollup rows (or the raw aggregate of a partial bucket) into one
+COMBINE_COLUMNS = """
+    sum(records), max(max_speed), sum(speed_sum), sum(speed_count),
+    min(odometer_min), max(odometer_max), min(voltage_min), max(voltage_max),
+    min(first_seen), max(last_seen)
+"""
+
+_schema_ready = False
+
+def ensure_schema(conn):
+    """Create the continuous aggregates and their refresh policies if missing"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    # Continuous aggregates are created outside a transaction block
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        cursor.execute(SCHEMA_SQL)
+        cursor.close()
+    finally:
+        conn.autocommit = autocommit
+    _schema_ready = True
+
+def _floor(value, unit):
+    if unit == 'day':
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def _ceil(value, unit):
+    floored = _floor(value, unit)
+    if floored == value:
+        return value
+    return floored + (timedelta(days=1) if unit == 'day' else timedelta(hours=1))
+
+def plan_segments(start, end):
+    """
+    Split [start, end) into (source, from, to) segments: raw rows for the
+    partial hours at the edges, hourly rollups around whole days, daily
+    rollups in between. Times are UTC, matching time_bucket alignment.
+    """
+    hour_start, hour_end = _ceil(start, 'hour'), _floor(end, 'hour')
+    if hour_start >= hour_end:
+        return [('telemetry', start, end)]
+
+    segments = [('telemetry', start, hour_start)]
+    day_start, day_end = _ceil(start, 'day'), _floor(end, 'day')
+    if day_start < day_end:
+        segments += [
+            ('telemetry_hourly', hour_start, day_start),
+            ('telemetry_daily', day_start, day_end),
+            ('telemetry_hourly', day_end, hour_end),
+        ]
+    else:
+        segments.append(('telemetry_hourly', hour_start, hour_end))
+    segments.append(('telemetry', hour_end, end))
+    return [segment for segment in segments if segment[1] < segment[2]]
+
+def window_stats(cursor, imei, start, end=None):
+    """Aggregate a device's telemetry over [start, end) in one query"""
+    end = end or datetime.now(timezone.utc)
+    parts = []
+    params = []
+    for source, seg_start, seg_end in plan_segments(start, end):
+        if source == 'telemetry':
+            parts.append(f"""
+                SELECT {ROLLUP_AGGREGATES} FROM telemetry
+                WHERE imei = %s AND time >= %s AND time < %s
+            """)
+        else:
+            parts.append(f"""
+                SELECT {COMBINE_COLUMNS} FROM {source}
+                WHERE imei = %s AND bucket >= %s AND bucket < %s
+            """)
+        params += [imei, seg_start, seg_end]
+
+    cursor.execute(f"""
+        SELECT {COMBINE_COLUMNS}
+        FROM ({' UNION ALL '.join(parts)}) AS segments (
+            records, max_speed, speed_sum, speed_count, odometer_min,
+            odometer_max, voltage_min, voltage_max, first_seen, last_seen
+        )
+    """, params)
+    row = cursor.fetchone()
+    return {
+        'records': int(row[0]) if row[0] else 0,
+        'max_speed': float(row[1]) if row[1] else 0,
+        'avg_speed': float(row[2]) / int(row[3]) if row[3] else 0,
+        'odometer_min': row[4],
+        'odometer_max': row[5],
+        'voltage_min': row[6],
+        'voltage_max': row[7],
+        'first_seen': row[8],
+        'last_seen': row[9]
+    }
+
+def refresh(conn, start=None, end=None):
+    """Materialize both rollups over [start, end) (default: everything)"""
+    ensure_schema(conn)
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        for view in ROLLUP_VIEWS:
+            print(f"Refreshing {view}...")
+            cursor.execute("CALL refresh_continuous_aggregate(%s, %s, %s)", (view, start, end))
+        cursor.close()
+    finally:
+        conn.autocommit = autocommit
+
+def main():
+    parser = argparse.ArgumentParser(description='Telemetry rollup maintenance')
+    parser.add_argument('--refresh', action='store_true', help='materialize all buckets')
+    args = parser.parse_args()
+    if not args.refresh:
+        parser.print_help()
+        return
+
+    import psycopg2
+    from db_pool import DB_CONFIG
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        refresh(conn)
+        print("Done")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
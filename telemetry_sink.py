@@ -0,0 +1,218 @@
+"""
+POPTOP Telemetry Sink - Batched writers for parsed telemetry
+Records are buffered and written in one round trip per batch: COPY into
+Timescale (telemetry rows plus their decoded telemetry_io rows, in one
+transaction), batch_writer into DynamoDB. A batch is flushed when it reaches
+max_batch entries, when its oldest entry is older than max_age seconds,
+or when the caller flushes explicitly (e.g. at the end of a Lambda
+invocation). Sinks keep their connection open, so a module-level sink is
+reused across warm Lambda invocations.
+"""
+
+import csv
+import io
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+import telemetry_io
+
+TELEMETRY_COLUMNS = (
+    'time', 'imei', 'latitude', 'longitude', 'altitude', 'speed_kmh', 'heading',
+    'satellites', 'external_voltage_mv', 'internal_voltage_mv', 'ignition',
+    'movement', 'gsm_signal', 'odometer_m', 'vin', 'raw_json'
+)
+
+# OBD VIN is sent as a variable-length (hex) IO element
+VIN_IO_ID = 256
+
+def _io_value(io_elements, name):
+    element = io_elements.get(name)
+    return element['value'] if element else None
+
+def record_to_row(imei, record):
+    """Map a parsed AVL record onto a telemetry table row"""
+    gps = record.get('gps', {})
+    io_elements = record.get('io', {})
+    ignition = _io_value(io_elements, 'ignition')
+    movement = _io_value(io_elements, 'movement')
+
+    vin = None
+    for element in io_elements.values():
+        if element['id'] == VIN_IO_ID and isinstance(element['value'], str):
+            try:
+                vin = bytes.fromhex(element['value']).decode('ascii').strip('\x00 ') or None
+            except ValueError:
+                pass
+            break
+
+    return (
+        datetime.fromtimestamp(record['timestamp'] / 1000, tz=timezone.utc),
+        imei,
+        gps.get('latitude'),
+        gps.get('longitude'),
+        gps.get('altitude'),
+        gps.get('speed_kmh'),
+        gps.get('angle'),
+        gps.get('satellites'),
+        _io_value(io_elements, 'external_voltage'),
+        _io_value(io_elements, 'battery_voltage'),
+        None if ignition is None else bool(ignition),
+        None if movement is None else bool(movement),
+        _io_value(io_elements, 'gsm_signal'),
+        _io_value(io_elements, 'total_odometer'),
+        vin,
+        json.dumps(record)
+    )
+
+class TelemetrySink:
+    """Buffer entries and write them in batches; subclasses implement _write"""
+
+    def __init__(self, max_batch=500, max_age=1.0):
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._metrics = {
+            'flushes': 0,
+            'entries': 0,
+            'errors': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0
+        }
+
+    def add(self, entry):
+        """Buffer one entry, flushing if the batch is full or too old"""
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(entry)
+            due = (len(self._buffer) >= self.max_batch
+                   or time.monotonic() - self._oldest >= self.max_age)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered; returns the number of entries written"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            try:
+                self._timed_write(batch)
+            except Exception:
+                # Keep the batch so the next flush retries it
+                self._buffer = batch + self._buffer
+                raise
+            return len(batch)
+
+    def _timed_write(self, batch):
+        """_write one batch and count it; call with the lock held"""
+        started = time.perf_counter()
+        try:
+            self._write(batch)
+        except Exception:
+            self._metrics['errors'] += 1
+            raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        m = self._metrics
+        m['flushes'] += 1
+        m['entries'] += len(batch)
+        m['last_batch_size'] = len(batch)
+        m['max_batch_size'] = max(m['max_batch_size'], len(batch))
+        m['last_flush_ms'] = round(elapsed_ms, 2)
+        m['max_flush_ms'] = round(max(m['max_flush_ms'], elapsed_ms), 2)
+        m['total_flush_ms'] += elapsed_ms
+
+    def discard(self):
+        """Drop everything buffered"""
+        with self._lock:
+            self._buffer = []
+
+    def metrics(self):
+        """Flush latency and batch size counters"""
+        with self._lock:
+            m = dict(self._metrics)
+            m['buffered'] = len(self._buffer)
+        m['avg_batch_size'] = round(m['entries'] / m['flushes'], 1) if m['flushes'] else 0
+        m['avg_flush_ms'] = round(m.pop('total_flush_ms') / m['flushes'], 2) if m['flushes'] else 0
+        return m
+
+    def _write(self, batch):
+        raise NotImplementedError
+
+def record_to_entry(imei, record):
+    """Telemetry row plus its telemetry_io rows, as buffered by TimescaleSink"""
+    row = record_to_row(imei, record)
+    return row, telemetry_io.record_to_io_rows(imei, row[0], record.get('io', {}))
+
+class TimescaleSink(TelemetrySink):
+    """Writes telemetry and telemetry_io rows to Timescale with COPY, one transaction per batch"""
+
+    def __init__(self, connect_kwargs=None, max_batch=500, max_age=1.0):
+        super().__init__(max_batch, max_age)
+        self.connect_kwargs = connect_kwargs
+        self._conn = None
+
+    def add_records(self, imei, records):
+        for record in records:
+            self.add(record_to_entry(imei, record))
+
+    def write(self, batch):
+        """
+        Write a list of (imei, record) pairs now (TCP server batches), in
+        one transaction and apart from the buffer: either every row is
+        stored or none is, so a device resending after a failed ACK never
+        duplicates rows.
+        """
+        entries = [record_to_entry(imei, record) for imei, record in batch]
+        if not entries:
+            return
+        with self._lock:
+            self._timed_write(entries)
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            # Imported here so DynamoDB-only Lambdas don't need psycopg2
+            import psycopg2
+            from db_config import DB_CONFIG
+            self._conn = psycopg2.connect(**(self.connect_kwargs or DB_CONFIG))
+        return self._conn
+
+    def _write(self, entries):
+        buf = io.StringIO()
+        csv.writer(buf).writerows(row for row, _ in entries)
+        buf.seek(0)
+        conn = self._connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(
+                f"COPY telemetry ({', '.join(TELEMETRY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                buf
+            )
+            io_rows = [io_row for _, rows in entries for io_row in rows]
+            if io_rows:
+                telemetry_io.copy_io_rows(cursor, io_rows)
+            cursor.close()
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+class DynamoSink(TelemetrySink):
+    """Writes event items to DynamoDB through batch_writer (25 items per request)"""
+
+    def __init__(self, table, max_batch=25, max_age=1.0):
+        super().__init__(max_batch, max_age)
+        self.table = table
+
+    def _write(self, items):
+        with self.table.batch_writer() as writer:
+            for item in items:
+                writer.put_item(Item=item)
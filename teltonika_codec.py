@@ -0,0 +1,301 @@
+"""
+POPTOP Teltonika Codec - Codec 8 / 8E AVL packet parser and encoder
+Decodes with precompiled struct.Struct objects and unpack_from over a
+memoryview, so no field is sliced or copied. Nothing is logged while
+parsing; malformed packets raise CodecError.
+
+Packet structure:
+- Preamble: 4 bytes (0x00000000)
+- Data Length: 4 bytes
+- Codec ID: 1 byte (0x08 for Codec 8, 0x8E for Codec 8E)
+- Number of Records: 1 byte
+- Records: Variable
+- Number of Records (again): 1 byte
+- CRC: 4 bytes (CRC-16/IBM of codec ID through the second record count)
+"""
+
+import struct
+from datetime import datetime
+
+CODEC_8 = 0x08
+CODEC_8E = 0x8E
+CODEC_NAMES = {CODEC_8: 'Codec 8', CODEC_8E: 'Codec 8E', 0x10: 'Codec 16'}
+
+# Preamble, data length, codec ID, number of records
+PACKET_HEADER = struct.Struct('>IIBB')
+# Timestamp, priority, longitude, latitude, altitude, angle, satellites, speed
+RECORD_HEADER = struct.Struct('>QBiihHBH')
+CRC_FIELD = struct.Struct('>I')
+
+U8 = struct.Struct('>B')
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+U64 = struct.Struct('>Q')
+# Codec 8E variable-length IO: id, value length
+VAR_IO_HEADER = struct.Struct('>HH')
+
+# Per-codec layout: (event IO + total count struct, count struct, IO id struct)
+CODEC_LAYOUT = {
+    CODEC_8: (struct.Struct('>BB'), U8, U8),
+    CODEC_8E: (struct.Struct('>HH'), U16, U16),
+}
+
+# Fixed-size IO groups in wire order: (value size, value struct)
+IO_GROUPS = ((1, U8), (2, U16), (4, U32), (8, U64))
+
+# FMM00A IO elements: id -> (name, description)
+IO_CATALOG = {
+    # Digital inputs
+    1: ('digital_input_1', 'Digital Input 1'),
+    2: ('digital_input_2', 'Digital Input 2'),
+    3: ('digital_input_3', 'Digital Input 3'),
+    4: ('digital_input_4', 'Digital Input 4'),
+
+    # Analog inputs
+    9: ('analog_input_1', 'Analog Input 1 (mV)'),
+    10: ('analog_input_2', 'Analog Input 2 (mV)'),
+    11: ('ibutton_id', 'iButton ID'),
+
+    # System
+    16: ('total_odometer', 'Total Odometer (m)'),
+    21: ('gsm_signal', 'GSM Signal Strength'),
+    24: ('speed', 'Speed (km/h)'),
+    66: ('external_voltage', 'External Voltage (mV)'),
+    67: ('battery_voltage', 'Battery Voltage (mV)'),
+    68: ('battery_current', 'Battery Current (mA)'),
+    69: ('gnss_status', 'GNSS Status'),
+    80: ('data_mode', 'Data Mode'),
+    113: ('battery_level', 'Battery Level (%)'),
+    181: ('gnss_pdop', 'GNSS PDOP'),
+    182: ('gnss_hdop', 'GNSS HDOP'),
+    199: ('trip_odometer', 'Trip Odometer (m)'),
+
+    # Status flags
+    239: ('ignition', 'Ignition'),
+    240: ('movement', 'Movement'),
+    241: ('active_gsm_operator', 'Active GSM Operator'),
+
+    # Dallas temperature sensors
+    72: ('dallas_temp_1', 'Dallas Temperature 1 (°C)'),
+    73: ('dallas_temp_2', 'Dallas Temperature 2 (°C)'),
+    74: ('dallas_temp_3', 'Dallas Temperature 3 (°C)'),
+    75: ('dallas_temp_4', 'Dallas Temperature 4 (°C)'),
+
+    # Additional
+    200: ('sleep_mode', 'Sleep Mode'),
+    205: ('cell_id', 'Cell ID'),
+    206: ('area_code', 'Area Code (LAC)'),
+    247: ('crash_detection', 'Crash Detection'),
+}
+
+# IO name -> id, for callers that select elements by name
+IO_IDS = {name: io_id for io_id, (name, _) in IO_CATALOG.items()}
+
+# Catalog plus generated entries for unknown IDs seen on the wire
+_IO_LOOKUP = dict(IO_CATALOG)
+
+class CodecError(Exception):
+    """Malformed or truncated AVL packet; `records` holds what was decoded"""
+
+    def __init__(self, message, records=None):
+        super().__init__(message)
+        self.records = records or []
+
+def _unknown_io(io_id):
+    info = _IO_LOOKUP[io_id] = (f'io_{io_id}', f'Unknown IO Element {io_id}')
+    return info
+
+def get_io_info(io_id):
+    """Name and description of an IO element"""
+    info = _IO_LOOKUP.get(io_id) or _unknown_io(io_id)
+    return {'name': info[0], 'description': info[1]}
+
+def format_timestamp(timestamp_ms):
+    """Convert milliseconds since epoch to ISO datetime"""
+    try:
+        return datetime.fromtimestamp(timestamp_ms / 1000).isoformat()
+    except (OverflowError, OSError, ValueError):
+        return f"invalid_{timestamp_ms}"
+
+def _build_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _build_crc_table()
+
+def crc16(data):
+    """CRC-16/IBM (poly 0xA001, init 0) as used by Teltonika"""
+    crc = 0
+    table = _CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def parse_avl_record(buf, offset, codec_id):
+    """
+    Decode one AVL record from buf (bytes or memoryview) at offset.
+    Returns (record, new_offset).
+    """
+    try:
+        timestamp_ms, priority, lon_raw, lat_raw, altitude, angle, satellites, speed = \
+            RECORD_HEADER.unpack_from(buf, offset)
+        offset += RECORD_HEADER.size
+
+        io_header, count_struct, id_struct = CODEC_LAYOUT[codec_id]
+        event_io_id, total_io = io_header.unpack_from(buf, offset)
+        offset += io_header.size
+
+        lookup = _IO_LOOKUP
+        io = {}
+        count_size = count_struct.size
+        id_size = id_struct.size
+        for value_size, value_struct in IO_GROUPS:
+            count = count_struct.unpack_from(buf, offset)[0]
+            offset += count_size
+            for _ in range(count):
+                io_id = id_struct.unpack_from(buf, offset)[0]
+                value = value_struct.unpack_from(buf, offset + id_size)[0]
+                offset += id_size + value_size
+                info = lookup.get(io_id) or _unknown_io(io_id)
+                io[info[0]] = {'id': io_id, 'value': value, 'description': info[1]}
+
+        # Codec 8E adds a group of variable-length values, stored as hex
+        if codec_id == CODEC_8E:
+            count = U16.unpack_from(buf, offset)[0]
+            offset += 2
+            for _ in range(count):
+                io_id, length = VAR_IO_HEADER.unpack_from(buf, offset)
+                offset += VAR_IO_HEADER.size
+                end = offset + length
+                if end > len(buf):
+                    raise CodecError(f'Variable IO {io_id} overruns packet at offset {offset}')
+                value = buf[offset:end].hex()
+                offset = end
+                info = lookup.get(io_id) or _unknown_io(io_id)
+                io[info[0]] = {'id': io_id, 'value': value, 'description': info[1]}
+    except struct.error as e:
+        raise CodecError(f'Truncated record at offset {offset}: {e}')
+
+    latitude = lat_raw / 10000000.0
+    longitude = lon_raw / 10000000.0
+    record = {
+        'timestamp': timestamp_ms,
+        'datetime': format_timestamp(timestamp_ms),
+        'priority': priority,
+        'gps': {
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': altitude,
+            'angle': angle,
+            'satellites': satellites,
+            'speed_kmh': speed,
+            'valid': satellites > 0 and latitude != 0 and longitude != 0
+        },
+        'event_io_id': event_io_id,
+        'total_io_elements': total_io,
+        'io': io
+    }
+    return record, offset
+
+def parse_packet(data, verify_crc=False):
+    """
+    Decode a complete AVL packet (preamble through CRC).
+    Raises CodecError for truncated, unsupported or (with verify_crc)
+    corrupted packets.
+    """
+    buf = memoryview(data)
+    if len(buf) < PACKET_HEADER.size:
+        raise CodecError(f'Packet too short: {len(buf)} bytes')
+
+    preamble, data_length, codec_id, num_records = PACKET_HEADER.unpack_from(buf, 0)
+    if codec_id not in CODEC_LAYOUT:
+        raise CodecError(f'Unsupported codec 0x{codec_id:02x}')
+
+    result = {
+        'codec_id': codec_id,
+        'codec_name': CODEC_NAMES.get(codec_id, f'Unknown (0x{codec_id:02x})'),
+        'num_records': num_records,
+        'records': []
+    }
+
+    records = result['records']
+    offset = PACKET_HEADER.size
+    try:
+        for _ in range(num_records):
+            record, offset = parse_avl_record(buf, offset, codec_id)
+            records.append(record)
+    except CodecError as e:
+        e.records = records
+        raise
+
+    # Trailer: record count again, then the CRC
+    if offset + 1 + CRC_FIELD.size <= len(buf):
+        if buf[offset] != num_records:
+            raise CodecError(
+                f'Record count mismatch: header {num_records}, footer {buf[offset]}', records
+            )
+        crc = CRC_FIELD.unpack_from(buf, offset + 1)[0]
+        result['crc'] = crc
+        if verify_crc and crc != crc16(buf[8:offset + 1]):
+            raise CodecError(f'CRC mismatch: packet 0x{crc:04x}', records)
+    elif verify_crc:
+        raise CodecError('Packet has no CRC trailer', records)
+
+    return result
+
+def encode_record(record, codec_id=CODEC_8E):
+    """Encode a record dict (the shape parse_avl_record returns) to bytes"""
+    gps = record['gps']
+    io_header, count_struct, id_struct = CODEC_LAYOUT[codec_id]
+    parts = [RECORD_HEADER.pack(
+        record['timestamp'], record.get('priority', 0),
+        round(gps['longitude'] * 10000000), round(gps['latitude'] * 10000000),
+        gps.get('altitude', 0), gps.get('angle', 0), gps.get('satellites', 0), int(gps.get('speed_kmh', 0))
+    )]
+
+    # Group IO values by wire size
+    groups = {1: [], 2: [], 4: [], 8: [], 'X': []}
+    for element in record.get('io', {}).values():
+        value = element['value']
+        if isinstance(value, str):
+            groups['X'].append((element['id'], bytes.fromhex(value)))
+        elif value < 0x100:
+            groups[1].append((element['id'], value))
+        elif value < 0x10000:
+            groups[2].append((element['id'], value))
+        elif value < 0x100000000:
+            groups[4].append((element['id'], value))
+        else:
+            groups[8].append((element['id'], value))
+    if codec_id == CODEC_8 and groups['X']:
+        raise CodecError('Codec 8 cannot carry variable-length IO elements')
+
+    total = sum(len(items) for items in groups.values())
+    parts.append(io_header.pack(record.get('event_io_id', 0), total))
+    for value_size, value_struct in IO_GROUPS:
+        items = groups[value_size]
+        parts.append(count_struct.pack(len(items)))
+        for io_id, value in items:
+            parts.append(id_struct.pack(io_id))
+            parts.append(value_struct.pack(value))
+    if codec_id == CODEC_8E:
+        parts.append(U16.pack(len(groups['X'])))
+        for io_id, value in groups['X']:
+            parts.append(VAR_IO_HEADER.pack(io_id, len(value)))
+            parts.append(value)
+    return b''.join(parts)
+
+def build_packet(records, codec_id=CODEC_8E):
+    """Encode records into a complete AVL packet with length and CRC"""
+    body = b''.join([
+        U8.pack(codec_id),
+        U8.pack(len(records)),
+        *(encode_record(record, codec_id) for record in records),
+        U8.pack(len(records))
+    ])
+    return struct.pack('>II', 0, len(body)) + body + CRC_FIELD.pack(crc16(body))
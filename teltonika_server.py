@@ -0,0 +1,199 @@
+"""
+POPTOP Teltonika TCP Server - Direct device ingestion over asyncio
+Speaks the Teltonika TCP protocol without Soracom Funnel / IoT Core /
+Lambda in between:
+
+1. Device sends its IMEI (2-byte length + ASCII); server answers 0x01
+2. Device sends AVL packets (preamble, length, data, CRC)
+3. Server answers each packet with the 4-byte number of records accepted
+
+Decoded records from every connection go to one RecordBatcher, which hands
+them to a blocking writer in batches. A packet is acknowledged only after
+the batch containing it was written, so the device resends on failure.
+"""
+
+import argparse
+import asyncio
+import os
+import struct
+import time
+
+from telemetry_sink import TimescaleSink
+from teltonika_codec import CRC_FIELD, CodecError, crc16, parse_packet
+
+IMEI_LENGTH = struct.Struct('>H')
+PACKET_PREFIX = struct.Struct('>II')  # preamble, data length
+ACK = struct.Struct('>I')
+
+# Largest AVL data field accepted; FMB/FMM devices stay well under this
+MAX_DATA_LENGTH = 64 * 1024
+
+# Devices that stay silent longer than this are disconnected
+READ_TIMEOUT = float(os.environ.get('TELTONIKA_READ_TIMEOUT', 600))
+
+class RecordBatcher:
+    """Collects (imei, record) pairs from all connections and flushes them in batches"""
+
+    def __init__(self, write, max_batch=500, max_delay=0.5):
+        self.write = write            # blocking callable taking a list of (imei, record)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = []            # (imei, record)
+        self._waiters = []            # futures resolved when the pending batch is written
+        self._wakeup = asyncio.Event()
+        self.batches = 0
+        self.records = 0
+        self.errors = 0
+
+    async def put(self, imei, records):
+        """Queue records and wait until they have been written"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.extend((imei, record) for record in records)
+        self._waiters.append(future)
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+        await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            batch, self._pending = self._pending, []
+            waiters, self._waiters = self._waiters, []
+            try:
+                await loop.run_in_executor(None, self.write, batch)
+            except Exception as e:
+                self.errors += 1
+                print(f"Batch write failed ({len(batch)} records): {e}")
+                for future in waiters:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.records += len(batch)
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+
+class TeltonikaServer:
+    """asyncio TCP server handling one coroutine per device socket"""
+
+    def __init__(self, batcher, sink=None, accept_imei=None):
+        self.batcher = batcher
+        self.sink = sink
+        self.accept_imei = accept_imei or (lambda imei: imei.isdigit())
+        self.connections = 0
+        self.packets = 0
+        self.crc_errors = 0
+        self.parse_errors = 0
+
+    def stats(self):
+        stats = {
+            'connections': self.connections,
+            'packets': self.packets,
+            'crc_errors': self.crc_errors,
+            'parse_errors': self.parse_errors,
+            'batches': self.batcher.batches,
+            'records': self.batcher.records,
+            'write_errors': self.batcher.errors
+        }
+        if self.sink is not None:
+            stats['sink'] = self.sink.metrics()
+        return stats
+
+    async def _read(self, reader, size):
+        return await asyncio.wait_for(reader.readexactly(size), READ_TIMEOUT)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        imei = None
+        try:
+            # IMEI handshake
+            length = IMEI_LENGTH.unpack(await self._read(reader, IMEI_LENGTH.size))[0]
+            imei = (await self._read(reader, length)).decode('ascii', 'replace')
+            if not self.accept_imei(imei):
+                writer.write(b'\x00')
+                await writer.drain()
+                return
+            writer.write(b'\x01')
+            await writer.drain()
+
+            # AVL packets until the device disconnects
+            while True:
+                prefix = await self._read(reader, PACKET_PREFIX.size)
+                preamble, data_length = PACKET_PREFIX.unpack(prefix)
+                if preamble != 0 or data_length > MAX_DATA_LENGTH:
+                    print(f"{imei}: bad packet header (preamble {preamble:#x}, length {data_length})")
+                    return
+                body = await self._read(reader, data_length + CRC_FIELD.size)
+                self.packets += 1
+
+                crc = CRC_FIELD.unpack_from(body, data_length)[0]
+                if crc != crc16(memoryview(body)[:data_length]):
+                    # No records accepted; the device resends the packet
+                    self.crc_errors += 1
+                    writer.write(ACK.pack(0))
+                    await writer.drain()
+                    continue
+
+                try:
+                    records = parse_packet(prefix + body)['records']
+                except CodecError as e:
+                    self.parse_errors += 1
+                    print(f"{imei}: {e}")
+                    writer.write(ACK.pack(0))
+                    await writer.drain()
+                    continue
+
+                try:
+                    await self.batcher.put(imei, records)
+                except Exception:
+                    writer.write(ACK.pack(0))
+                else:
+                    writer.write(ACK.pack(len(records)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+async def report(server, interval=60):
+    """Print throughput counters periodically"""
+    while True:
+        await asyncio.sleep(interval)
+        print(f"[{time.strftime('%H:%M:%S')}] {server.stats()}")
+
+def log_writer(batch):
+    """Default writer: report what would be stored"""
+    devices = len({imei for imei, _ in batch})
+    print(f"Received {len(batch)} records from {devices} device(s)")
+
+async def serve(host, port, write=log_writer, max_batch=500, max_delay=0.5, sink=None):
+    batcher = RecordBatcher(sink.write if sink else write, max_batch, max_delay)
+    server = TeltonikaServer(batcher, sink)
+    tcp_server = await asyncio.start_server(server.handle, host, port, backlog=4096)
+    print(f"Teltonika TCP server listening on {host}:{port}")
+    async with tcp_server:
+        await asyncio.gather(tcp_server.serve_forever(), batcher.run(), report(server))
+
+def main():
+    parser = argparse.ArgumentParser(description='Teltonika TCP ingestion server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('TELTONIKA_PORT', 5027)))
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--batch-delay', type=float, default=0.5)
+    parser.add_argument('--sink', choices=['log', 'timescale'], default='log',
+                        help='where decoded records go (default: just log batch sizes)')
+    args = parser.parse_args()
+    sink = TimescaleSink(max_batch=args.batch_size) if args.sink == 'timescale' else None
+    asyncio.run(serve(args.host, args.port, max_batch=args.batch_size, max_delay=args.batch_delay, sink=sink))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""?fields= handling of the Flask API (needs flask, flask-cors and psycopg2)"""
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_cors')
+pytest.importorskip('psycopg2')
+
+import db_config
+
+# Keep the background threads started at import away from a real database
+db_config.DB_CONFIG.update(host='127.0.0.1', port=1, connect_timeout=1)
+
+import api_server_NEW as api
+
+class FakeCursor:
+    """Records statements; every query returns no rows"""
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def execute(self, query, params=None):
+        self.queries.append(' '.join(query.split()))
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self):
+        self.queries = []
+
+    def cursor(self, name=None):
+        return FakeCursor(self.queries)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(api, 'live_state_ready', lambda: False)
+    return api.app.test_client()
+
+def run(client, monkeypatch, url):
+    conn = FakeConnection()
+    monkeypatch.setattr(api, 'get_timescale_connection', lambda: conn)
+    response = client.get(url)
+    return response.status_code, response.get_json(), conn.queries
+
+@pytest.mark.parametrize('path', ['/api/latest/862464068525406', '/api/history/862464068525406'])
+def test_empty_fields_is_no_projection(client, monkeypatch, path):
+    status, body, queries = run(client, monkeypatch, path)
+    assert status != 500, body
+    assert run(client, monkeypatch, path + '?fields=') == (status, body, queries)
+
+@pytest.mark.parametrize('path', ['/api/latest/862464068525406', '/api/history/862464068525406'])
+def test_unknown_fields_are_rejected(client, monkeypatch, path):
+    status, body, _ = run(client, monkeypatch, path + '?fields=latitude,nope')
+    assert status == 400
+    assert 'nope' in body['error']
@@ -0,0 +1,54 @@
+import math
+
+import numpy as np
+import pytest
+
+import geo_stats
+
+# One degree of latitude on the geo_stats sphere
+DEGREE_M = geo_stats.EARTH_RADIUS_M * math.pi / 180
+
+def test_to_array_marks_missing_fixes():
+    arr = geo_stats.to_array([1.5, None, 0, 2.0])
+    assert arr[0] == 1.5 and arr[3] == 2.0
+    assert np.isnan(arr[1]) and np.isnan(arr[2])
+
+def test_haversine_matches_known_distances():
+    assert geo_stats.haversine_m(0.0, 0.0, 1.0, 0.0) == pytest.approx(DEGREE_M)
+    assert geo_stats.haversine_m(10.0, 20.0, 10.0, 20.0) == 0
+    assert geo_stats.haversine_m(0.0, 0.0, 0.0, 180.0) == pytest.approx(math.pi * geo_stats.EARTH_RADIUS_M)
+
+def test_step_distances_skip_missing_fixes():
+    lat = geo_stats.to_array([0.0001, 0.0011, None, 0.0021, 0.0031])
+    lon = geo_stats.to_array([1.0, 1.0, 1.0, 1.0, 1.0])
+    steps = geo_stats.step_distances(lat, lon)
+    assert steps[0] == 0
+    assert steps[1] == pytest.approx(DEGREE_M / 1000)
+    assert steps[2] == 0 and steps[3] == 0
+    assert steps[4] == pytest.approx(DEGREE_M / 1000)
+
+def test_step_distances_drop_jumps():
+    lat = [1.0, 1.001, 2.0, 2.001]
+    lon = [1.0, 1.0, 1.0, 1.0]
+    time_s = [0, 10, 20, 30]
+    steps = geo_stats.step_distances(lat, lon, time_s, max_speed_kmh=300)
+    assert steps[2] == 0  # ~111 km in 10 s
+    assert steps[1] == pytest.approx(DEGREE_M / 1000)
+    assert geo_stats.step_distances(lat, lon, max_step_m=1000)[2] == 0
+
+def test_short_tracks():
+    assert geo_stats.step_distances([], []).tolist() == []
+    assert geo_stats.step_distances([1.0], [1.0]).tolist() == [0]
+    assert geo_stats.speed_stats([]) == (0.0, 0.0, 0)
+
+def test_cumulative_distance_is_the_running_sum():
+    lat = [0.0001, 0.0011, 0.0021]
+    lon = [1.0, 1.0, 1.0]
+    assert geo_stats.cumulative_distance(lat, lon).tolist() == pytest.approx([0, DEGREE_M / 1000, DEGREE_M / 500])
+
+def test_trip_stats_averages_moving_samples_only():
+    stats = geo_stats.trip_stats([0.0001, 0.0011], [1.0, 1.0], [0, 40, None, 60, 0.5])
+    assert stats['distance_m'] == pytest.approx(DEGREE_M / 1000)
+    assert stats['max_speed'] == 60
+    assert stats['avg_speed'] == 50
+    assert stats['moving_samples'] == 2
@@ -0,0 +1,100 @@
+"""Fence geometry, grid index and enter/exit evaluation (geofence imports psycopg2)"""
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+import geofence
+from geofence import Fence, GeofenceEngine, GridIndex, distance_m
+
+SQUARE = {'points': [[38.0, -121.0], [38.0, -120.99], [38.01, -120.99], [38.01, -121.0]]}
+# An L: the notch at the top right is outside
+L_SHAPE = {'points': [[0, 0], [0, 0.2], [0.1, 0.2], [0.1, 0.1], [0.2, 0.1], [0.2, 0]]}
+
+def test_distance():
+    assert distance_m(38.0, -121.0, 38.0, -121.0) == 0
+    assert distance_m(0, 0, 1, 0) == pytest.approx(111195, rel=1e-3)
+
+def test_circle_contains():
+    fence = Fence(1, 'Depot', 'circle', {'center': [38.5, -121.5], 'radius_m': 100})
+    assert fence.contains(38.5, -121.5)
+    assert fence.contains(38.5008, -121.5)      # ~89 m north
+    assert not fence.contains(38.5010, -121.5)  # ~111 m north
+    assert not fence.contains(40.0, -121.5)
+
+def test_polygon_contains():
+    square = Fence(1, 'Yard', 'polygon', SQUARE)
+    assert square.contains(38.005, -120.995)
+    assert not square.contains(38.02, -120.995)
+    l_shape = Fence(2, 'L', 'polygon', L_SHAPE)
+    assert l_shape.contains(0.05, 0.15)
+    assert l_shape.contains(0.15, 0.05)
+    assert not l_shape.contains(0.15, 0.15)  # inside the bounding box, outside the polygon
+
+@pytest.mark.parametrize('kind, geometry', [
+    ('circle', {'center': [38.5, -121.5], 'radius_m': 0}),
+    ('circle', {'center': [38.5, -121.5], 'radius_m': float('nan')}),
+    ('circle', {'center': [38.5, -121.5], 'radius_m': 500000}),
+    ('polygon', {'points': [[30, -125], [30, -70], [48, -70], [48, -125]]}),
+    ('polygon', {'points': [[0, 0], [1, 1]]}),
+    ('square', {})
+])
+def test_invalid_fences(kind, geometry):
+    with pytest.raises(ValueError):
+        Fence(1, 'Bad', kind, geometry)
+
+def test_largest_fence_is_accepted():
+    fence = Fence(1, 'Site', 'circle', {'center': [38.5, -121.5], 'radius_m': 40000})
+    assert fence.bbox[2] - fence.bbox[0] < 1
+    index = GridIndex(cell_deg=0.01)
+    index.insert(fence)
+    assert len(index) <= (geofence.MAX_SPAN_DEG / 0.01 + 1) ** 2
+
+def test_grid_index():
+    index = GridIndex(cell_deg=0.01)
+    fence = Fence(1, 'Yard', 'polygon', SQUARE)
+    index.insert(fence)
+    assert 1 in index.candidates(38.005, -120.995)
+    assert 1 not in index.candidates(38.5, -120.995)
+    assert len(index) > 0
+    index.remove(1)
+    assert not index.candidates(38.005, -120.995)
+    assert len(index) == 0
+
+def test_enter_and_exit_events():
+    engine = GeofenceEngine(cell_deg=0.01)
+    engine.add_fence(Fence(1, 'Yard', 'polygon', SQUARE))
+    engine.add_fence(Fence(2, 'Gate', 'circle', {'center': [38.0, -121.0], 'radius_m': 200}))
+    assert engine.evaluate('1', 1000, 38.5, -121.5) == []
+    assert engine.evaluate('1', 2000, 38.005, -120.995) == [(1, 'enter')]
+    assert engine.evaluate('1', 3000, 38.0005, -120.9995) == [(2, 'enter')]
+    assert engine.inside('1') == [1, 2]
+    assert engine.evaluate('1', 4000, 38.5, -121.5) == [(1, 'exit'), (2, 'exit')]
+    assert engine.inside('1') == []
+
+def test_out_of_order_positions_are_ignored():
+    engine = GeofenceEngine(cell_deg=0.01)
+    engine.add_fence(Fence(1, 'Yard', 'polygon', SQUARE))
+    assert engine.evaluate('1', 2000, 38.005, -120.995) == [(1, 'enter')]
+    assert engine.evaluate('1', 1000, 38.5, -121.5) == []
+    assert engine.inside('1') == [1]
+
+def test_removed_fence_is_left_silently():
+    engine = GeofenceEngine(cell_deg=0.01)
+    engine.add_fence(Fence(1, 'Yard', 'polygon', SQUARE))
+    engine.evaluate('1', 1000, 38.005, -120.995)
+    engine.remove_fence(1)
+    assert engine.inside('1') == []
+    assert engine.evaluate('1', 2000, 38.5, -121.5) == []
+
+def test_records_are_only_queued_by_the_leader():
+    engine = GeofenceEngine(queue_size=1)
+    record = {'imei': '1', 'timestamp': 1000, 'gps': {'latitude': 38.0, 'longitude': -121.0}}
+    engine.on_record(record)
+    assert engine.stats()['queued'] == 0
+    engine.leader = True
+    engine.on_record({**record, 'gps': {'latitude': 0, 'longitude': 0}})  # no fix
+    engine.on_record(record)
+    engine.on_record(record)
+    assert engine.stats()['queued'] == 1
+    assert engine.stats()['dropped'] == 1
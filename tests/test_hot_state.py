@@ -0,0 +1,106 @@
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import hot_state
+from hot_state import HotState, from_micros, to_micros
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+LONG_AGO = T0 - timedelta(days=7)
+
+@pytest.fixture
+def hot():
+    state = HotState(slots=8, slot_size=256)
+    yield state
+    state.close()
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+def test_micros_round_trip():
+    moment = datetime(2025, 6, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    assert from_micros(to_micros(moment)) == moment
+    assert to_micros(moment.replace(tzinfo=None)) == to_micros(moment)
+
+def test_latest_body_until_new_telemetry(hot):
+    assert hot.get_latest('1') == (None, None)
+    hot.set_latest('1', 'VIN', T0, b'{"a": 1}')
+    assert hot.get_latest('1') == (b'{"a": 1}', T0)
+    # A newer row drops the stored body; an older response can't replace it
+    hot.touch('1', 'VIN', T0 + timedelta(seconds=1))
+    assert hot.get_latest('1') == (None, T0 + timedelta(seconds=1))
+    hot.set_latest('1', 'VIN', T0, b'{"a": 1}')
+    assert hot.get_latest('1')[0] is None
+    assert hot.newest('1') == T0 + timedelta(seconds=1)
+
+def test_oversized_bodies_are_not_stored(hot):
+    hot.set_latest('1', 'VIN', T0, b'x' * hot.max_body + b'x')
+    assert hot.get_latest('1') == (None, None)
+
+def test_devices_need_seeding(hot):
+    hot.touch('1', 'VIN1', T0)
+    assert hot.devices(LONG_AGO) is None
+    hot.seed_devices([('1', 'VIN1', T0), ('2', '', T0 + timedelta(hours=1)), ('3', None, None)])
+    assert hot.devices(LONG_AGO) == [('2', None, T0 + timedelta(hours=1)), ('1', 'VIN1', T0)]
+    assert hot.devices(T0) == [('2', None, T0 + timedelta(hours=1))]
+
+def test_full_table_leaves_devices_unseeded(hot):
+    rows = [(str(i), '', T0) for i in range(hot.slots + 1)]
+    hot.seed_devices(rows)
+    assert hot.devices(LONG_AGO) is None
+    assert not hot.stats()['devices_seeded']
+
+def test_device_beyond_a_full_table_unseeds_the_list(hot):
+    hot.seed_devices([(str(i), '', T0) for i in range(hot.slots)])
+    assert len(hot.devices(LONG_AGO)) == hot.slots
+    assert hot.touch('1', '', T0 + timedelta(seconds=1))
+    assert not hot.touch('new', '', T0)
+    assert hot.devices(LONG_AGO) is None
+
+def test_clear(hot):
+    hot.seed_devices([('1', '', T0)])
+    hot.clear()
+    assert hot.newest('1') is None
+    assert hot.devices(LONG_AGO) is None
+    assert hot.stats()['clears'] == 1
+
+def test_first_listener_clears(hot):
+    hot.touch('1', '', T0)
+    assert hot.listener_connected()
+    assert hot.newest('1') is None
+    assert hot.stats()['listeners'] == 1
+
+def test_reconnect_while_another_listener_is_live_keeps_the_table(hot):
+    hot.listener_connected(os.getppid())
+    hot.touch('1', '', T0)
+    assert not hot.listener_connected()
+    assert not hot.listener_connected()  # reconnect of the same process
+    assert hot.newest('1') == T0
+    assert hot.stats()['listeners'] == 2
+
+def test_listener_gone_or_dead_clears(hot):
+    hot.listener_connected(os.getppid())
+    hot.listener_disconnected(os.getppid())
+    hot.touch('1', '', T0)
+    assert hot.listener_connected()
+    assert hot.newest('1') is None
+
+    hot.listener_disconnected()
+    hot.listener_connected(dead_pid())
+    hot.touch('1', '', T0)
+    assert hot.listener_connected()
+    assert hot.newest('1') is None
+    assert hot.stats()['listeners'] == 1
+
+def test_init_returns_one_segment(monkeypatch):
+    monkeypatch.setattr(hot_state, 'hot_state', None)
+    first = hot_state.init(slots=4, slot_size=256)
+    try:
+        assert hot_state.init() is first
+    finally:
+        first.close()
@@ -0,0 +1,32 @@
+"""Metrics summed across worker snapshots in METRICS_DIR (needs psycopg2)"""
+
+import json
+import os
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+import metrics
+
+def test_render_sums_worker_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    other = {
+        'http_slow_requests_total': [[['/x'], 2]],
+        'http_request_duration_seconds': [[['/x', 'GET', 200], [1] * 13 + [0.004, 1]]]
+    }
+    (tmp_path / 'metrics_1.json').write_text(json.dumps(other))
+    metrics.SLOW_REQUESTS.inc('/x')
+    metrics.REQUEST_DURATION.observe(0.003, '/x', 'GET', 200)
+
+    text = metrics.render()
+    own = dict((tuple(k), v) for k, v in metrics.SLOW_REQUESTS.snapshot())[('/x',)]
+    assert f'http_slow_requests_total{{route="/x"}} {own + 2}' in text
+    count = dict((tuple(k), v) for k, v in metrics.REQUEST_DURATION.snapshot())[('/x', 'GET', 200)][-1]
+    assert f'http_request_duration_seconds_count{{route="/x",method="GET",status="200"}} {count + 1}' in text
+    assert os.path.exists(tmp_path / f'metrics_{os.getpid()}.json')
+
+def test_render_without_metrics_dir_is_process_local(monkeypatch):
+    monkeypatch.delenv('METRICS_DIR', raising=False)
+    metrics.SLOW_REQUESTS.inc('/local')
+    assert 'http_slow_requests_total{route="/local"}' in metrics.render()
@@ -0,0 +1,51 @@
+import time
+
+from response_cache import ANY_IMEI, ResponseCache
+
+def test_get_and_set():
+    cache = ResponseCache()
+    assert cache.get('a') is None
+    assert cache.set('a', '1', b'body')
+    assert cache.get('a') == b'body'
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1 and stats['entries'] == 1
+
+def test_entries_expire():
+    cache = ResponseCache(ttl=0.01)
+    cache.set('a', '1', b'body')
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0
+
+def test_least_recently_used_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.set('a', '1', b'a')
+    cache.set('b', '2', b'b')
+    cache.get('a')
+    cache.set('c', '3', b'c')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'a' and cache.get('c') == b'c'
+    assert cache.stats()['evictions'] == 1
+
+def test_invalidate_drops_the_device_and_default_entries():
+    cache = ResponseCache()
+    cache.set('one', '1', b'1')
+    cache.set('two', '2', b'2')
+    cache.set('default', ANY_IMEI, b'*')
+    cache.invalidate('1')
+    assert cache.get('one') is None and cache.get('default') is None
+    assert cache.get('two') == b'2'
+
+def test_value_computed_across_an_invalidation_is_not_stored():
+    cache = ResponseCache()
+    version = cache.version('1')
+    default_version = cache.version(ANY_IMEI)
+    cache.invalidate('1')
+    assert not cache.set('one', '1', b'stale', version)
+    assert not cache.set('default', ANY_IMEI, b'stale', default_version)
+    assert cache.get('one') is None and cache.get('default') is None
+    # Another device's invalidation doesn't affect it
+    version = cache.version('1')
+    cache.invalidate('2')
+    assert cache.set('one', '1', b'fresh', version)
+    assert cache.get('one') == b'fresh'
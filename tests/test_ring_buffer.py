@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+
+from hot_state import to_micros
+from ring_buffer import COLUMNS, DeviceRing, RingBuffers
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+def at(seconds):
+    return T0 + timedelta(seconds=seconds)
+
+def values(speed):
+    row = [None] * len(COLUMNS)
+    row[0], row[1], row[3] = 38.5, -121.5, speed
+    return row
+
+def seed_rows(times, vin='VIN'):
+    """SEED_SQL rows, newest first"""
+    return [(at(t), *values(float(t)), vin) for t in sorted(times, reverse=True)]
+
+def record(imei, seconds, speed=10.0, vin='Unknown'):
+    io = {name: {'value': None} for name in
+          ('external_voltage', 'battery_voltage', 'ignition', 'movement', 'gsm_signal', 'total_odometer')}
+    io['ignition'] = {'value': 1}
+    return {
+        'imei': imei,
+        'vin': vin,
+        'datetime': at(seconds).isoformat(),
+        'gps': {'latitude': 38.5, 'longitude': -121.5, 'altitude': 10, 'speed_kmh': speed,
+                'angle': 90, 'satellites': 9},
+        'io': io
+    }
+
+class FakeCursor:
+    def __init__(self, rows, during_query=None):
+        self.rows = rows
+        self.during_query = during_query
+
+    def execute(self, query, params):
+        if self.during_query:
+            self.during_query()
+
+    def fetchall(self):
+        return self.rows
+
+def test_unseeded_ring_answers_nothing():
+    ring = DeviceRing('1', size=4)
+    ring.add(to_micros(at(1)), values(1))
+    assert ring.latest(['speed_kmh']) is None
+    assert ring.rows(['speed_kmh'], to_micros(at(0)), 10) is None
+
+def test_short_history_is_complete():
+    ring = DeviceRing('1', size=4)
+    ring.seed(seed_rows([1, 2]))
+    assert ring.complete_from == 0
+    assert ring.latest(['speed_kmh', 'vin']) == (at(2), 2.0, 'VIN')
+    assert ring.rows(['speed_kmh'], 0, 10) == [(at(2), 2.0), (at(1), 1.0)]
+
+def test_wrapping_moves_the_horizon():
+    ring = DeviceRing('1', size=3)
+    ring.seed(seed_rows([1, 2, 3]))
+    assert ring.complete_from == to_micros(at(1))
+    ring.add(to_micros(at(4)), values(4.0))
+    assert ring.complete_from == to_micros(at(2))
+    assert ring.rows(['speed_kmh'], to_micros(at(2)), 10) == [(at(4), 4.0), (at(3), 3.0), (at(2), 2.0)]
+    # Reaching before the horizon only answers with a full page
+    assert ring.rows(['speed_kmh'], to_micros(at(0)), 10) is None
+    assert ring.rows(['speed_kmh'], to_micros(at(0)), 2) == [(at(4), 4.0), (at(3), 3.0)]
+
+def test_late_and_repeated_rows_keep_time_order():
+    ring = DeviceRing('1', size=4)
+    ring.seed(seed_rows([1, 3]))
+    ring.add(to_micros(at(2)), values(2.0))
+    ring.add(to_micros(at(3)), values(30.0))
+    assert ring.rows(['speed_kmh'], 0, 10) == [(at(3), 30.0), (at(2), 2.0), (at(1), 1.0)]
+    # Older than anything the ring vouches for once it's full
+    ring.add(to_micros(at(4)), values(4.0))
+    ring.add(to_micros(at(5)), values(5.0))
+    ring.add(to_micros(at(0)), values(0.0))
+    assert [row[0] for row in ring.rows(['speed_kmh'], 0, 1)] == [at(5)]
+    assert ring.newest() == to_micros(at(5))
+
+def test_rows_notified_during_the_seed_query_are_kept():
+    ring = DeviceRing('1', size=4)
+    ring.add(to_micros(at(3)), values(3.0))
+    ring.seed(seed_rows([1, 2]))
+    assert [row[0] for row in ring.rows([], 0, 10)] == [at(3), at(2), at(1)]
+
+def test_missing_values_come_back_as_none():
+    ring = DeviceRing('1', size=4)
+    ring.seed(seed_rows([1]))
+    assert ring.latest(['altitude', 'ignition', 'speed_kmh']) == (at(1), None, None, 1.0)
+
+def test_buffers_follow_notifications_once_seeded():
+    buffers = RingBuffers(size=4)
+    buffers.on_record(record('1', 2, vin='VIN2'))
+    assert buffers.latest('1', ['speed_kmh']) is None
+    buffers.seed(FakeCursor(seed_rows([1])), '1')
+    buffers.on_record(record('1', 3, speed=33.0))
+    assert buffers.latest('1', ['speed_kmh', 'ignition', 'vin']) == (at(3), 33.0, 1, 'VIN2')
+    assert len(buffers.rows('1', ['speed_kmh'], at(0), 10)) == 3
+    stats = buffers.stats()
+    assert stats['seeded'] == 1 and stats['seeds'] == 1
+    assert stats['hits'] == 2 and stats['misses'] == 1
+
+def test_seeding_happens_once():
+    buffers = RingBuffers(size=4)
+    buffers.seed(FakeCursor(seed_rows([1])), '1')
+    buffers.seed(FakeCursor(seed_rows([1, 2])), '1')
+    assert buffers.stats()['seeds'] == 1
+
+def test_reconnect_drops_rings_and_discards_a_racing_seed():
+    buffers = RingBuffers(size=4)
+    buffers.sync(1)
+    buffers.seed(FakeCursor(seed_rows([1])), '1')
+    buffers.sync(1)
+    assert buffers.latest('1', []) is not None
+    buffers.sync(2)
+    assert buffers.latest('1', []) is None
+    buffers.seed(FakeCursor(seed_rows([1]), during_query=lambda: buffers.sync(3)), '1')
+    assert buffers.latest('1', []) is None
+
+def test_least_recently_used_devices_are_evicted():
+    buffers = RingBuffers(size=4, max_devices=2)
+    for imei in ('1', '2', '3'):
+        buffers.on_record(record(imei, 1))
+    assert buffers.stats()['devices'] == 2
+    assert buffers.io_snapshot('1', at(1)) is None
+
+def test_io_elements_of_the_newest_row():
+    buffers = RingBuffers(size=4)
+    buffers.seed(FakeCursor(seed_rows([1, 2])), '1')
+    buffers.set_io('1', at(1), {'old': 1})
+    assert buffers.io_snapshot('1', at(1)) is None
+    buffers.set_io('1', at(2), {'ignition': 1})
+    assert buffers.io_snapshot('1', at(2)) == {'ignition': 1}
@@ -0,0 +1,48 @@
+import csv
+import io
+from datetime import datetime, timezone
+
+import pytest
+
+import telemetry_export
+from telemetry_export import ExportError, _csv_chunks
+
+COLUMNS = ['time', 'imei', 'latitude', 'vin']
+
+def parse(chunks):
+    return list(csv.reader(io.StringIO(b''.join(chunks).decode())))
+
+def test_csv_writes_one_chunk_per_group():
+    groups = [
+        [['2025-01-01 00:00:00+00', '1', 38.5, 'VIN1'], ['2025-01-01 00:00:01+00', '1', 38.6, None]],
+        [['2025-01-01 00:00:02+00', '2', None, 'VIN, "quoted"']]
+    ]
+    chunks = list(_csv_chunks(iter(groups), COLUMNS))
+    assert len(chunks) == 2
+    assert chunks[0].startswith(b'time,imei,latitude,vin\r\n')
+    assert parse(chunks) == [
+        COLUMNS,
+        ['2025-01-01 00:00:00+00', '1', '38.5', 'VIN1'],
+        ['2025-01-01 00:00:01+00', '1', '38.6', ''],
+        ['2025-01-01 00:00:02+00', '2', '', 'VIN, "quoted"']
+    ]
+
+def test_csv_without_rows_is_just_the_header():
+    chunks = list(_csv_chunks(iter([]), COLUMNS))
+    assert parse(chunks) == [COLUMNS]
+
+def test_csv_is_generated_lazily():
+    def groups():
+        yield [['t', '1', 1.0, None]]
+        raise AssertionError('read past the first group')
+    chunks = _csv_chunks(groups(), COLUMNS)
+    assert parse([next(chunks)]) == [COLUMNS, ['t', '1', '1.0', '']]
+
+def test_check_format():
+    telemetry_export.check_format('csv')
+    with pytest.raises(ExportError, match='Unknown format'):
+        telemetry_export.check_format('xlsx')
+
+def test_parse_time_defaults_to_utc():
+    assert telemetry_export.parse_time('2025-01-01') == datetime(2025, 1, 1, tzinfo=timezone.utc)
+    assert telemetry_export.parse_time('2025-01-01T02:00:00+02:00') == datetime(2025, 1, 1, tzinfo=timezone.utc)
@@ -0,0 +1,89 @@
+import pytest
+
+import teltonika_codec
+from teltonika_codec import CODEC_8, CODEC_8E, CodecError, build_packet, crc16, parse_packet
+
+# Codec 8 example packet from the Teltonika protocol documentation
+DOC_PACKET = bytes.fromhex(
+    '000000000000003608010000016B40D8EA30010000000000000000000000000000000105021503010101425E0F01F1'
+    '0000601A014E0000000000000000010000C7CF'
+)
+
+def make_record(timestamp=1700000000000, io=None):
+    return {
+        'timestamp': timestamp,
+        'priority': 1,
+        'gps': {'latitude': 38.5816, 'longitude': -121.4944, 'altitude': 12, 'angle': 270,
+                'satellites': 11, 'speed_kmh': 64},
+        'event_io_id': 239,
+        'io': io if io is not None else {
+            'ignition': {'id': 239, 'value': 1},
+            'gsm_signal': {'id': 21, 'value': 4},
+            'external_voltage': {'id': 66, 'value': 13800},
+            'total_odometer': {'id': 16, 'value': 123456789},
+            'io_9999': {'id': 9999, 'value': 2 ** 40}
+        }
+    }
+
+def test_crc16_check_value():
+    assert crc16(b'123456789') == 0xBB3D
+    assert crc16(b'') == 0
+
+def test_documentation_packet():
+    result = parse_packet(DOC_PACKET, verify_crc=True)
+    assert result['codec_id'] == CODEC_8
+    assert result['crc'] == 0xC7CF
+    record, = result['records']
+    assert record['timestamp'] == 1560161086000
+    assert record['event_io_id'] == 1
+    assert record['io']['external_voltage']['value'] == 24079
+    assert record['io']['io_78'] == {'id': 78, 'value': 0, 'description': 'Unknown IO Element 78'}
+
+@pytest.mark.parametrize('codec_id', [CODEC_8, CODEC_8E])
+def test_round_trip(codec_id):
+    records = [make_record(1700000000000 + i * 1000) for i in range(3)]
+    if codec_id == CODEC_8:
+        # Codec 8 IO ids are one byte
+        for record in records:
+            del record['io']['io_9999']
+    result = parse_packet(build_packet(records, codec_id), verify_crc=True)
+    assert result['codec_id'] == codec_id
+    assert result['num_records'] == 3
+    for sent, received in zip(records, result['records']):
+        assert received['timestamp'] == sent['timestamp']
+        assert received['gps']['latitude'] == pytest.approx(sent['gps']['latitude'])
+        assert received['gps']['longitude'] == pytest.approx(sent['gps']['longitude'])
+        assert received['gps']['speed_kmh'] == 64
+        assert received['gps']['valid']
+        assert {name: element['value'] for name, element in received['io'].items()} == \
+            {name: element['value'] for name, element in sent['io'].items()}
+
+def test_variable_length_io_round_trip():
+    record = make_record(io={'iccid': {'id': 11, 'value': '8901260882212345678f'}})
+    io = parse_packet(build_packet([record]), verify_crc=True)['records'][0]['io']
+    assert list(io.values())[0]['value'] == '8901260882212345678f'
+    with pytest.raises(CodecError):
+        build_packet([record], CODEC_8)
+
+def test_corrupted_packet_fails_crc():
+    packet = bytearray(build_packet([make_record()]))
+    packet[20] ^= 0xFF
+    with pytest.raises(CodecError, match='CRC mismatch'):
+        parse_packet(bytes(packet), verify_crc=True)
+    # Without verification the (wrong) values are still decoded
+    assert parse_packet(bytes(packet))['num_records'] == 1
+
+def test_truncated_packet_keeps_decoded_records():
+    packet = build_packet([make_record(), make_record(1700000001000)])
+    with pytest.raises(CodecError) as error:
+        parse_packet(packet[:len(packet) - 30])
+    assert len(error.value.records) == 1
+
+def test_unsupported_codec():
+    with pytest.raises(CodecError, match='Unsupported codec'):
+        parse_packet(bytes.fromhex('00000000000000041001000000'))
+    with pytest.raises(CodecError, match='too short'):
+        parse_packet(b'\0\0')
+
+def test_unknown_io_names():
+    assert teltonika_codec.get_io_info(65000) == {'name': 'io_65000', 'description': 'Unknown IO Element 65000'}
@@ -0,0 +1,63 @@
+import math
+
+import track_simplify
+from track_simplify import simplify_indices
+
+def line(count, lat=38.5, lon=-121.5, step=0.0001):
+    return [lat] * count, [lon + i * step for i in range(count)]
+
+def test_short_and_unsimplified_tracks_keep_every_point():
+    lats, lons = line(10)
+    assert simplify_indices(lats[:2], lons[:2], tolerance_m=5) == [0, 1]
+    assert simplify_indices(lats, lons) == list(range(10))
+
+def test_points_without_coordinates_are_dropped():
+    lats, lons = line(5)
+    lats[2] = None
+    lons[3] = 0
+    assert simplify_indices(lats, lons) == [0, 1, 4]
+
+def test_straight_line_keeps_only_its_ends():
+    lats, lons = line(200)
+    assert simplify_indices(lats, lons, tolerance_m=1) == [0, 199]
+
+def test_detour_beyond_tolerance_is_kept():
+    lats, lons = line(101)
+    # A gentle bend peaking ~110 m off the line at the middle point
+    lats = [lat + 0.00002 * min(i, 100 - i) for i, lat in enumerate(lats)]
+    assert simplify_indices(lats, lons, tolerance_m=50) == [0, 50, 100]
+    assert simplify_indices(lats, lons, tolerance_m=200) == [0, 100]
+
+def test_stops_are_kept():
+    lats, lons = line(100)
+    speeds = [40] * 100
+    speeds[30:40] = [0] * 10
+    kept = simplify_indices(lats, lons, speeds, tolerance_m=1)
+    assert {0, 29, 30, 39, 40, 99} <= set(kept)
+
+def test_max_points_keeps_the_most_significant():
+    lats = [38.5 + 0.001 * math.sin(i / 5) for i in range(500)]
+    lons = [-121.5 + i * 0.0001 for i in range(500)]
+    kept = simplify_indices(lats, lons, max_points=20)
+    assert len(kept) <= 20
+    assert kept[0] == 0 and kept[-1] == 499
+    assert kept == sorted(kept)
+
+def test_long_tracks_are_split_into_segments():
+    count = track_simplify.SEGMENT_POINTS * 2 + 10
+    lats, lons = line(count)
+    kept = simplify_indices(lats, lons, tolerance_m=1)
+    assert kept == [0, track_simplify.SEGMENT_POINTS, track_simplify.SEGMENT_POINTS * 2, count - 1]
+
+def test_vectorised_and_plain_distances_agree():
+    lats = [38.5 + 0.001 * math.sin(i / 7) for i in range(300)]
+    lons = [-121.5 + i * 0.0001 for i in range(300)]
+    vector_min = track_simplify.VECTOR_MIN_POINTS
+    try:
+        track_simplify.VECTOR_MIN_POINTS = 10 ** 9
+        plain = simplify_indices(lats, lons, tolerance_m=3)
+        track_simplify.VECTOR_MIN_POINTS = 2
+        vectorised = simplify_indices(lats, lons, tolerance_m=3)
+    finally:
+        track_simplify.VECTOR_MIN_POINTS = vector_min
+    assert plain == vectorised
@@ -0,0 +1,143 @@
+"""
+POPTOP Track Simplification - Thin GPS tracks for map rendering
+Douglas-Peucker over a local metric projection. Start, end, stop and turn
+points are always kept. Every other point gets a significance (the DP
+tolerance at which it would be dropped), so one run answers both a
+`tolerance_m` and a `max_points` request.
+
+Projection, stop and turn detection are single numpy passes, and each DP
+split of a long segment measures it in one vectorised pass. DP still costs
+O(n²) distance evaluations in the worst case (e.g. a spiral), so tracks are
+also split every SEGMENT_POINTS points. That bounds a run at
+O(n · SEGMENT_POINTS), and each split point is kept.
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000
+
+# A point is part of a stop at or below this speed
+STOP_SPEED_KMH = 1.0
+
+# Heading change that marks a turn, and the minimum leg length for it to count
+TURN_ANGLE_DEG = 60.0
+TURN_MIN_LEG_M = 5.0
+
+# Longest run of points Douglas-Peucker works on at once
+SEGMENT_POINTS = 5000
+
+# Below this many points a plain loop beats numpy's per-call overhead
+VECTOR_MIN_POINTS = 64
+
+def _farthest(xs, ys, start, end):
+    """(index, distance) of the point farthest from segment start-end, on lists"""
+    ax, ay, bx, by = xs[start], ys[start], xs[end], ys[end]
+    dx = bx - ax
+    dy = by - ay
+    length_sq = dx * dx + dy * dy
+    best, best_dist = None, -1.0
+    for k in range(start + 1, end):
+        px, py = xs[k], ys[k]
+        if length_sq == 0:
+            d = math.hypot(px - ax, py - ay)
+        else:
+            t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+            d = math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+        if d > best_dist:
+            best, best_dist = k, d
+    return best, best_dist
+
+def _segment_distances(xs, ys, start, end):
+    """Distances in meters from points start+1..end-1 to segment start-end"""
+    px = xs[start + 1:end]
+    py = ys[start + 1:end]
+    ax, ay, bx, by = xs[start], ys[start], xs[end], ys[end]
+    dx = bx - ax
+    dy = by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return np.hypot(px - ax, py - ay)
+    t = np.clip(((px - ax) * dx + (py - ay) * dy) / length_sq, 0.0, 1.0)
+    return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+def simplify_indices(lats, lons, speeds=None, tolerance_m=None, max_points=None):
+    """
+    Return the sorted indices of the points to keep.
+    Points without coordinates are dropped. With neither tolerance_m nor
+    max_points every located point is kept.
+    """
+    lats = np.array([float(lat) if lat else np.nan for lat in lats])
+    lons = np.array([float(lon) if lon else np.nan for lon in lons])
+    index = np.flatnonzero(~(np.isnan(lats) | np.isnan(lons)))
+    count = len(index)
+    if count <= 2 or (tolerance_m is None and max_points is None):
+        return index.tolist()
+
+    # Project to meters around the first point's latitude
+    lat = np.radians(lats[index])
+    xs = np.radians(lons[index]) * EARTH_RADIUS_M * math.cos(lat[0])
+    ys = lat * EARTH_RADIUS_M
+
+    forced = np.zeros(count, dtype=bool)
+    forced[[0, count - 1]] = True
+    forced[::SEGMENT_POINTS] = True
+
+    # Keep the first and last point of every stop
+    if speeds is not None:
+        stopped = np.array([(speeds[i] or 0) <= STOP_SPEED_KMH for i in index.tolist()])
+        changes = np.flatnonzero(stopped[1:] != stopped[:-1])
+        forced[changes] = True
+        forced[changes + 1] = True
+
+    # Keep the vertex of every sharp turn
+    dx = np.diff(xs)
+    dy = np.diff(ys)
+    legs = np.hypot(dx, dy)
+    headings = np.degrees(np.arctan2(dy, dx))
+    turn = np.abs(headings[1:] - headings[:-1]) % 360
+    turn = np.where(turn > 180, 360 - turn, turn)
+    sharp = (legs[:-1] >= TURN_MIN_LEG_M) & (legs[1:] >= TURN_MIN_LEG_M) & (turn >= TURN_ANGLE_DEG)
+    forced[np.flatnonzero(sharp) + 1] = True
+
+    # Douglas-Peucker between consecutive forced points. A point's
+    # significance is capped by its parent's so thresholds nest.
+    significance = np.zeros(count)
+    xs_list, ys_list = xs.tolist(), ys.tolist()
+    anchors = np.flatnonzero(forced).tolist()
+    stack = [(a, b, math.inf) for a, b in zip(anchors, anchors[1:]) if b - a > 1]
+    while stack:
+        start, end, parent = stack.pop()
+        if end - start < VECTOR_MIN_POINTS:
+            best, distance = _farthest(xs_list, ys_list, start, end)
+        else:
+            distances = _segment_distances(xs, ys, start, end)
+            best = int(np.argmax(distances))
+            distance = float(distances[best])
+            best += start + 1
+        sig = min(distance, parent)
+        significance[best] = sig
+        if best - start > 1:
+            stack.append((start, best, sig))
+        if end - best > 1:
+            stack.append((best, end, sig))
+
+    keep = set(anchors)
+    candidates = np.flatnonzero(~forced)
+    if tolerance_m is not None:
+        candidates = candidates[significance[candidates] > tolerance_m]
+    candidates = candidates.tolist()
+    if max_points is not None:
+        budget = max_points - len(keep)
+        if budget <= 0:
+            # More forced points than allowed: sample them evenly, keeping both ends
+            ordered = sorted(keep)
+            step = (len(ordered) - 1) / max(max_points - 1, 1)
+            keep = {ordered[round(i * step)] for i in range(max(max_points, 2))}
+            candidates = []
+        elif len(candidates) > budget:
+            candidates = heapq.nlargest(budget, candidates, key=significance.__getitem__)
+    keep.update(candidates)
+    return index[sorted(keep)].tolist()
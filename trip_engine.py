@@ -0,0 +1,442 @@
+"""
+POPTOP Trip Engine - Incremental trip segmentation
+Trips are detected once and persisted in the `trips` table. A per-IMEI
+checkpoint in `trip_checkpoints` remembers the last telemetry time processed
+and the trip that is still open, so every run only scans newer rows.
+
+Detection runs in the background (TripUpdater), in whichever process holds
+the trip_engine advisory lock; the API only reads the trips table.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+import geo_stats
+import metrics
+from db_pool import DB_CONFIG, try_advisory_lock
+
+log = logging.getLogger(__name__)
+
+# Trips shorter than this are discarded once they close
+MIN_TRIP_DURATION_MS = 60000
+
+# Rows pulled per round trip from the server-side cursor and processed as one batch
+FETCH_SIZE = 2000
+
+# Seconds between background catch-up rounds
+UPDATE_INTERVAL = float(os.environ.get('TRIP_UPDATE_INTERVAL', 15))
+
+# Recently active devices with telemetry past their checkpoint
+PENDING_DEVICES_SQL = """
+    SELECT t.imei
+    FROM (
+        SELECT imei, MAX(time) AS newest FROM telemetry
+        WHERE time > NOW() - INTERVAL '7 days'
+        GROUP BY imei
+    ) t
+    LEFT JOIN trip_checkpoints c ON c.imei = t.imei
+    WHERE c.last_time IS NULL OR t.newest > c.last_time
+"""
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS trips (
+    id BIGSERIAL PRIMARY KEY,
+    imei TEXT NOT NULL,
+    vin TEXT,
+    start_time TIMESTAMPTZ NOT NULL,
+    end_time TIMESTAMPTZ NOT NULL,
+    start_latitude DOUBLE PRECISION,
+    start_longitude DOUBLE PRECISION,
+    end_latitude DOUBLE PRECISION,
+    end_longitude DOUBLE PRECISION,
+    start_odometer BIGINT,
+    end_odometer BIGINT,
+    gps_distance_m DOUBLE PRECISION NOT NULL DEFAULT 0,
+    max_speed DOUBLE PRECISION NOT NULL DEFAULT 0,
+    speed_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    speed_count INTEGER NOT NULL DEFAULT 0,
+    point_count INTEGER NOT NULL DEFAULT 0,
+    ongoing BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+CREATE INDEX IF NOT EXISTS trips_imei_end_time_idx ON trips (imei, end_time DESC);
+
+CREATE TABLE IF NOT EXISTS trip_checkpoints (
+    imei TEXT PRIMARY KEY,
+    last_time TIMESTAMPTZ NOT NULL,
+    open_trip_id BIGINT REFERENCES trips (id) ON DELETE SET NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+TRIP_COLUMNS = (
+    'vin', 'start_time', 'end_time',
+    'start_latitude', 'start_longitude', 'end_latitude', 'end_longitude',
+    'start_odometer', 'end_odometer', 'gps_distance_m',
+    'max_speed', 'speed_sum', 'speed_count', 'point_count', 'ongoing'
+)
+
+_schema_ready = False
+
+def ensure_schema(conn):
+    """Create the trips and trip_checkpoints tables if they don't exist"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA_SQL)
+    cursor.close()
+    conn.commit()
+    _schema_ready = True
+
+def _load_trip(cursor, trip_id):
+    """Load an open trip row back into the in-memory state dict"""
+    cursor.execute(
+        f"SELECT id, {', '.join(TRIP_COLUMNS)} FROM trips WHERE id = %s",
+        (trip_id,)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return dict(zip(('id',) + TRIP_COLUMNS, row))
+
+def _save_trip(cursor, imei, trip):
+    """Insert or update a trip row, returning its id"""
+    values = [trip[col] for col in TRIP_COLUMNS]
+    if trip['id'] is None:
+        cursor.execute(
+            f"""
+            INSERT INTO trips (imei, {', '.join(TRIP_COLUMNS)})
+            VALUES (%s, {', '.join(['%s'] * len(TRIP_COLUMNS))})
+            RETURNING id
+            """,
+            [imei] + values
+        )
+        trip['id'] = cursor.fetchone()[0]
+    else:
+        cursor.execute(
+            f"""
+            UPDATE trips SET {', '.join(f'{col} = %s' for col in TRIP_COLUMNS)}
+            WHERE id = %s
+            """,
+            values + [trip['id']]
+        )
+    return trip['id']
+
+def _close_trip(cursor, imei, trip):
+    """Persist a finished trip, or drop it if it was too short"""
+    duration_ms = (trip['end_time'] - trip['start_time']).total_seconds() * 1000
+    if duration_ms > MIN_TRIP_DURATION_MS:
+        trip['ongoing'] = False
+        _save_trip(cursor, imei, trip)
+    elif trip['id'] is not None:
+        cursor.execute("DELETE FROM trips WHERE id = %s", (trip['id'],))
+
+def _process_batch(cursor, imei, rows, current_trip):
+    """
+    Segment one batch of telemetry rows (oldest first) into trips.
+    Per-point work is done on arrays; the Python loop runs once per trip.
+    Returns the trip still open at the end of the batch, if any.
+    """
+    lat = geo_stats.to_array([row[1] for row in rows])
+    lon = geo_stats.to_array([row[2] for row in rows])
+    speed = np.nan_to_num(np.array([row[3] for row in rows], dtype=float))
+    ignition = np.array([bool(row[4]) for row in rows])
+    time_s = np.array([row[0].timestamp() for row in rows])
+
+    # Prepend the open trip's last point so the first step of the batch counts
+    carry = 1 if current_trip is not None else 0
+    if carry:
+        lat = np.concatenate(([current_trip['end_latitude'] or np.nan], lat))
+        lon = np.concatenate(([current_trip['end_longitude'] or np.nan], lon))
+        time_s = np.concatenate(([current_trip['end_time'].timestamp()], time_s))
+    distance = geo_stats.cumulative_distance(
+        lat, lon, time_s, max_speed_kmh=geo_stats.MAX_PLAUSIBLE_SPEED_KMH
+    )
+    lat = lat[carry:]
+    lon = lon[carry:]
+    distance = distance[carry:]
+
+    # Trip start: ignition on with a fix. Trip end: ignition off (inclusive).
+    starts = np.flatnonzero(ignition & ~np.isnan(lat) & ~np.isnan(lon))
+    stops = np.flatnonzero(~ignition)
+
+    n = len(rows)
+    pos = 0
+    while pos < n:
+        if current_trip is None:
+            i = np.searchsorted(starts, pos)
+            if i == len(starts):
+                break
+            pos = int(starts[i])
+            row = rows[pos]
+            current_trip = {
+                'id': None,
+                'vin': row[6] if row[6] else 'Unknown',
+                'start_time': row[0],
+                'end_time': row[0],
+                'start_latitude': float(lat[pos]),
+                'start_longitude': float(lon[pos]),
+                'end_latitude': None,
+                'end_longitude': None,
+                'start_odometer': row[5],
+                'end_odometer': row[5],
+                'gps_distance_m': 0,
+                'max_speed': float(speed[pos]),
+                'speed_sum': 0,
+                'speed_count': 0,
+                'point_count': 0,
+                'ongoing': True
+            }
+            first = distance[pos]
+        else:
+            # Continuing trip: include the step from its previous point
+            first = distance[pos - 1] if pos else 0.0
+
+        i = np.searchsorted(stops, pos)
+        end = int(stops[i]) if i < len(stops) else n - 1
+
+        max_speed, speed_sum, speed_count = geo_stats.speed_stats(speed[pos:end + 1])
+        current_trip['gps_distance_m'] += float(distance[end] - first)
+        current_trip['max_speed'] = max(current_trip['max_speed'], max_speed)
+        current_trip['speed_sum'] += speed_sum
+        current_trip['speed_count'] += speed_count
+        current_trip['point_count'] += end - pos + 1
+        current_trip['end_time'] = rows[end][0]
+        current_trip['end_latitude'] = None if np.isnan(lat[end]) else float(lat[end])
+        current_trip['end_longitude'] = None if np.isnan(lon[end]) else float(lon[end])
+        current_trip['end_odometer'] = rows[end][5]
+
+        if i < len(stops):
+            _close_trip(cursor, imei, current_trip)
+            current_trip = None
+        pos = end + 1
+    return current_trip
+
+def update_trips(conn, imei):
+    """
+    Run trip detection over telemetry newer than the IMEI's checkpoint.
+    Returns the number of telemetry rows processed.
+
+    Rows that arrive with a time older than the checkpoint (late device
+    buffers) are not re-segmented.
+    """
+    cursor = conn.cursor()
+    try:
+        # Serialize concurrent updates for the same device
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (imei,))
+        cursor.execute(
+            "SELECT last_time, open_trip_id FROM trip_checkpoints WHERE imei = %s",
+            (imei,)
+        )
+        checkpoint = cursor.fetchone()
+        last_time = checkpoint[0] if checkpoint else None
+        current_trip = _load_trip(cursor, checkpoint[1]) if checkpoint and checkpoint[1] else None
+
+        # Stream new rows through a server-side cursor in batches so the first
+        # backfill of a long history does not load it all into memory
+        rows = conn.cursor(name='trip_engine_rows')
+        if last_time is None:
+            rows.execute("""
+                SELECT time, latitude, longitude, speed_kmh, ignition, odometer_m, vin
+                FROM telemetry
+                WHERE imei = %s
+                ORDER BY time ASC
+            """, (imei,))
+        else:
+            rows.execute("""
+                SELECT time, latitude, longitude, speed_kmh, ignition, odometer_m, vin
+                FROM telemetry
+                WHERE imei = %s AND time > %s
+                ORDER BY time ASC
+            """, (imei, last_time))
+
+        processed = 0
+        while True:
+            batch = rows.fetchmany(FETCH_SIZE)
+            if not batch:
+                break
+            processed += len(batch)
+            last_time = batch[-1][0]
+            current_trip = _process_batch(cursor, imei, batch, current_trip)
+        rows.close()
+
+        if processed == 0:
+            conn.commit()
+            return 0
+
+        open_trip_id = _save_trip(cursor, imei, current_trip) if current_trip else None
+        cursor.execute("""
+            INSERT INTO trip_checkpoints (imei, last_time, open_trip_id, updated_at)
+            VALUES (%s, %s, %s, NOW())
+            ON CONFLICT (imei) DO UPDATE
+            SET last_time = EXCLUDED.last_time,
+                open_trip_id = EXCLUDED.open_trip_id,
+                updated_at = EXCLUDED.updated_at
+        """, (imei, last_time, open_trip_id))
+        conn.commit()
+        return processed
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def _ms(value):
+    return int(value.timestamp() * 1000)
+
+def _distance_km(trip):
+    # Prefer the odometer, fall back to the accumulated GPS distance
+    if trip['end_odometer'] and trip['start_odometer']:
+        distance = trip['end_odometer'] - trip['start_odometer']
+    else:
+        distance = trip['gps_distance_m']
+    return distance / 1000  # Convert to km
+
+def _avg_speed(trip):
+    avg_speed = trip['speed_sum'] / trip['speed_count'] if trip['speed_count'] > 0 else 0
+    return round(avg_speed, 1)
+
+# Summary fields: name -> (trip columns needed, builder)
+SUMMARY_FIELDS = {
+    'id': (('id',), lambda trip: trip['id']),
+    'start_time': (('start_time',), lambda trip: _ms(trip['start_time'])),
+    'start_datetime': (('start_time',), lambda trip: trip['start_time'].isoformat()),
+    'start_location': (('start_latitude', 'start_longitude'),
+                       lambda trip: {'latitude': trip['start_latitude'], 'longitude': trip['start_longitude']}),
+    'end_time': (('end_time',), lambda trip: _ms(trip['end_time'])),
+    'end_datetime': (('end_time',), lambda trip: trip['end_time'].isoformat()),
+    'end_location': (('end_latitude', 'end_longitude'),
+                     lambda trip: {'latitude': trip['end_latitude'], 'longitude': trip['end_longitude']}),
+    'duration_ms': (('start_time', 'end_time'), lambda trip: _ms(trip['end_time']) - _ms(trip['start_time'])),
+    'distance': (('start_odometer', 'end_odometer', 'gps_distance_m'), _distance_km),
+    'max_speed': (('max_speed',), lambda trip: round(trip['max_speed'], 1)),
+    'avg_speed': (('speed_sum', 'speed_count'), _avg_speed),
+    'num_points': (('point_count',), lambda trip: trip['point_count']),
+    'ongoing': (('ongoing',), lambda trip: trip['ongoing']),
+    'vin': (('vin',), lambda trip: trip['vin'])
+}
+
+def fetch_trips(cursor, imei, start_time, fields=None):
+    """
+    Return trip summaries overlapping the window, oldest first.
+    fields limits the summary (and the columns read) to those names;
+    the trip id is always included.
+    """
+    fields = ['id'] + [f for f in fields if f != 'id'] if fields else list(SUMMARY_FIELDS)
+    columns = []
+    for field in fields:
+        for column in SUMMARY_FIELDS[field][0]:
+            if column not in columns:
+                columns.append(column)
+    cursor.execute(f"""
+        SELECT {', '.join(columns)}
+        FROM trips
+        WHERE imei = %s AND end_time >= %s
+        ORDER BY start_time ASC
+    """, (imei, start_time))
+    return [trip_summary(dict(zip(columns, row)), fields) for row in cursor.fetchall()]
+
+def checkpoint_time(cursor, imei):
+    """When the device's trips were last updated, or None"""
+    cursor.execute("SELECT updated_at FROM trip_checkpoints WHERE imei = %s", (imei,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+def ignition_on_seconds(cursor, imei, start_time, end_time):
+    """Seconds of ignition-on (trip) time within [start_time, end_time]"""
+    cursor.execute("""
+        SELECT COALESCE(SUM(EXTRACT(EPOCH FROM LEAST(end_time, %s) - GREATEST(start_time, %s))), 0)
+        FROM trips
+        WHERE imei = %s AND end_time >= %s AND start_time <= %s
+    """, (end_time, start_time, imei, start_time, end_time))
+    return float(cursor.fetchone()[0])
+
+def trip_summary(trip, fields=None):
+    """Build the API representation of a persisted trip row"""
+    return {field: SUMMARY_FIELDS[field][1](trip) for field in (fields or SUMMARY_FIELDS)}
+
+class TripUpdater:
+    """
+    Background thread that keeps every active device's trips up to date.
+    Each API process runs one, but only the one holding the trip_engine
+    advisory lock (on its own connection) does any work; the others stand
+    by and take over when that process goes away.
+    """
+
+    def __init__(self, interval=UPDATE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.leader = False
+        self.rounds = 0
+        self.rows = 0
+        self.errors = 0
+        self.last_round = None
+
+    def start(self):
+        """Start the updater thread if it isn't running yet"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trip-updater', daemon=True)
+                self._thread.start()
+
+    def run_once(self, conn):
+        """Catch up every device with new telemetry; returns the rows processed"""
+        cursor = conn.cursor()
+        cursor.execute(PENDING_DEVICES_SQL)
+        imeis = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        conn.commit()
+        processed = 0
+        for imei in imeis:
+            try:
+                with metrics.timed('trip_update'):
+                    processed += update_trips(conn, imei)
+            except Exception:
+                if conn.closed:
+                    raise
+                self.errors += 1
+                metrics.BACKGROUND_ERRORS.inc('trip_update')
+                log.exception("Trip update failed for %s", imei)
+        return processed
+
+    def stats(self):
+        return {
+            'leader': self.leader,
+            'rounds': self.rounds,
+            'rows': self.rows,
+            'errors': self.errors,
+            'last_round': self.last_round
+        }
+
+    def _run(self):
+        conn = None
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    self.leader = False
+                    conn = psycopg2.connect(**DB_CONFIG)
+                if not self.leader:
+                    self.leader = try_advisory_lock(conn, 'trip_engine')
+                if self.leader:
+                    self.rows += self.run_once(conn)
+                    self.rounds += 1
+                    self.last_round = time.time()
+            except Exception:
+                self.errors += 1
+                metrics.BACKGROUND_ERRORS.inc('trip_updater')
+                log.exception("Trip updater error")
+                # Closing the session releases the lock for another process
+                if conn is not None:
+                    conn.close()
+                conn = None
+                self.leader = False
+            time.sleep(self.interval)
+
+trip_updater = TripUpdater()